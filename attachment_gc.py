@@ -0,0 +1,224 @@
+import os
+import time
+import traceback
+from collections import namedtuple
+
+import attachments
+import db
+import tasks
+from queries import is_attachment_referenced, iter_attachment_paths, release_attachment
+
+QUARANTINE_DIR = os.path.join(attachments.FILES_DIR, 'quarantine')
+PASS_BUDGET_BYTES = 256 * 1024 * 1024
+PASS_MAX_FILES = 2000
+GRACE_PERIOD_S = 60 * 60
+TEMP_MAX_AGE_S = 24 * 60 * 60
+QUARANTINE_MAX_AGE_S = 7 * 24 * 60 * 60
+IDLE_DELAY_MS = 60 * 1000
+CHECK_INTERVAL_MS = 30 * 1000
+NEXT_PASS_DELAY_MS = 1000
+CYCLE_INTERVAL_S = 60 * 60
+
+# Итог прохода: cursor — последний просмотренный путь (следующий проход начнёт после него),
+# finished — files/ просмотрен до конца, reclaimed_bytes — сколько места освобождено на диске
+PassResult = namedtuple('PassResult', 'cursor finished files reclaimed_bytes quarantined_bytes')
+
+# Сборщик неиспользуемых вложений. Файлы в files/ обходятся в порядке возрастания пути и сливаются
+# с отсортированными путями из messages (iter_attachment_paths) — ни список файлов, ни список
+# ссылок целиком в памяти не держится. Проход ограничен бюджетом байт и числом файлов и продолжается
+# со своего курсора, поэтому большая папка разбирается по частям, пока приложение простаивает.
+# Перед удалением ссылки перепроверяются в транзакции BEGIN IMMEDIATE: вставка сообщения с этим
+# файлом не может проскочить между проверкой и удалением. Свежие файлы (моложе GRACE_PERIOD_S)
+# не трогаются: блоб мог только что попасть в хранилище, а сообщение ещё в очереди отправки.
+# Блоб, взятый заново для нового сообщения, тоже становится свежим (attachments.pin_blob).
+# Кроме файлов без ссылок собираются превью удалённых блобов, брошенные временные файлы загрузок
+# и старый карантин.
+
+# Запуск в простое: проходы идут в рабочем потоке, когда пользователь ничего не делал IDLE_DELAY_MS;
+# после незаконченного прохода следующий начинается через NEXT_PASS_DELAY_MS с того же курсора,
+# а новый полный цикл — не раньше чем через CYCLE_INTERVAL_S (или сразу после request()).
+# last_report — итог последнего полного цикла: (освобождено байт, перенесено в карантин байт)
+_root = None
+_quarantine = False
+_on_report = None
+_cursor = ''
+_running = False
+_forced = False
+_last_activity = 0.0
+_next_cycle = 0.0
+_cycle = [0, 0]
+last_report = None
+
+def collect(cursor='', budget_bytes=PASS_BUDGET_BYTES, max_files=PASS_MAX_FILES, quarantine=False, now=None):
+    now = time.time() if now is None else now
+    candidates = []
+    candidate_bytes = 0
+    scanned = 0
+    finished = True
+    with db.read_connection() as conn:
+        references = iter_attachment_paths(conn, cursor)
+        reference = next(references, None)
+        for path, file_stat in _walk(attachments.FILES_DIR, cursor):
+            while reference is not None and reference < path:
+                reference = next(references, None)
+            cursor = path
+            scanned += 1
+            if reference != path and _is_garbage(path, file_stat, now):
+                candidates.append((path, file_stat))
+                candidate_bytes += file_stat.st_size
+            if candidate_bytes >= budget_bytes or scanned >= max_files:
+                finished = False
+                break
+
+    removed = reclaimed = quarantined = 0
+    if candidates:
+        conn = db.get_connection()
+        conn.execute('BEGIN IMMEDIATE;')
+        try:
+            for path, file_stat in candidates:
+                # Файл могли тронуть после обхода: блоб, взятый заново (attachments.pin_blob), снова свежий
+                try:
+                    file_stat = os.stat(path, follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if not _is_garbage(path, file_stat, now):
+                    continue
+                if _in_dir(path, attachments.STORE_DIR) and not _in_dir(path, attachments.STORE_TMP_DIR):
+                    if is_attachment_referenced(conn, path) or not release_attachment(conn, os.path.basename(path)):
+                        continue
+                elif not _is_derived(path) and is_attachment_referenced(conn, path):
+                    continue
+                try:
+                    if quarantine and not _in_dir(path, QUARANTINE_DIR):
+                        _move_to_quarantine(path)
+                        quarantined += file_stat.st_size
+                    else:
+                        os.remove(path)
+                        reclaimed += file_stat.st_size
+                except FileNotFoundError:
+                    continue
+                removed += 1
+            conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+    return PassResult(cursor, finished, removed, reclaimed, quarantined)
+
+def _walk(directory, after):
+    # Файлы под directory с путём больше after, по возрастанию пути как строки (так же сортирует
+    # ORDER BY в SQLite): каталог сравнивается как "имя/", поддеревья целиком до after пропускаются
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda entry: entry.name + os.sep if entry.is_dir(follow_symlinks=False) else entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            prefix = entry.path + os.sep
+            if after > prefix and not after.startswith(prefix):
+                continue
+            yield from _walk(entry.path, after)
+        elif entry.path > after:
+            try:
+                yield entry.path, entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+
+def _in_dir(path, directory):
+    return path.startswith(directory + os.sep)
+
+def _is_derived(path):
+    # Файлы, на которые сообщения не ссылаются никогда: превью, временные файлы загрузок, карантин
+    return any(_in_dir(path, directory) for directory in (attachments.THUMBS_DIR, attachments.STORE_TMP_DIR, QUARANTINE_DIR))
+
+def _is_garbage(path, file_stat, now):
+    # Ссылок из сообщений на path нет; решаем, пора ли его убирать
+    changed = max(file_stat.st_mtime, file_stat.st_ctime)
+    if _in_dir(path, QUARANTINE_DIR):
+        # Время попадания в карантин — ctime (переименование его обновляет)
+        return now - file_stat.st_ctime > QUARANTINE_MAX_AGE_S
+    if _in_dir(path, attachments.STORE_TMP_DIR):
+        # Недокачанная загрузка: на паузе её временный файл живёт до TEMP_MAX_AGE_S
+        return now - changed > TEMP_MAX_AGE_S
+    if now - changed <= GRACE_PERIOD_S:
+        return False
+    if _in_dir(path, attachments.THUMBS_DIR):
+        return not os.path.exists(attachments.blob_path(os.path.basename(path)[:64]))
+    return True
+
+def _move_to_quarantine(path):
+    target_path = os.path.join(QUARANTINE_DIR, os.path.relpath(path, attachments.FILES_DIR))
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    os.replace(path, target_path)
+
+def install(root, quarantine=False, on_report=None):
+    # quarantine=True: файлы без ссылок не удаляются, а переносятся в files/quarantine
+    # и удаляются оттуда через QUARANTINE_MAX_AGE_S. on_report(last_report) — после каждого полного цикла
+    global _root, _quarantine, _on_report, _last_activity
+    _root = root
+    _quarantine = quarantine
+    _on_report = on_report
+    _last_activity = time.monotonic()
+    for sequence in ('<Any-KeyPress>', '<Any-ButtonPress>', '<MouseWheel>'):
+        root.bind_all(sequence, _touch, add='+')
+    root.after(CHECK_INTERVAL_MS, _check)
+
+def request():
+    # Сообщения с вложениями удалены: следующий цикл начнётся при первом же простое
+    global _next_cycle
+    _next_cycle = 0.0
+
+def run_now():
+    # Цикл до конца без ожидания простоя (кнопка в настройках)
+    global _forced, _next_cycle
+    _forced = True
+    _next_cycle = 0.0
+    _start_pass()
+
+def _touch(event=None):
+    global _last_activity
+    _last_activity = time.monotonic()
+
+def _is_idle():
+    return (time.monotonic() - _last_activity) * 1000 >= IDLE_DELAY_MS
+
+def _check():
+    if not _running and (_cursor or time.monotonic() >= _next_cycle) and _is_idle():
+        _start_pass()
+    _root.after(CHECK_INTERVAL_MS, _check)
+
+def _start_pass():
+    global _running
+    if _running:
+        return
+    _running = True
+    tasks.submit(collect, _cursor, PASS_BUDGET_BYTES, PASS_MAX_FILES, _quarantine,
+                 on_done=_pass_done, on_error=_pass_failed)
+
+def _pass_done(result):
+    global _running, _forced, _cursor, _next_cycle, _cycle, last_report
+    _running = False
+    _cycle[0] += result.reclaimed_bytes
+    _cycle[1] += result.quarantined_bytes
+    if not result.finished:
+        _cursor = result.cursor
+        _root.after(NEXT_PASS_DELAY_MS, _continue)
+        return
+    _cursor = ''
+    _forced = False
+    _next_cycle = time.monotonic() + CYCLE_INTERVAL_S
+    last_report = tuple(_cycle)
+    _cycle = [0, 0]
+    if _on_report is not None:
+        _on_report(last_report)
+
+def _continue():
+    if not _running and (_forced or _is_idle()):
+        _start_pass()
+
+def _pass_failed(error):
+    global _running, _forced
+    _running = False
+    _forced = False
+    traceback.print_exception(error)
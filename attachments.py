@@ -0,0 +1,213 @@
+import errno
+import os
+import stat
+import threading
+from collections import OrderedDict, namedtuple
+
+FILES_DIR = 'files'
+STORE_DIR = os.path.join(FILES_DIR, 'blobs')
+STORE_TMP_DIR = os.path.join(STORE_DIR, 'tmp')
+THUMBS_DIR = os.path.join(FILES_DIR, 'thumbs')
+CHUNK_SIZE = 1024 * 1024
+COPY_STEP = 16 * 1024 * 1024
+HASH_CACHE_SIZE = 1024
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
+FICLONE = 0x40049409  # ioctl из linux/fs.h: reflink всего файла (btrfs, xfs, bcachefs)
+# Ошибки, при которых способ копирования не поддерживается этой ФС или парой ФС — пробуем следующий
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM}
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Вложение в хранилище: path — путь к блобу (его же пишем в messages.file_path), name — исходное имя файла
+Attachment = namedtuple('Attachment', 'file_hash path name size')
+
+# Хранилище вложений с адресацией по содержимому: файл лежит один раз под своим SHA-256
+# (files/blobs/ab/abcdef...), сообщения ссылаются на хеш, а таблица attachments считает ссылки.
+# Блобы только для чтения и никогда не отдаются жёсткими ссылками ни в хранилище, ни из него: блоб общий
+# для всех сообщений с этим хешем, и правка файла по такой ссылке испортила бы их все. Вне хранилища
+# оказываются только независимые копии — reflink (копирование при записи) или копия данных.
+# Кэш хешей по (путь, устройство, inode, размер, mtime): повторная отправка того же файла
+# не читает его заново и не копирует.
+_hash_cache = OrderedDict()
+_hash_cache_lock = threading.Lock()
+
+def blob_path(file_hash):
+    return os.path.join(STORE_DIR, file_hash[:2], file_hash)
+
+def is_image(name):
+    return bool(name) and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+def hash_from_path(path):
+    # Путь внутри хранилища (пересылка уже сохранённого вложения): хеш — это имя файла
+    name = os.path.basename(path)
+    if len(name) == 64 and os.path.abspath(path) == os.path.abspath(blob_path(name)):
+        return name
+    return None
+
+def _source_key(path, file_stat):
+    return os.path.abspath(path), file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+def _cached_hash(key):
+    with _hash_cache_lock:
+        file_hash = _hash_cache.get(key)
+        if file_hash is not None:
+            _hash_cache.move_to_end(key)
+        return file_hash
+
+def remember_hash(path, file_stat, file_hash):
+    key = _source_key(path, file_stat)
+    with _hash_cache_lock:
+        _hash_cache[key] = file_hash
+        _hash_cache.move_to_end(key)
+        while len(_hash_cache) > HASH_CACHE_SIZE:
+            _hash_cache.popitem(last=False)
+
+def find_stored(path):
+    # Attachment, если содержимое файла уже есть в хранилище и хеш известен без чтения файла, иначе None
+    file_stat = os.stat(path)
+    file_hash = hash_from_path(path) or _cached_hash(_source_key(path, file_stat))
+    if file_hash is None or not pin_blob(file_hash):
+        return None
+    return Attachment(file_hash, blob_path(file_hash), os.path.basename(path), file_stat.st_size)
+
+def pin_blob(file_hash):
+    # Блоб уже в хранилище и будет использован заново: свежее время изменения защищает его от сборщика
+    # (attachment_gc.GRACE_PERIOD_S), пока сообщение с ним ждёт в очереди отправки. False — блоба нет
+    try:
+        os.utime(blob_path(file_hash))
+    except FileNotFoundError:
+        return False
+    return True
+
+def check_unchanged(path, file_stat):
+    # Хеш посчитан по содержимому на момент file_stat: изменённый за это время файл в хранилище не кладём
+    if _source_key(path, os.stat(path)) != _source_key(path, file_stat):
+        raise OSError(errno.EAGAIN, "Файл изменился во время добавления", path)
+
+def commit_blob(temp_path, file_hash):
+    # Переносит готовый временный файл на место блоба; при гонке двух одинаковых загрузок побеждает первая
+    target_path = blob_path(file_hash)
+    if pin_blob(file_hash):
+        os.remove(temp_path)
+        return target_path
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.replace(temp_path, target_path)
+    return target_path
+
+def export_file(path, target_path):
+    # Сохранение вложения пользователю: копия рядом с целью, затем атомарная замена. Копия доступна
+    # на запись, как обычный скачанный файл
+    temp_path = f"{target_path}.{os.getpid()}.part"
+    try:
+        method = copy_file(path, temp_path)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return method
+
+def copy_file(source_path, target_path):
+    # Копирует файл самым дешёвым доступным способом и возвращает его название:
+    # reflink (FICLONE) -> copy_file_range -> sendfile -> копирование блоками. target_path не должен существовать.
+    method = clone_file(source_path, target_path)
+    if method is not None:
+        return method
+    with open(source_path, 'rb') as source, open(target_path, 'xb') as target:
+        return copy_data(source, target)
+
+def clone_file(source_path, target_path):
+    # Копия без копирования данных: 'reflink' или None, если ФС его не позволяет. Жёсткая ссылка сюда
+    # не относится: у неё с источником одно содержимое, а не копия при записи
+    with open(source_path, 'rb') as source:
+        if _reflink(source, target_path):
+            return 'reflink'
+    return None
+
+def _reflink(source, target_path):
+    if fcntl is None:
+        return False
+    with open(target_path, 'xb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return True
+        except OSError as error:
+            if error.errno not in UNSUPPORTED_ERRNOS:
+                raise
+    os.remove(target_path)
+    return False
+
+def copy_data(source, target, offset=0, on_progress=None):
+    # Копирует данные открытых файлов начиная с offset (продолжение прерванной копии) блоками COPY_STEP;
+    # on_progress(offset) вызывается после каждого блока и может прервать копирование исключением
+    size = os.fstat(source.fileno()).st_size
+    for method, copy_range in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile)):
+        try:
+            _copy_steps(copy_range, source.fileno(), target.fileno(), offset, size, on_progress)
+            return method
+        except _Unsupported as unsupported:
+            # Способ отказал (возможно, на середине) — продолжаем следующим с того же места
+            offset = unsupported.offset
+
+    source.seek(offset)
+    target.seek(offset)
+    target.truncate(offset)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    while True:
+        read = source.readinto(buffer)
+        if not read:
+            break
+        target.write(view[:read])
+        offset += read
+        if on_progress is not None and offset % COPY_STEP < CHUNK_SIZE:
+            on_progress(offset)
+    if on_progress is not None:
+        on_progress(offset)
+    return 'chunked'
+
+def _copy_steps(copy_range, source_fd, target_fd, offset, size, on_progress):
+    while offset < size:
+        copied = copy_range(source_fd, target_fd, offset, min(COPY_STEP, size - offset))
+        if copied == 0:
+            break
+        offset += copied
+        if on_progress is not None:
+            on_progress(offset)
+
+class _Unsupported(Exception):
+
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.offset = offset
+
+def _copy_file_range(source_fd, target_fd, offset, count):
+    if not hasattr(os, 'copy_file_range'):
+        raise _Unsupported(offset)
+    try:
+        return os.copy_file_range(source_fd, target_fd, count, offset, offset)
+    except OSError as error:
+        if error.errno in UNSUPPORTED_ERRNOS:
+            raise _Unsupported(offset)
+        raise
+
+def _sendfile(source_fd, target_fd, offset, count):
+    if not hasattr(os, 'sendfile'):
+        raise _Unsupported(offset)
+    try:
+        os.lseek(target_fd, offset, os.SEEK_SET)
+        return os.sendfile(target_fd, source_fd, offset, count)
+    except OSError as error:
+        if error.errno in UNSUPPORTED_ERRNOS:
+            raise _Unsupported(offset)
+        raise
+
+def display_name(message):
+    # Исходное имя вложения (messages.file_name), для старых сообщений — имя файла из file_path
+    if len(message) > 6 and message[6]:
+        return message[6]
+    return os.path.basename(message[3]) if message[3] else None
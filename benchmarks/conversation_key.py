@@ -0,0 +1,159 @@
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import db
+import schema
+from queries import CONVERSATION_KEY_SQL, LOAD_CHAT_MESSAGES_BEFORE_SQL, MAX_MESSAGE_ID, MESSAGE_COLUMNS, MESSAGE_PAGE_SIZE, chat_key
+
+# Как переписка выбиралась до conversation_key: OR двух пар (так удалял чат delete_chat)
+# и UNION ALL двух поисков по индексу (receiver_type, receiver_id, sender_id)
+OR_PAGE_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE receiver_type = 'user'
+    AND ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
+    AND id < ?
+    ORDER BY id DESC LIMIT ?;
+'''
+
+UNION_PAGE_SQL = f'''
+    SELECT * FROM (
+        SELECT {MESSAGE_COLUMNS}
+        FROM messages
+        WHERE receiver_type = 'user' AND receiver_id = ? AND sender_id = ? AND id < ?
+        AND sender_id != receiver_id
+        ORDER BY id DESC LIMIT ?
+    )
+    UNION ALL
+    SELECT * FROM (
+        SELECT {MESSAGE_COLUMNS}
+        FROM messages
+        WHERE receiver_type = 'user' AND receiver_id = ? AND sender_id = ? AND id < ?
+        AND sender_id != receiver_id
+        ORDER BY id DESC LIMIT ?
+    )
+    ORDER BY id DESC LIMIT ?;
+'''
+
+OR_COUNT_SQL = '''
+    SELECT COUNT(*) FROM messages
+    WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?);
+'''
+
+KEY_COUNT_SQL = f'''
+    SELECT COUNT(*) FROM messages WHERE {CONVERSATION_KEY_SQL} = ? AND sender_id != receiver_id;
+'''
+
+def build_database(conn, rows, users, groups):
+    # Схема до _add_conversation_key; триггеры на messages снимаются на время массовой вставки
+    # (индекс по основам, список чатов) — замеряются только выборки переписки
+    target = schema.MIGRATIONS.index(schema._add_conversation_key)
+    for version in range(target):
+        conn.execute('BEGIN IMMEDIATE;')
+        schema.MIGRATIONS[version](conn)
+        conn.execute(f'PRAGMA user_version = {version + 1};')
+        conn.commit()
+    triggers = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'messages';")]
+    with conn:
+        for name in triggers:
+            conn.execute(f'DROP TRIGGER {name};')
+        conn.execute('''
+            WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < ?1)
+            INSERT INTO messages (sender_id, receiver_id, content, receiver_type, ts_ms)
+            SELECT abs(random()) % ?2 + 1,
+                   CASE WHEN n % 20 = 0 THEN abs(random()) % ?3 + 1 ELSE abs(random()) % ?2 + 1 END,
+                   'Сообщение номер ' || n,
+                   CASE WHEN n % 20 = 0 THEN 'group' ELSE 'user' END,
+                   1700000000000 + n
+            FROM numbers;
+        ''', (rows, users, groups))
+    conn.execute('ANALYZE;')
+
+def pick_pairs(conn, count):
+    # Переписки, которые есть в базе: пары из случайных сообщений
+    top = conn.execute('SELECT MAX(id) FROM messages;').fetchone()[0]
+    pairs = []
+    while len(pairs) < count:
+        row = conn.execute('''
+            SELECT sender_id, receiver_id FROM messages
+            WHERE id >= ? AND receiver_type = 'user' AND sender_id != receiver_id LIMIT 1;
+        ''', (random.randint(1, top),)).fetchone()
+        if row is not None:
+            pairs.append(row)
+    return pairs
+
+def measure(name, conn, sql, make_params, pairs):
+    timings = []
+    for pair in pairs:
+        started = time.perf_counter()
+        conn.execute(sql, make_params(*pair)).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95)]
+    print(f"{name}: p50 {statistics.median(timings):.3f} мс, p95 {p95:.3f} мс")
+
+def measure_key(title, conn, pairs, page):
+    print(title)
+    measure("    страница, conversation_key", conn, LOAD_CHAT_MESSAGES_BEFORE_SQL,
+            lambda a, b: (chat_key(a, b), MAX_MESSAGE_ID, MAX_MESSAGE_ID, page), pairs)
+    measure("    вся переписка (delete_chat), conversation_key", conn, KEY_COUNT_SQL,
+            lambda a, b: (chat_key(a, b),), pairs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Выборки переписки до и после conversation_key")
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--groups', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--dir', default=None, help="каталог для тестовой базы")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        db.configure(os.path.join(tmp, 'conversations.db'))
+        conn = db.get_connection()
+        started = time.perf_counter()
+        build_database(conn, args.rows, args.users, args.groups)
+        print(f"база: {args.rows:,} сообщений за {time.perf_counter() - started:.0f} с")
+        pairs = pick_pairs(conn, args.queries)
+        page = MESSAGE_PAGE_SIZE
+
+        print("до миграции:")
+        measure("    страница, OR двух пар", conn, OR_PAGE_SQL,
+                lambda a, b: (a, b, b, a, MAX_MESSAGE_ID, page), pairs)
+        measure("    страница, UNION ALL двух поисков", conn, UNION_PAGE_SQL,
+                lambda a, b: (b, a, MAX_MESSAGE_ID, page, a, b, MAX_MESSAGE_ID, page, page), pairs)
+        measure("    вся переписка (delete_chat), OR двух пар", conn, OR_COUNT_SQL,
+                lambda a, b: (a, b, b, a), pairs)
+
+        # Только _add_conversation_key: следующие миграции к замеру не относятся
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE;')
+        schema._add_conversation_key(conn)
+        conn.execute(f'PRAGMA user_version = {schema.MIGRATIONS.index(schema._add_conversation_key) + 1};')
+        conn.commit()
+        print(f"миграция _add_conversation_key: {time.perf_counter() - started:.1f} с")
+        # Страница идёт по (время, id) — нужен и индекс по времени внутри переписки
+        with conn:
+            schema._add_message_time_order(conn)
+        conn.execute('ANALYZE;')
+        # Запросы читают ключ через COALESCE, поэтому работают и до заполнения старых строк
+        measure_key("до заполнения ключа:", conn, pairs, page)
+
+        # Ключ старых строк заполняется после миграции транзакциями по BACKFILL_BATCH_SIZE строк:
+        # блокировка записи держится только на время одной из них
+        started = time.perf_counter()
+        filled = schema.backfill_conversation_key(conn, pause=0)
+        elapsed = time.perf_counter() - started
+        batches = filled // schema.BACKFILL_BATCH_SIZE + 1
+        print(f"backfill_conversation_key: {filled:,} строк за {elapsed:.1f} с, "
+              f"{batches:,} транзакций, в среднем {elapsed / batches * 1000:.0f} мс")
+        measure_key("после заполнения ключа:", conn, pairs, page)
+        db.close_all()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import core
+import db
+import outbox
+import schema
+from benchmarks import dataset
+from queries import (
+    authenticate_user, find_user, get_previous_chats, get_user_groups, load_group_messages, load_messages,
+)
+
+PERCENTILES = (50, 95, 99)
+
+# Замеры функций слоя данных, которые вызывает main.py, на базе из benchmarks.dataset.
+# Каждая операция вызывается с параметрами, выбранными из самой базы (существующие пользователи,
+# переписки, группы), и даёт p50/p95/p99. Результат пишется в JSON вместе с коммитом и параметрами
+# базы и числом строк в таблицах после замера; --compare сравнивает его с результатом другого коммита на той же базе.
+# Замеры идут на копии базы: create_message пишет в неё, а исходная база должна оставаться одинаковой.
+
+def percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+def sample_parameters(rng, count):
+    with db.read_connection() as conn:
+        users = conn.execute('SELECT MAX(id) FROM users;').fetchone()[0]
+        top = conn.execute('SELECT MAX(id) FROM messages;').fetchone()[0]
+        members = conn.execute('SELECT group_id, user_id FROM group_members;').fetchall()
+        pairs = []
+        while len(pairs) < count:
+            row = conn.execute('''
+                SELECT sender_id, receiver_id FROM messages
+                WHERE id >= ? AND receiver_type = 'user' AND sender_id != receiver_id LIMIT 1;
+            ''', (rng.randint(1, top),)).fetchone()
+            if row is not None:
+                pairs.append(row)
+    return {
+        'users': [rng.randint(1, users) for _ in range(count)],
+        'pairs': pairs,
+        'members': [rng.choice(members) for _ in range(count)] if members else [],
+    }
+
+def operations(parameters):
+    # Имя операции -> функция (номер вызова) -> результат
+    users = parameters['users']
+    pairs = parameters['pairs']
+    members = parameters['members']
+
+    def create_message(number):
+        # Путь данных main.create_message без окна: очередь отправки и ожидание фиксации
+        user_id, peer_id = pairs[number]
+        return core.send_message(user_id, peer_id, f"Замер {number}").result()
+
+    result = {
+        'authenticate_user': lambda number: authenticate_user(
+            dataset.username(users[number]), dataset.password(users[number])),
+        'find_user': lambda number: find_user(
+            dataset.username(users[number]) if number % 2 else str(users[number])),
+        'load_messages': lambda number: load_messages(*pairs[number]),
+        'get_previous_chats': lambda number: get_previous_chats(users[number]),
+        'get_user_groups': lambda number: get_user_groups(users[number]),
+        'create_message': create_message,
+    }
+    if members:
+        result['load_group_messages'] = lambda number: load_group_messages(members[number][0])
+    return result
+
+def measure(operation, iterations, warmup):
+    for number in range(warmup):
+        operation(number)
+    timings = []
+    for number in range(iterations):
+        started = time.perf_counter()
+        operation(number)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    summary = {f'p{percent}_ms': round(percentile(timings, percent), 4) for percent in PERCENTILES}
+    summary['mean_ms'] = round(sum(timings) / len(timings), 4)
+    summary['max_ms'] = round(timings[-1], 4)
+    return summary
+
+def describe_database():
+    with db.read_connection() as conn:
+        return {
+            table: conn.execute(f'SELECT COUNT(*) FROM {table};').fetchone()[0]
+            for table in ('users', 'groups', 'group_members', 'messages', 'attachments')
+        }
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def copy_database(source, target):
+    # Через backup, а не копированием файла: в копию попадает и то, что ещё лежит в WAL
+    source_conn = sqlite3.connect(source)
+    target_conn = sqlite3.connect(target)
+    try:
+        source_conn.backup(target_conn)
+    finally:
+        target_conn.close()
+        source_conn.close()
+
+def run(database, iterations, warmup, seed):
+    db.configure(database)
+    schema.migrate()
+    parameters = sample_parameters(random.Random(seed), iterations + warmup)
+    table = operations(parameters)
+    results = {}
+    for name, operation in table.items():
+        results[name] = measure(operation, iterations, warmup)
+        print(f"{name}: " + ", ".join(f"{key[:-3]} {value:.3f} мс" for key, value in results[name].items()))
+    outbox.shutdown()
+    counts = describe_database()
+    db.close_all()
+    return counts, results
+
+def compare(baseline, current):
+    print(f"сравнение с {baseline.get('label') or baseline.get('commit')}:")
+    for name, summary in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        cells = []
+        for percent in PERCENTILES:
+            key = f'p{percent}_ms'
+            change = (summary[key] - previous[key]) / previous[key] * 100 if previous[key] else 0
+            cells.append(f"p{percent} {previous[key]:.3f} -> {summary[key]:.3f} мс ({change:+.0f}%)")
+        print(f"    {name}: " + ", ".join(cells))
+
+def main():
+    parser = argparse.ArgumentParser(description="p50/p95/p99 функций слоя данных на синтетической базе")
+    parser.add_argument('--database', help="готовая база из benchmarks.dataset; без неё база создаётся заново")
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--output', help="куда записать результат в JSON")
+    parser.add_argument('--label', help="подпись результата, по умолчанию — коммит")
+    parser.add_argument('--compare', help="JSON прошлого запуска для сравнения")
+    dataset.add_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'app_database.db')
+        if args.database:
+            copy_database(args.database, path)
+            parameters = {'source': os.path.abspath(args.database)}
+        else:
+            parameters = dataset.generate_from_args(path, args)
+        counts, results = run(path, args.iterations, args.warmup, args.seed)
+
+    commit = current_commit()
+    report = {
+        'label': args.label or commit,
+        'commit': commit,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'dataset': parameters,
+        'tables': counts,
+        'iterations': args.iterations,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as target:
+            json.dump(report, target, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as source:
+            compare(json.load(source), report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import hashlib
+import os
+import random
+import time
+
+import attachments
+import db
+import schema
+from queries import insert_message
+
+BATCH_SIZE = 10000
+START_MS = 1_700_000_000_000
+FILE_NAMES = ['отчёт.pdf', 'договор.docx', 'таблица.xlsx', 'архив.zip', 'заметки.txt']
+IMAGE_NAMES = ['фото.jpg', 'скриншот.png', 'схема.png']
+WORDS = ('привет как дела завтра встреча в офисе отправил файл посмотри пожалуйста документы '
+         'договор отчёт готов созвонимся вечером спасибо хорошо проект сроки задача').split()
+
+# Синтетическая база той же схемы, что app_database.db. Пользователь user{N} с паролем password{N};
+# у каждого есть круг собеседников, поэтому переписки получаются длинными, как в жизни, а не
+# по сообщению на пару. Сообщения пишутся через insert_message со всеми триггерами схемы
+# (список чатов, поисковый индекс, счётчики ссылок вложений), так что база ничем не отличается
+# от наработанной приложением. Файлы вложений на диск не пишутся — в базе только ссылки на блобы.
+
+def username(number):
+    return f"user{number}"
+
+def password(number):
+    return f"password{number}"
+
+def make_text(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+
+def make_attachment(rng, number, names):
+    # Блоб под хешем, выведенным из номера сообщения: часть вложений повторяется, как пересланные файлы
+    file_hash = hashlib.sha256(str(number % 1000 if rng.random() < 0.3 else number).encode()).hexdigest()
+    return attachments.Attachment(file_hash, attachments.blob_path(file_hash), rng.choice(names), rng.randint(1024, 4 << 20))
+
+def generate(path, users=1000, groups=50, group_size=20, messages=100_000, contacts=20, group_ratio=0.2,
+             attachment_ratio=0.05, image_ratio=0.02, seed=1):
+    # Создаёт базу path (её не должно быть) и возвращает словарь с параметрами для отчёта
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    rng = random.Random(seed)
+    db.configure(path)
+    schema.migrate()
+    conn = db.get_connection()
+
+    with conn:
+        conn.executemany('INSERT INTO users (id, username, password) VALUES (?, ?, ?);',
+                         [(number, username(number), password(number)) for number in range(1, users + 1)])
+        conn.executemany('INSERT INTO groups (id, name) VALUES (?, ?);',
+                         [(number, f"Группа {number}") for number in range(1, groups + 1)])
+        members = {}
+        for group_id in range(1, groups + 1):
+            members[group_id] = rng.sample(range(1, users + 1), min(group_size, users))
+            conn.executemany('INSERT INTO group_members (group_id, user_id) VALUES (?, ?);',
+                             [(group_id, user_id) for user_id in members[group_id]])
+
+    peers = {user_id: rng.sample([peer for peer in range(1, users + 1) if peer != user_id], min(contacts, users - 1))
+             for user_id in range(1, users + 1)}
+    # Собеседники взаимны: если у a есть b, то и b пишет a
+    for user_id in range(1, users + 1):
+        for peer_id in peers[user_id]:
+            if user_id not in peers[peer_id]:
+                peers[peer_id].append(user_id)
+
+    ts_ms = START_MS
+    written = 0
+    while written < messages:
+        with conn:
+            for number in range(written, min(written + BATCH_SIZE, messages)):
+                ts_ms += rng.randint(1, 60_000)
+                if groups and rng.random() < group_ratio:
+                    receiver_type = 'group'
+                    receiver_id = rng.randint(1, groups)
+                    sender_id = rng.choice(members[receiver_id])
+                else:
+                    receiver_type = 'user'
+                    sender_id = rng.randint(1, users)
+                    receiver_id = rng.choice(peers[sender_id])
+                attachment = image_path = None
+                roll = rng.random()
+                if roll < image_ratio:
+                    attachment = make_attachment(rng, number, IMAGE_NAMES)
+                    image_path = attachment.path
+                elif roll < image_ratio + attachment_ratio:
+                    attachment = make_attachment(rng, number, FILE_NAMES)
+                insert_message(conn, sender_id, receiver_id, make_text(rng), image_path=image_path,
+                               receiver_type=receiver_type, attachment=attachment, ts_ms=ts_ms)
+            written = number + 1
+    conn.execute('ANALYZE;')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+    db.close_all()
+    return {
+        'users': users, 'groups': groups, 'group_size': group_size, 'messages': messages, 'contacts': contacts,
+        'group_ratio': group_ratio, 'attachment_ratio': attachment_ratio, 'image_ratio': image_ratio, 'seed': seed,
+    }
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--contacts', type=int, default=20, help="собеседников у пользователя")
+    parser.add_argument('--group-ratio', type=float, default=0.2, help="доля сообщений в группы")
+    parser.add_argument('--attachment-ratio', type=float, default=0.05, help="доля сообщений с файлом")
+    parser.add_argument('--image-ratio', type=float, default=0.02, help="доля сообщений с изображением")
+    parser.add_argument('--seed', type=int, default=1)
+
+def generate_from_args(path, args):
+    return generate(path, args.users, args.groups, args.group_size, args.messages, args.contacts,
+                    args.group_ratio, args.attachment_ratio, args.image_ratio, args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетическая база app_database.db для замеров")
+    parser.add_argument('output', help="путь к новой базе")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    generate_from_args(args.output, args)
+    size_mb = os.path.getsize(args.output) / 1024 / 1024
+    print(f"{args.output}: {args.messages:,} сообщений, {size_mb:,.0f} МБ за {time.perf_counter() - started:.0f} с")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import db
+import queries
+import sync
+from benchmarks import dataset
+
+# Синхронизация двух баз по журналу изменений (sync.py). База A — из benchmarks.dataset, B — её копия
+# файлом (со своим site, как положено копии). Затем обе стороны независимо меняют данные: сообщения
+# в личных переписках и группах, новый пользователь и группа, удаление переписки — и sync_files сводит
+# их. Замеряется, сколько байт ушло в каждую сторону, против размера базы и первой полной синхронизации
+# в пустую базу C. В конце проверяется, что сообщения во всех трёх базах совпадают.
+
+def copy_database(source, target):
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+
+def make_changes(conn, rng, count, users, label):
+    # count изменений на одной стороне; возвращает число строк журнала, которые они дали
+    before = conn.execute('SELECT COUNT(*) FROM change_log;').fetchone()[0]
+    group_ids = [row[0] for row in conn.execute('SELECT id FROM groups;')]
+    with conn:
+        user_id = conn.execute('INSERT INTO users (username, password) VALUES (?, ?);',
+                               (f"{label}-новый", 'password')).lastrowid
+        group_id = conn.execute('INSERT INTO groups (name) VALUES (?);', (f"Группа {label}",)).lastrowid
+        conn.executemany('INSERT INTO group_members (group_id, user_id) VALUES (?, ?);',
+                         [(group_id, user_id), (group_id, 1), (group_id, 2)])
+        for number in range(count):
+            text = f"{label} {number}: {dataset.make_text(rng)}"
+            if rng.random() < 0.2:
+                queries.insert_message(conn, 1, rng.choice(group_ids + [group_id]), text, receiver_type='group')
+            else:
+                sender_id, receiver_id = rng.sample(range(1, users + 1), 2)
+                queries.insert_message(conn, sender_id, receiver_id, text)
+        a, b = rng.sample(range(1, users + 1), 2)
+        conn.execute(f'DELETE FROM messages WHERE {queries.CONVERSATION_KEY_SQL} = ? AND sender_id != receiver_id;',
+                     (queries.chat_key(a, b),))
+    return conn.execute('SELECT COUNT(*) FROM change_log;').fetchone()[0] - before
+
+def message_set(path):
+    # Сообщения без локальных id: (время, текст, имя отправителя)
+    with sqlite3.connect(path) as conn:
+        return set(conn.execute('''
+            SELECT messages.ts_ms, messages.content, users.username
+            FROM messages JOIN users ON users.id = messages.sender_id;
+        '''))
+
+def chat_lists(path):
+    # Последнее сообщение каждой переписки по именам собеседников: оно должно быть последним по времени
+    # в любой базе, в каком бы порядке сообщения в неё ни пришли
+    with sqlite3.connect(path) as conn:
+        return set(conn.execute('''
+            SELECT owner.username, peer.username, conversations.last_ts_ms, conversations.last_preview
+            FROM conversations
+            JOIN users AS owner ON owner.id = conversations.user_id
+            JOIN users AS peer ON peer.id = conversations.peer_id;
+        '''))
+
+def report(name, stats, elapsed):
+    print(f"{name}: получено {stats.received:,} записей ({stats.received_bytes / 1024:,.1f} КБ), "
+          f"отправлено {stats.sent:,} ({stats.sent_bytes / 1024:,.1f} КБ) за {elapsed:.2f} с")
+
+def main():
+    parser = argparse.ArgumentParser(description="Разностная синхронизация двух баз по журналу изменений")
+    dataset.add_arguments(parser)
+    parser.add_argument('--changes', type=int, default=1000, help="новых сообщений на каждой стороне")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path_a, path_b, path_c = (os.path.join(tmp, f'{name}.db') for name in 'abc')
+        dataset.generate_from_args(path_a, args)
+        db.close_all()
+        copy_database(path_a, path_b)
+        conn_b = db.dedicated_connection(path_b)
+        sync.reset_site(conn_b)
+        conn_a = db.dedicated_connection(path_a)
+        print(f"база: {args.messages:,} сообщений, {os.path.getsize(path_a) / 1024 / 1024:,.1f} МБ")
+
+        started = time.perf_counter()
+        report("A и B без изменений", sync.sync_files(path_a, path_b), time.perf_counter() - started)
+
+        logged_a = make_changes(conn_a, rng, args.changes, args.users, 'A')
+        logged_b = make_changes(conn_b, rng, args.changes, args.users, 'B')
+        db.close_connection(conn_a)
+        db.close_connection(conn_b)
+        print(f"изменения: в A {logged_a:,} записей журнала, в B {logged_b:,}")
+        started = time.perf_counter()
+        stats = sync.sync_files(path_a, path_b)
+        report("A и B после изменений", stats, time.perf_counter() - started)
+        print(f"    на запись журнала: {(stats.received_bytes + stats.sent_bytes) / (logged_a + logged_b):.0f} байт")
+
+        started = time.perf_counter()
+        report("пустая C из A (полная)", sync.sync_files(path_c, path_a), time.perf_counter() - started)
+
+        messages = message_set(path_a)
+        assert messages == message_set(path_b) == message_set(path_c), "базы разошлись"
+        print(f"сообщения в A, B и C совпадают: {len(messages):,}")
+        chats = chat_lists(path_a)
+        assert chats == chat_lists(path_b) == chat_lists(path_c), "последние сообщения переписок разошлись"
+        print(f"последние сообщения переписок совпадают: {len(chats):,}")
+
+if __name__ == '__main__':
+    main()
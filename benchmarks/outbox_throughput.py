@@ -0,0 +1,97 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import db
+import schema
+from outbox import Outbox
+from queries import insert_message
+
+class CountingOutbox(Outbox):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = 0
+
+    def flush(self, batch):
+        self.batches += 1
+        super().flush(batch)
+
+def make_message(producer, number):
+    return 1 + producer, 100 + number % 10, f"Сообщение {number} от отправителя {producer}"
+
+def run_producers(producers, messages, send):
+    per_producer = messages // producers
+
+    def produce(producer):
+        for number in range(per_producer):
+            send(*make_message(producer, number))
+
+    threads = [threading.Thread(target=produce, args=(producer,)) for producer in range(producers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return per_producer * producers, started
+
+def per_message_commit(producers, messages):
+    # Прежняя схема create_message: своя транзакция и фиксация на каждое сообщение
+    def send(sender_id, receiver_id, content):
+        with db.transaction() as conn:
+            insert_message(conn, sender_id, receiver_id, content)
+
+    sent, started = run_producers(producers, messages, send)
+    return sent, time.perf_counter() - started, sent
+
+def group_commit(producers, messages, flush_interval_ms, max_batch_size):
+    outbox = CountingOutbox(flush_interval_ms=flush_interval_ms, max_batch_size=max_batch_size)
+    futures = []
+    futures_lock = threading.Lock()
+
+    def send(sender_id, receiver_id, content):
+        future = outbox.send(sender_id, receiver_id, content)
+        with futures_lock:
+            futures.append(future)
+
+    sent, started = run_producers(producers, messages, send)
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started
+    outbox.close()
+    return sent, elapsed, outbox.batches
+
+def count_messages():
+    with db.read_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM messages;').fetchone()[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность отправки: фиксация на сообщение против групповой")
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--producers', type=int, default=4)
+    parser.add_argument('--flush-interval-ms', type=float, default=5)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--synchronous', choices=['OFF', 'NORMAL', 'FULL'], default=db.SYNCHRONOUS)
+    args = parser.parse_args()
+
+    db.SYNCHRONOUS = args.synchronous
+    runs = [
+        ("фиксация на каждое сообщение", lambda: per_message_commit(args.producers, args.messages)),
+        ("очередь с групповой фиксацией", lambda: group_commit(
+            args.producers, args.messages, args.flush_interval_ms, args.batch_size)),
+    ]
+    for name, run in runs:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.configure(os.path.join(tmp, 'outbox.db'))
+            schema.migrate()
+            sent, elapsed, commits = run()
+            stored = count_messages()
+            db.close_all()
+        assert stored == sent, f"{name}: записано {stored} из {sent}"
+        print(f"{name} (synchronous={args.synchronous}): {sent / elapsed:.0f} сообщ./с, "
+              f"фиксаций: {commits}, в среднем {sent / commits:.1f} сообщ. на фиксацию")
+
+if __name__ == '__main__':
+    main()
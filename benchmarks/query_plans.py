@@ -0,0 +1,46 @@
+import os
+import re
+import sys
+import tempfile
+
+import db
+import schema
+from queries import HOT_QUERIES
+
+# Индекс должен сужать выборку до конкретного пользователя, переписки или группы, а не только до receiver_type;
+# диапазон rowid допустим для запросов выше отметки последнего прочитанного id. <expr>=? — ключ переписки
+# (queries.CONVERSATION_KEY_SQL): других выражений на первом месте в индексах нет
+INDEXED_SEARCH = re.compile(r'^SEARCH \w+ USING (COVERING |INTEGER PRIMARY KEY |PRIMARY KEY )?(INDEX \w+ )?\(.*((sender_id|receiver_id|user_id|group_id|conversation_key|origin|gid|local_id|hash|rowid|<expr>)=\?|rowid>\?)')
+
+def get_plan(conn, sql, params):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+def check_query_plans(conn):
+    failures = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = get_plan(conn, sql, params)
+        # Проход по подзапросу (SCAN (subquery-N)) читает уже ограниченную LIMIT выборку,
+        # json_each — список значений из параметра, а виртуальная таблица FTS5 ищет по своему индексу
+        table_steps = [step for step in plan if step.startswith(('SCAN', 'SEARCH'))
+                       and '(subquery-' not in step and 'VIRTUAL TABLE' not in step]
+        if not table_steps or not all(INDEXED_SEARCH.match(step) for step in table_steps):
+            failures.append((name, plan))
+        print(f"{name}:")
+        for step in plan:
+            print(f"    {step}")
+    return failures
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, 'plans.db'))
+        conn = db.get_connection()
+        schema.migrate(conn)
+        conn.execute('ANALYZE;')
+        failures = check_query_plans(conn)
+        db.close_all()
+
+    assert not failures, f"Запросы без индекса: {[name for name, _ in failures]}"
+    print("Все горячие запросы используют индексы.")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import db
+import queries
+import wire
+from benchmarks import dataset
+from benchmarks.relay_fanout import connect, start_server
+
+# Догон истории по двоичному протоколу без кредитов, пока идут новые сообщения. Клиент входит с after_id=0
+# и credits=0: ретранслятор читает пропущенное пакетами по SYNC_BATCH_SIZE и копит в очереди клиента,
+# а хвост тем временем добавляет туда же свежие сообщения — с id больше, чем у ещё не прочитанных пакетов
+# догона. Отправитель (JSON) всё это время шлёт получателю личные сообщения. Потом клиент выдаёт кредиты
+# и читает кадры, пока не получит всё, что было в базе для получателя в этот момент. Проверяется, что
+# соединение не разорвано, id не повторяются и ничего не пропало.
+
+RECEIVER_ID = 1
+SENDER_ID = 2
+
+class WireBenchClient:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.frames = wire.FrameReader()
+
+    def send(self, payload):
+        self.writer.write(wire.encode_request(payload))
+
+    async def read_frames(self, timeout):
+        # Кадры из следующего куска данных; None — соединение закрыто сервером
+        data = await asyncio.wait_for(self.reader.read(64 * 1024), timeout)
+        if not data:
+            return None
+        self.frames.feed(data)
+        return [(frame_type, bytes(payload)) for frame_type, payload in self.frames.frames()]
+
+async def connect_wire(address, user_id, after_id, credits):
+    reader, writer = await asyncio.open_unix_connection(address, limit=1024 * 1024)
+    client = WireBenchClient(reader, writer)
+    writer.write(wire.MAGIC)
+    client.send({'op': 'auth', 'username': dataset.username(user_id), 'password': dataset.password(user_id),
+                 'after_id': after_id, 'credits': credits})
+    while True:
+        for frame_type, payload in await client.read_frames(10):
+            reply = wire.decode_request(frame_type, memoryview(payload))
+            assert reply['op'] == 'auth_ok', reply
+            return client
+
+async def send_live(sender, rate, stop):
+    # Личные сообщения получателю с равномерным темпом, пока не выставлен stop; ответы sent не ждём
+    started = time.perf_counter()
+    number = 0
+    while not stop.is_set():
+        delay = started + number / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sender.send({'op': 'send', 'type': 'user', 'to': RECEIVER_ID, 'content': f"живое {number}"})
+        number += 1
+    return number
+
+async def drain(reader):
+    while await reader.read(64 * 1024):
+        pass
+
+def expected_ids(path):
+    conn = db.dedicated_connection(path)
+    try:
+        rows = conn.execute(queries.RELAY_USER_MESSAGES_SQL,
+                            (0, RECEIVER_ID, RECEIVER_ID, RECEIVER_ID, 1 << 62)).fetchall()
+    finally:
+        db.close_connection(conn)
+    return {row[0] for row in rows}
+
+async def catch_up(path, address, starve_seconds, timeout):
+    # Возвращает (полученные id, сколько из ожидаемых не пришло, разорвано ли соединение, время доставки)
+    client = await connect_wire(address, RECEIVER_ID, 0, 0)
+    await asyncio.sleep(starve_seconds)
+    expected = await asyncio.to_thread(expected_ids, path)
+    started = time.perf_counter()
+    client.send({'op': 'credit', 'credits': 1_000_000})
+    ids = []
+    missing = set(expected)
+    closed = False
+    while missing:
+        try:
+            frames = await client.read_frames(timeout)
+        except asyncio.TimeoutError:
+            break
+        if frames is None:
+            closed = True
+            break
+        for frame_type, payload in frames:
+            if frame_type in (wire.MESSAGE, wire.BATCH):
+                rows = wire.decode_rows(frame_type, memoryview(payload))
+                ids.extend(row[0] for row in rows)
+                missing.difference_update(row[0] for row in rows)
+    elapsed = time.perf_counter() - started
+    client.writer.close()
+    return ids, len(missing), closed, elapsed
+
+async def run(path, address, args):
+    sender = await connect(address, SENDER_ID)
+    replies = asyncio.create_task(drain(sender.reader))
+    stop = asyncio.Event()
+    live = asyncio.create_task(send_live(sender, args.rate, stop))
+    failures = 0
+    try:
+        for number in range(args.rounds):
+            ids, missing, closed, elapsed = await catch_up(path, address, args.starve, args.timeout)
+            repeated = len(ids) - len(set(ids))
+            failures += closed or repeated or missing > 0
+            print(f"    заход {number + 1}: получено {len(ids):,} за {elapsed:.2f} с, "
+                  f"повторов {repeated}, не пришло {missing}"
+                  f"{', соединение разорвано' if closed else ''}")
+    finally:
+        stop.set()
+        sent = await live
+        sender.writer.close()
+        replies.cancel()
+        await asyncio.gather(replies, return_exceptions=True)
+    print(f"живых сообщений отправлено: {sent:,}")
+    assert not failures, f"заходов с ошибками: {failures} из {args.rounds}"
+    print("все заходы без разрывов, повторов и пропусков")
+
+def main():
+    parser = argparse.ArgumentParser(description="Догон истории без кредитов под живым потоком сообщений")
+    dataset.add_arguments(parser)
+    parser.set_defaults(users=20, groups=2, group_size=5, messages=30_000, contacts=5)
+    parser.add_argument('--rate', type=float, default=200, help="живых сообщений в секунду")
+    parser.add_argument('--starve', type=float, default=0.5, help="сколько клиент держит кредиты на нуле, с")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=10, help="сколько ждать следующего кадра, с")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'app_database.db')
+        dataset.generate_from_args(path, args)
+        db.close_all()
+        address = os.path.join(tmp, 'relay.sock')
+        server = start_server(path, address, tmp)
+        try:
+            asyncio.run(run(path, address, args))
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
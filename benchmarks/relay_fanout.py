@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import db
+from benchmarks import dataset
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONNECT_BATCH = 100
+
+# Нагрузочный тест ретранслятора на localhost: сервер (python -m relay) в отдельном процессе,
+# в этом процессе — все клиенты на одном цикле asyncio. Каждый клиент входит своим пользователем
+# из benchmarks.dataset; отправители шлют личные и групповые сообщения с заданной частотой, в тексте —
+# время отправки (time.time_ns). Задержка доставки — от отправки до прихода сообщения каждому получателю,
+# кроме самого отправителя. Клиенты разбирают JSON в одном процессе, так что на большой нагрузке
+# задержка включает и их собственную очередь.
+
+class BenchClient:
+
+    def __init__(self, user_id, reader, writer):
+        self.user_id = user_id
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, payload):
+        self.writer.write(json.dumps(payload).encode() + b'\n')
+
+async def connect(address, user_id):
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address, limit=1024 * 1024)
+    else:
+        reader, writer = await asyncio.open_connection(*address, limit=1024 * 1024)
+    client = BenchClient(user_id, reader, writer)
+    client.send({'op': 'auth', 'username': dataset.username(user_id), 'password': dataset.password(user_id)})
+    reply = json.loads(await reader.readline())
+    assert reply['op'] == 'auth_ok', reply
+    return client
+
+async def receive(client, latencies, state):
+    while True:
+        line = await client.reader.readline()
+        if not line:
+            return
+        arrived = time.time_ns()
+        payload = json.loads(line)
+        if payload['op'] == 'message' and payload['sender_id'] != client.user_id:
+            latencies[payload['receiver_type']].append((arrived - int(payload['content'])) / 1e6)
+            state['delivered'] += 1
+            if state['delivered'] >= state['expected'] and state['sending_done']:
+                state['finished'].set()
+        elif payload['op'] == 'error':
+            state['errors'] += 1
+
+def start_server(path, address, workdir, workers=1):
+    command = [sys.executable, '-m', 'relay', '--database', path, '--workers', str(workers)]
+    command += ['--unix', address] if isinstance(address, str) else ['--host', address[0], '--port', str(address[1])]
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    server = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+    server.stdout.readline()
+    return server
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def raise_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, needed), hard))
+
+def report(name, values):
+    if not values:
+        return
+    ordered = sorted(values)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"    {name}: доставок {len(values):,}, p50 {statistics.median(ordered):.1f} мс, p95 {p95:.1f} мс, "
+          f"p99 {p99:.1f} мс, максимум {ordered[-1]:.1f} мс")
+
+async def run(address, args, members):
+    started = time.perf_counter()
+    clients = []
+    for first in range(1, args.clients + 1, CONNECT_BATCH):
+        batch = range(first, min(first + CONNECT_BATCH, args.clients + 1))
+        clients.extend(await asyncio.gather(*(connect(address, user_id) for user_id in batch)))
+    print(f"подключено и вошло клиентов: {len(clients)} за {time.perf_counter() - started:.1f} с")
+
+    by_user = {client.user_id: client for client in clients}
+    latencies = {'user': [], 'group': []}
+    state = {'delivered': 0, 'expected': 0, 'errors': 0, 'sending_done': False, 'finished': asyncio.Event()}
+    receivers = [asyncio.create_task(receive(client, latencies, state)) for client in clients]
+
+    rng = random.Random(args.seed)
+    group_ids = [group_id for group_id, users in members.items() if len(users) > 1]
+    started = time.perf_counter()
+    for number in range(args.messages):
+        # Равномерный темп: n-е сообщение уходит не раньше n / rate секунд от начала
+        delay = started + number / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if group_ids and rng.random() < args.group_ratio:
+            group_id = rng.choice(group_ids)
+            sender_id = rng.choice(members[group_id])
+            state['expected'] += sum(1 for user_id in members[group_id] if user_id != sender_id and user_id in by_user)
+            request = {'op': 'send', 'type': 'group', 'to': group_id}
+        else:
+            sender_id, receiver_id = rng.sample(list(by_user), 2)
+            state['expected'] += 1
+            request = {'op': 'send', 'type': 'user', 'to': receiver_id}
+        request['content'] = str(time.time_ns())
+        by_user[sender_id].send(request)
+    sending_time = time.perf_counter() - started
+    state['sending_done'] = True
+    if state['delivered'] >= state['expected']:
+        state['finished'].set()
+    try:
+        await asyncio.wait_for(state['finished'].wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    for client in clients:
+        client.writer.close()
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    print(f"отправлено {args.messages:,} сообщений за {sending_time:.1f} с ({args.messages / sending_time:,.0f} сообщ./с), "
+          f"доставлено {state['delivered']:,} из {state['expected']:,} за {elapsed:.1f} с "
+          f"({state['delivered'] / elapsed:,.0f} доставок/с), ошибок {state['errors']}")
+    print("задержка от отправки до получателя:")
+    report("личные", latencies['user'])
+    report("групповые", latencies['group'])
+    report("все", latencies['user'] + latencies['group'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка рассылки ретранслятора на 1000 клиентах")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=500, help="сообщений в секунду")
+    parser.add_argument('--group-ratio', type=float, default=0.3, help="доля групповых сообщений")
+    parser.add_argument('--transport', choices=['unix', 'tcp'], default='unix')
+    parser.add_argument('--timeout', type=float, default=30, help="сколько ждать доставки после отправки, с")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    raise_file_limit(args.clients * 2 + 100)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'app_database.db')
+        dataset.generate(path, users=args.clients, groups=args.groups, group_size=args.group_size, messages=0,
+                         seed=args.seed)
+        db.configure(path)
+        with db.read_connection() as conn:
+            members = {}
+            for group_id, user_id in conn.execute('SELECT group_id, user_id FROM group_members;'):
+                members.setdefault(group_id, []).append(user_id)
+        db.close_all()
+
+        address = os.path.join(tmp, 'relay.sock') if args.transport == 'unix' else ('127.0.0.1', free_port())
+        server = start_server(path, address, tmp)
+        try:
+            asyncio.run(run(address, args, members))
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
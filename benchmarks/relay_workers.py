@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import db
+from benchmarks import dataset
+from benchmarks.relay_fanout import CONNECT_BATCH, connect, free_port, raise_file_limit, start_server
+
+# Пропускная способность ретранслятора при 1, 2, 4 и 8 рабочих процессах (python -m relay --workers N).
+# Нагрузка замкнутая: каждый клиент отправляет свои сообщения по одному, следующее — после ответа sent,
+# так что сервер получает столько, сколько успевает принять. Клиенты разнесены по нескольким процессам
+# (--client-processes), чтобы упираться в сервер, а не в разбор JSON на стороне клиентов.
+# Замеряется, сколько сообщений в секунду сервер принял (до последнего sent) и сколько доставок
+# в секунду разослал (до последней доставки). На машине с одним ядром процессы делят его между собой
+# и роста с числом процессов ждать не приходится — число ядер печатается вместе с результатами.
+
+async def run_clients(address, user_ids, sends, expected, ready, go, timeout):
+    clients = []
+    for start in range(0, len(user_ids), CONNECT_BATCH):
+        clients.extend(await asyncio.gather(*(connect(address, user_id)
+                                              for user_id in user_ids[start:start + CONNECT_BATCH])))
+    ready.put(len(clients))
+    await asyncio.to_thread(go.wait)
+
+    state = {'delivered': 0, 'errors': 0, 'last_ns': 0, 'acked_ns': 0}
+    latencies = []
+    finished = asyncio.Event()
+    if not expected:
+        finished.set()
+    acks = {client.user_id: asyncio.Queue() for client in clients}
+
+    async def receive(client):
+        while True:
+            line = await client.reader.readline()
+            if not line:
+                return
+            payload = json.loads(line)
+            if payload['op'] == 'message':
+                if payload['sender_id'] == client.user_id:
+                    continue
+                now = time.time_ns()
+                latencies.append((now - int(payload['content'])) / 1e6)
+                state['delivered'] += 1
+                state['last_ns'] = now
+                if state['delivered'] >= expected:
+                    finished.set()
+            else:
+                if payload['op'] == 'error':
+                    state['errors'] += 1
+                acks[client.user_id].put_nowait(payload)
+
+    async def send(client):
+        for receiver_type, receiver_id in sends.get(client.user_id, ()):
+            client.send({'op': 'send', 'type': receiver_type, 'to': receiver_id, 'content': str(time.time_ns())})
+            await acks[client.user_id].get()
+        state['acked_ns'] = max(state['acked_ns'], time.time_ns())
+
+    receivers = [asyncio.create_task(receive(client)) for client in clients]
+    await asyncio.gather(*(send(client) for client in clients))
+    try:
+        await asyncio.wait_for(finished.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    for client in clients:
+        client.writer.close()
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return dict(state, latencies=latencies, expected=expected)
+
+def client_process(address, user_ids, sends, expected, ready, go, results, timeout):
+    raise_file_limit(len(user_ids) * 2 + 100)
+    results.put(asyncio.run(run_clients(address, user_ids, sends, expected, ready, go, timeout)))
+
+def make_plan(args, members):
+    # (отправитель, тип, получатель) на каждое сообщение и число доставок каждому пользователю
+    rng = random.Random(args.seed)
+    user_ids = list(range(1, args.clients + 1))
+    group_ids = [group_id for group_id, users in members.items() if len(users) > 1]
+    plan = []
+    expected = dict.fromkeys(user_ids, 0)
+    for _ in range(args.messages):
+        if group_ids and rng.random() < args.group_ratio:
+            group_id = rng.choice(group_ids)
+            sender_id = rng.choice(members[group_id])
+            plan.append((sender_id, 'group', group_id))
+            recipients = [user_id for user_id in members[group_id] if user_id != sender_id]
+        else:
+            sender_id, receiver_id = rng.sample(user_ids, 2)
+            plan.append((sender_id, 'user', receiver_id))
+            recipients = [receiver_id]
+        for user_id in recipients:
+            expected[user_id] += 1
+    return plan, expected
+
+def run(path, workdir, workers, args, plan, expected):
+    # Каждый прогон — на чистой копии базы, без сообщений предыдущих
+    path = shutil.copy(path, os.path.join(workdir, f'workers-{workers}.db'))
+    address = os.path.join(workdir, 'relay.sock') if args.transport == 'unix' else ('127.0.0.1', free_port())
+    server = start_server(path, address, workdir, workers)
+    context = multiprocessing.get_context('fork')
+    ready, results, go = context.Queue(), context.Queue(), context.Event()
+    processes = []
+    try:
+        for number in range(args.client_processes):
+            user_ids = list(range(1 + number, args.clients + 1, args.client_processes))
+            own = set(user_ids)
+            sends = {}
+            for sender_id, receiver_type, receiver_id in plan:
+                if sender_id in own:
+                    sends.setdefault(sender_id, []).append((receiver_type, receiver_id))
+            process = context.Process(target=client_process, args=(
+                address, user_ids, sends, sum(expected[user_id] for user_id in user_ids), ready, go, results,
+                args.timeout))
+            process.start()
+            processes.append(process)
+        connected = sum(ready.get() for _ in processes)
+        started_ns = time.time_ns()
+        go.set()
+        reports = [results.get() for _ in processes]
+    finally:
+        for process in processes:
+            process.join()
+        server.terminate()
+        server.wait()
+
+    accepted_s = (max(report['acked_ns'] for report in reports) - started_ns) / 1e9
+    delivered = sum(report['delivered'] for report in reports)
+    delivered_s = (max(report['last_ns'] for report in reports) - started_ns) / 1e9
+    latencies = sorted(latency for report in reports for latency in report['latencies'])
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+    print(f"{workers:>8} | {len(plan) / accepted_s:>10,.0f} | {delivered / max(delivered_s, 1e-9):>12,.0f} | "
+          f"{statistics.median(latencies) if latencies else 0:>8.1f} | {p99:>8.1f} | "
+          f"{delivered:,} из {sum(report['expected'] for report in reports):,}, клиентов {connected}, "
+          f"ошибок {sum(report['errors'] for report in reports)}", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность ретранслятора в зависимости от числа процессов")
+    parser.add_argument('--workers', default='1,2,4,8', help="числа рабочих процессов через запятую")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--client-processes', type=int, default=2)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--group-ratio', type=float, default=0.8, help="доля групповых сообщений")
+    parser.add_argument('--transport', choices=['unix', 'tcp'], default='tcp')
+    parser.add_argument('--timeout', type=float, default=60, help="сколько ждать доставки после отправки, с")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    raise_file_limit(args.clients * 2 + 100)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'app_database.db')
+        dataset.generate(path, users=args.clients, groups=args.groups, group_size=args.group_size, messages=0,
+                         seed=args.seed)
+        db.configure(path)
+        with db.read_connection() as conn:
+            members = {}
+            for group_id, user_id in conn.execute('SELECT group_id, user_id FROM group_members;'):
+                members.setdefault(group_id, []).append(user_id)
+        db.close_all()
+
+        plan, expected = make_plan(args, members)
+        print(f"ядер: {os.cpu_count()}, клиентов: {args.clients} в {args.client_processes} процессах, "
+              f"сообщений: {len(plan):,} (групповых {args.group_ratio:.0%}), доставок: {sum(expected.values()):,}")
+        print("процессов | сообщ./с   | доставок/с   | p50, мс  | p99, мс  |")
+        for workers in (int(value) for value in args.workers.split(',')):
+            run(path, tmp, workers, args, plan, expected)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import time
+import tkinter as tk
+
+from chat_view import VirtualMessageList
+from queries import message_key
+
+widget_creations = 0
+
+def count_widget_creations():
+    original_init = tk.BaseWidget.__init__
+
+    def counting_init(self, *args, **kwargs):
+        global widget_creations
+        widget_creations += 1
+        original_init(self, *args, **kwargs)
+
+    tk.BaseWidget.__init__ = counting_init
+
+class SyntheticChat:
+    # Переписка в памяти с тем же форматом строк, что и queries.load_messages_*
+
+    def __init__(self, size):
+        self.messages = [self.make_message(message_id) for message_id in range(1, size + 1)]
+
+    @staticmethod
+    def make_message(message_id):
+        return (1 + message_id % 2, f"Сообщение {message_id}", 1700000000000 + message_id * 1000, None, None, message_id)
+
+    def add(self):
+        self.messages.append(self.make_message(self.messages[-1][5] + 1))
+
+    def since(self, after_id):
+        return [message for message in self.messages if message[5] > after_id]
+
+    def before(self, before_key, limit):
+        older = [message for message in self.messages if before_key is None or message_key(message) < before_key]
+        return older[-limit:]
+
+    def ids(self, from_key):
+        return [message[5] for message in self.messages if message_key(message) >= from_key]
+
+    def last_id(self):
+        return self.messages[-1][5] if self.messages else None
+
+def render_message(container, message):
+    message_frame = tk.Frame(container)
+    message_frame.pack(pady=5, anchor='w')
+    tk.Label(message_frame, text=f"{message[2]} - Пользователь {message[0]}").pack(anchor='w')
+    tk.Label(message_frame, text=message[1], bg='lightgrey', wraplength=300).pack(anchor='w')
+    tk.Button(message_frame, text="Копировать").pack(anchor='w', pady=2)
+    return message_frame
+
+def describe_message(message):
+    return f"{message[2]} - Пользователь {message[0]}", 'w' if message[0] == 1 else 'e'
+
+def open_virtual_list(root, chat):
+    frame = tk.Frame(root, width=500, height=600)
+    frame.pack(fill="both", expand=True)
+    view = VirtualMessageList(
+        frame,
+        describe_message=describe_message,
+        on_copy=lambda text: None,
+        on_download=lambda path, name: None,
+        load_since=chat.since,
+        load_before=lambda before_key: chat.before(before_key, len(chat.messages)),
+        load_ids=chat.ids,
+        get_last_id=chat.last_id,
+        page_size=len(chat.messages),
+    )
+    root.update()
+    return frame, view
+
+def measure(name, ticks, tick):
+    global widget_creations
+    created = []
+    durations = []
+    for _ in range(ticks):
+        widget_creations = 0
+        started = time.perf_counter()
+        tick()
+        durations.append(time.perf_counter() - started)
+        created.append(widget_creations)
+    print(f"{name}: виджетов за тик {sum(created) / ticks:.1f}, "
+          f"время тика {sum(durations) / ticks * 1000:.1f} мс (макс. {max(durations) * 1000:.1f} мс)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Число создаваемых Tk-виджетов и время тика обновления чата")
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--open-messages', type=int, default=100000)
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--rebuild-ticks', type=int, default=3)
+    args = parser.parse_args()
+
+    count_widget_creations()
+    root = tk.Tk()
+    root.geometry("500x600")
+
+    chat = SyntheticChat(args.messages)
+    container = tk.Frame(root)
+    container.pack(fill="both", expand=True)
+
+    # Прежняя схема: на каждом тике все дочерние виджеты уничтожаются и создаются заново
+    def rebuild_tick():
+        for widget in container.winfo_children():
+            widget.destroy()
+        for message in chat.since(0):
+            render_message(container, message)
+        container.update_idletasks()
+
+    measure("полная перерисовка, без новых сообщений", args.rebuild_ticks, rebuild_tick)
+    container.destroy()
+
+    frame, view = open_virtual_list(root, chat)
+
+    def idle_tick():
+        view.refresh()
+        root.update()
+
+    def new_message_tick():
+        chat.add()
+        view.refresh()
+        root.update()
+
+    measure("виртуализированный список, без новых сообщений", args.ticks, idle_tick)
+    measure("виртуализированный список, одно новое сообщение", args.ticks, new_message_tick)
+
+    def scroll_tick():
+        view.canvas.yview_scroll(-1, "pages")
+        root.update()
+
+    measure("виртуализированный список, прокрутка на страницу вверх", args.ticks, scroll_tick)
+    frame.destroy()
+
+    large_chat = SyntheticChat(args.open_messages)
+    started = time.perf_counter()
+    frame, view = open_virtual_list(root, large_chat)
+    print(f"открытие переписки из {args.open_messages} сообщений: {(time.perf_counter() - started) * 1000:.0f} мс, "
+          f"строк-виджетов: {len(view.visible_rows) + len(view.free_rows)}")
+    root.destroy()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import tempfile
+import time
+
+import db
+import news
+import schema
+import stemmer
+import useful_info
+from queries import insert_message
+from search_index import SearchIndex
+
+def make_corpus(tokens):
+    # Тексты новостей и полезной информации, повторённые до нужного числа слов
+    words = []
+    for item in news.NEWS_DATA + useful_info.USEFUL_INFO_DATA:
+        words.extend(stemmer.tokenize(f"{item.get('title', '')} {item.get('content', '')}"))
+    corpus = []
+    while len(corpus) < tokens:
+        corpus.extend(words)
+    return corpus[:tokens]
+
+def report(name, tokens, elapsed):
+    print(f"{name}: {tokens / elapsed:,.0f} токенов/с ({elapsed * 1000:.0f} мс на {tokens:,} токенов)")
+
+def measure_stemmer(corpus):
+    uncached = stemmer.stem.__wrapped__
+    started = time.perf_counter()
+    for word in corpus:
+        uncached(word)
+    report("стеммер без кэша", len(corpus), time.perf_counter() - started)
+
+    stemmer.stem.cache_clear()
+    started = time.perf_counter()
+    for word in corpus:
+        stemmer.stem(word)
+    report("стеммер с кэшем, холодный старт", len(corpus), time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for word in corpus:
+        stemmer.stem(word)
+    report("стеммер с кэшем, прогретый", len(corpus), time.perf_counter() - started)
+    info = stemmer.stem.cache_info()
+    print(f"    кэш основ: {info.currsize} слов, попаданий {info.hits / (info.hits + info.misses):.1%}")
+
+def chunk(corpus, size):
+    return [' '.join(corpus[start:start + size]) for start in range(0, len(corpus), size)]
+
+def measure_memory_index(documents, tokens):
+    index = SearchIndex()
+    started = time.perf_counter()
+    for doc_id, text in enumerate(documents):
+        index.add(doc_id, text)
+    report("индекс в памяти (новости, полезная информация)", tokens, time.perf_counter() - started)
+
+def measure_sqlite_index(documents, tokens):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, 'stems.db'))
+        schema.migrate()
+        started = time.perf_counter()
+        with db.transaction() as conn:
+            for number, text in enumerate(documents):
+                insert_message(conn, 1, 2 + number % 10, text)
+        elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with db.transaction() as conn:
+            conn.execute('DROP TRIGGER messages_stems_insert;')
+            for number, text in enumerate(documents):
+                insert_message(conn, 1, 2 + number % 10, text)
+        baseline = time.perf_counter() - started
+        db.close_all()
+    report("messages_stems: основы в insert_message, индекс триггером (вставка целиком)", tokens, elapsed)
+    report("    для сравнения: вставка тех же сообщений без индекса", tokens, baseline)
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость индексации с русским стеммером, токенов в секунду")
+    parser.add_argument('--tokens', type=int, default=500000)
+    parser.add_argument('--message-words', type=int, default=20)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.tokens)
+    documents = chunk(corpus, args.message_words)
+    measure_stemmer(corpus)
+    stemmer.stem.cache_clear()
+    measure_memory_index(documents, len(corpus))
+    stemmer.stem.cache_clear()
+    measure_sqlite_index(documents, len(corpus))
+
+if __name__ == '__main__':
+    main()
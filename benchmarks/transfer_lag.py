@@ -0,0 +1,118 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import attachments
+import transfers
+
+TICK_MS = 10
+BLOCK_SIZE = 16 * 1024 * 1024
+
+def make_file(path, size_mb):
+    # Случайный блок, повторённый до нужного размера: хеш и копирование идут по всему объёму
+    block = os.urandom(BLOCK_SIZE)
+    with open(path, 'wb') as target:
+        written = 0
+        while written < size_mb * 1024 * 1024:
+            target.write(block)
+            written += len(block)
+
+def run_loop(is_finished, on_tick=None, tk_root=None):
+    # Цикл событий с таймером на каждые TICK_MS: задержка — насколько позже срока сработал тик.
+    # Без Tk это простой цикл в главном потоке, с --tk — настоящий root.after.
+    # Последний тик идёт уже после завершения работы, чтобы учесть задержку, которую она вызвала.
+    lags = []
+    deadline = [time.perf_counter() + TICK_MS / 1000]
+
+    def tick():
+        finished = is_finished()
+        now = time.perf_counter()
+        lags.append(max(now - deadline[0], 0) * 1000)
+        deadline[0] = now + TICK_MS / 1000
+        if on_tick is not None and not finished:
+            on_tick()
+        return finished
+
+    if tk_root is None:
+        while True:
+            delay = deadline[0] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if tick():
+                return lags
+
+    def tk_tick():
+        if tick():
+            tk_root.quit()
+        else:
+            tk_root.after(TICK_MS, tk_tick)
+
+    tk_root.after(TICK_MS, tk_tick)
+    tk_root.mainloop()
+    return lags
+
+def report(name, lags, elapsed, size_mb):
+    ordered = sorted(lags) or [0]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{name}: {size_mb / elapsed:,.0f} МБ/с, тиков {len(lags)}, задержка p50 {statistics.median(ordered):.1f} мс, "
+          f"p99 {p99:.1f} мс, максимум {ordered[-1]:.0f} мс")
+
+def measure_blocking(path, size_mb, tk_root):
+    # Как было: загрузка с ожиданием прямо в обработчике кнопки (core.store_attachment), цикл событий
+    # стоит до конца
+    done = []
+
+    def on_tick():
+        if not done:
+            done.append(transfers.start(path).future.result())
+
+    started = time.perf_counter()
+    lags = run_loop(lambda: bool(done), on_tick, tk_root)
+    report("копирование в обработчике", lags, time.perf_counter() - started, size_mb)
+    os.chmod(done[0].path, 0o644)
+    os.remove(done[0].path)
+
+def measure_background(path, size_mb, tk_root):
+    started = time.perf_counter()
+    transfer = transfers.start(path)
+    progress = []
+    lags = run_loop(transfer.future.done, lambda: progress.append(transfer.progress), tk_root)
+    attachment = transfer.future.result()
+    report("фоновая загрузка (transfers)", lags, time.perf_counter() - started, size_mb)
+    print(f"    обновлений прогресса: {len(progress)}")
+    os.chmod(attachment.path, 0o644)
+    os.remove(attachment.path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка цикла событий во время загрузки большого вложения")
+    parser.add_argument('--size-mb', type=int, default=2048)
+    parser.add_argument('--dir', default=None, help="каталог для тестового файла и хранилища")
+    parser.add_argument('--force-chunked', action='store_true', help="без copy_file_range/sendfile и reflink")
+    parser.add_argument('--tk', action='store_true', help="мерить настоящий mainloop Tk (нужен дисплей)")
+    args = parser.parse_args()
+
+    if args.force_chunked:
+        def unsupported(source_fd, target_fd, offset, count):
+            raise attachments._Unsupported(offset)
+
+        attachments._copy_file_range = attachments._sendfile = unsupported
+        attachments._reflink = lambda source, target_path: False
+
+    tk_root = None
+    if args.tk:
+        import tkinter as tk
+        tk_root = tk.Tk()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        os.chdir(tmp)
+        make_file('source.bin', args.size_mb)
+        # Каждый замер начинается с непрогретого кэша хешей: иначе второй просто найдёт блоб
+        measure_blocking('source.bin', args.size_mb, tk_root)
+        attachments._hash_cache.clear()
+        measure_background('source.bin', args.size_mb, tk_root)
+    transfers.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import random
+import time
+
+import relay
+import wire
+from benchmarks import dataset
+
+READ_SIZE = 64 * 1024
+
+# Синхронизация истории в 10 000 сообщений: строки JSON (relay.encode_message) против кадров BATCH
+# из wire.py. Замеряются размер, кодирование и разбор на приёмной стороне, куда данные приходят
+# кусками по READ_SIZE, как из сокета. Для JSON приёмник режет буфер по строкам и вызывает json.loads,
+# для wire — FrameReader и decode_rows по memoryview.
+
+def make_history(count, seed):
+    # Одна переписка двух пользователей: id подряд, время растёт на секунды-минуты
+    rng = random.Random(seed)
+    rows = []
+    ts_ms = dataset.START_MS
+    for number in range(count):
+        ts_ms += rng.randint(500, 120_000)
+        sender_id, receiver_id = (17, 4242) if rng.random() < 0.5 else (4242, 17)
+        file_name = rng.choice(dataset.FILE_NAMES) if rng.random() < 0.05 else None
+        rows.append((100_000 + number, sender_id, receiver_id, 'user', ts_ms, dataset.make_text(rng), file_name))
+    return rows
+
+def encode_json(rows):
+    return b''.join(relay.encode_message(row) for row in rows)
+
+def decode_json(chunks):
+    rows = []
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            message = json.loads(line)
+            rows.append((message['id'], message['sender_id'], message['receiver_id'], message['receiver_type'],
+                         message['ts_ms'], message['content'], message['file_name']))
+    return rows
+
+def encode_wire(rows, batch_rows):
+    return b''.join(wire.encode_batch(rows[start:start + batch_rows]) for start in range(0, len(rows), batch_rows))
+
+def decode_wire(chunks):
+    rows = []
+    frames = wire.FrameReader()
+    for chunk in chunks:
+        frames.feed(chunk)
+        for frame_type, payload in frames.frames():
+            rows.extend(wire.decode_rows(frame_type, payload))
+    return rows
+
+def best_of(repeats, fn, *args):
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Кодек wire против строк JSON на синхронизации истории")
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--batch-rows', type=int, default=wire.BATCH_MAX_ROWS)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rows = make_history(args.messages, args.seed)
+    codecs = [
+        ("строки JSON", lambda: encode_json(rows), decode_json),
+        (f"wire, BATCH по {args.batch_rows}", lambda: encode_wire(rows, args.batch_rows), decode_wire),
+    ]
+    for name, encode, decode in codecs:
+        data, encode_ms = best_of(args.repeats, encode)
+        chunks = [data[start:start + READ_SIZE] for start in range(0, len(data), READ_SIZE)]
+        decoded, decode_ms = best_of(args.repeats, decode, chunks)
+        assert decoded == rows, name
+        print(f"{name}: {len(data) / 1024:,.0f} КБ ({len(data) / len(rows):.1f} байт на сообщение), "
+              f"кодирование {encode_ms:.1f} мс, разбор {decode_ms:.1f} мс")
+
+if __name__ == '__main__':
+    main()
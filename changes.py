@@ -0,0 +1,85 @@
+import itertools
+import sqlite3
+import traceback
+
+import db
+
+MIN_INTERVAL_MS = 100
+MAX_INTERVAL_MS = 3000
+BACKOFF_FACTOR = 2
+
+# Общая служба обнаружения изменений. PRAGMA data_version меняется, когда базу зафиксировало
+# любое другое соединение (в том числе из другого процесса); проверка не читает таблиц.
+# Подписчики вызываются только после реальных изменений, а пока база не меняется,
+# интервал проверки растёт от MIN_INTERVAL_MS до MAX_INTERVAL_MS.
+_root = None
+_conn = None
+_version = None
+_interval = MIN_INTERVAL_MS
+_after_id = None
+_subscribers = {}
+_tokens = itertools.count(1)
+
+def install(root):
+    global _root
+    _root = root
+
+def subscribe(callback):
+    token = next(_tokens)
+    _subscribers[token] = callback
+    if _after_id is None:
+        _schedule(MIN_INTERVAL_MS)
+    return token
+
+def unsubscribe(token):
+    global _after_id
+    _subscribers.pop(token, None)
+    if not _subscribers and _after_id is not None:
+        _root.after_cancel(_after_id)
+        _after_id = None
+
+def poke():
+    # Ожидается скорое изменение (например, пользователь только что отправил сообщение): проверять чаще
+    global _interval
+    _interval = MIN_INTERVAL_MS
+    if _after_id is not None:
+        _root.after_cancel(_after_id)
+        _schedule(MIN_INTERVAL_MS)
+
+def _schedule(delay):
+    global _after_id
+    _after_id = _root.after(int(delay), _tick)
+
+def _read_version():
+    global _conn
+    for _ in range(2):
+        if _conn is None:
+            # Отдельное соединение: свои же фиксации data_version на соединении не меняют
+            _conn = db.dedicated_connection()
+        try:
+            return _conn.execute('PRAGMA data_version;').fetchone()[0]
+        except sqlite3.ProgrammingError:
+            # Соединение закрыто через db.close_all — открываем заново
+            _conn = None
+    return None
+
+def _tick():
+    global _version, _interval, _after_id
+    _after_id = None
+    try:
+        version = _read_version()
+    except sqlite3.Error:
+        traceback.print_exc()
+        version = _version
+    if version != _version:
+        _version = version
+        _interval = MIN_INTERVAL_MS
+        for callback in list(_subscribers.values()):
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+    else:
+        _interval = min(_interval * BACKOFF_FACTOR, MAX_INTERVAL_MS)
+    if _subscribers:
+        _schedule(_interval)
@@ -0,0 +1,487 @@
+import bisect
+import heapq
+import tkinter as tk
+
+import images
+import tasks
+from attachments import display_name
+from queries import MESSAGE_PAGE_SIZE, message_key
+
+ESTIMATED_ROW_HEIGHT = 70
+ROW_PADDING = 10
+OVERSCAN_ROWS = 5
+
+class MessageRow:
+    # Переиспользуемая строка списка: один набор виджетов, который перепривязывается к разным сообщениям
+
+    def __init__(self, canvas, on_copy, on_download, on_preview):
+        self.canvas = canvas
+        self.message = None
+        self.on_preview = on_preview
+        self.frame = tk.Frame(canvas)
+        self.header_label = tk.Label(self.frame)
+        self.content_label = tk.Label(self.frame, bg='lightgrey', wraplength=300, justify='left')
+        self.image_label = tk.Label(self.frame)
+        self.copy_button = tk.Button(self.frame, text="Копировать", command=lambda: on_copy(self.message[1]))
+        self.file_button = tk.Button(self.frame, command=lambda: on_download(self.message[3], display_name(self.message)))
+        self.item = canvas.create_window(0, 0, window=self.frame, anchor='nw', state='hidden')
+
+    def bind(self, message, header, file_name):
+        self.message = message
+        for widget in (self.header_label, self.image_label, self.content_label, self.copy_button, self.file_button):
+            widget.pack_forget()
+
+        self.header_label.config(text=header)
+        self.header_label.pack(anchor='w')
+        if message[4]:
+            # Превью берётся только из кэша; если его там нет, строка перерисуется, когда оно будет готово
+            message_id = message[5]
+            preview = images.get_preview(message[4], lambda: self.on_preview(message_id))
+            if preview is not None:
+                self.image_label.config(image=preview, text='')
+                self.image_label.pack(anchor='w')
+        if message[1]:
+            self.content_label.config(text=message[1])
+            self.content_label.pack(anchor='w')
+            self.copy_button.pack(anchor='w', pady=2)
+        if message[3]:
+            self.file_button.config(text=f"Скачать файл: {file_name}")
+            self.file_button.pack(anchor='w')
+
+    def place(self, x, y, anchor):
+        self.canvas.coords(self.item, x, y)
+        self.canvas.itemconfigure(self.item, anchor=anchor, state='normal')
+
+    def hide(self):
+        self.canvas.itemconfigure(self.item, state='hidden')
+        self.message = None
+
+class VirtualMessageList:
+    # Виртуализированный список сообщений: виджеты существуют только для строк в области видимости
+    # (плюс небольшой запас) и переиспользуются при прокрутке. Позиции строк берутся из кэша высот
+    # по id сообщения; ещё не измеренные строки занимают оценочную высоту.
+    # Запросы к базе выполняются через submit (по умолчанию синхронно, в приложении — tasks.submit),
+    # сам список меняется только в колбэках на потоке Tk.
+    # Отправляемые сообщения показываются сразу, с временным отрицательным id, и всегда стоят в конце
+    # списка; строка заменяется настоящим сообщением, когда оно приходит из базы.
+    # Сообщения стоят по (время, id) — queries.message_key; first_key — ключ первого загруженного,
+    # по нему подгружается история. last_id — отметка записи: всё с большим id ещё не получено. Новое
+    # по id сообщение не обязательно новое по времени (синхронизация, другой процесс ретранслятора),
+    # поэтому оно встаёт на своё место, а не в конец.
+
+    def __init__(self, parent, describe_message, on_copy, on_download, load_since, load_before,
+                 load_ids=None, get_last_id=None, page_size=MESSAGE_PAGE_SIZE, submit=tasks.run_inline,
+                 on_error=None, on_messages=None):
+        self.describe_message = describe_message
+        self.on_copy = on_copy
+        self.on_download = on_download
+        self.load_since = load_since
+        self.load_before = load_before
+        self.load_ids = load_ids
+        self.get_last_id = get_last_id
+        self.page_size = page_size
+        self.submit = submit
+        self.on_error = on_error
+        self.on_messages = on_messages
+
+        self.canvas = tk.Canvas(parent, highlightthickness=0)
+        self.scrollbar = tk.Scrollbar(parent, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self.on_scroll)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.messages = []
+        self.offsets = [0]
+        self.dirty_from = None
+        self.height_cache = {}
+        self.visible_rows = {}
+        self.free_rows = []
+        self.first_key = None
+        self.last_id = 0
+        self.has_more = True
+        self.opened = False
+        self.loading = False
+        self.refreshing = False
+        self.refresh_again = False
+        self.laying_out = False
+        self.pending_count = 0
+        self.next_pending_id = -1
+        self.confirmed = {}
+        self.scheduled = set()
+
+        self.canvas.bind("<Configure>", lambda event: self.layout())
+        self.canvas.bind("<Enter>", lambda event: self.bind_mouse_wheel())
+        self.canvas.bind("<Leave>", lambda event: self.unbind_mouse_wheel())
+        self.canvas.bind("<Destroy>", lambda event: self.cancel_scheduled())
+
+        self.load_first_page()
+
+    def load_first_page(self):
+        self.loading = True
+        self.submit(self.load_before, None, on_done=self.show_first_page, on_error=self.report_error)
+
+    def is_alive(self):
+        return bool(self.canvas.winfo_exists())
+
+    def after_idle(self, callback):
+        # Отложенные вызовы запоминаются, чтобы отменить их при закрытии окна
+        def run():
+            self.scheduled.discard(after_id)
+            callback()
+
+        after_id = self.canvas.after_idle(run)
+        self.scheduled.add(after_id)
+
+    def cancel_scheduled(self):
+        for after_id in self.scheduled:
+            self.canvas.after_cancel(after_id)
+        self.scheduled.clear()
+
+    def report_error(self, error):
+        self.loading = False
+        self.refreshing = False
+        if self.on_error is not None and self.is_alive():
+            self.on_error(error)
+
+    def show_first_page(self, messages):
+        self.loading = False
+        if not self.is_alive():
+            return
+        self.opened = True
+        self.has_more = len(messages) >= self.page_size
+        self.insert([message for message in messages if message[5] > self.last_id])
+        self.after_idle(self.scroll_to_bottom)
+        self.refresh_if_requested()
+
+    def row_height(self, message):
+        return self.height_cache.get(message[5], ESTIMATED_ROW_HEIGHT)
+
+    def ensure_offsets(self):
+        if self.dirty_from is None:
+            return
+        start = self.dirty_from
+        del self.offsets[start + 1:]
+        position = self.offsets[start]
+        for message in self.messages[start:]:
+            position += self.row_height(message)
+            self.offsets.append(position)
+        self.dirty_from = None
+
+    def mark_dirty(self, index):
+        if self.dirty_from is None or index < self.dirty_from:
+            self.dirty_from = index
+
+    def total_height(self):
+        self.ensure_offsets()
+        return self.offsets[-1]
+
+    def insert(self, messages):
+        # Сообщения с id больше last_id. Раньше первого загруженного пропускаются, пока история
+        # загружена не вся: они придут со страницей show_older
+        if not messages:
+            return
+        self.last_id = max(self.last_id, max(message[5] for message in messages))
+        messages = sorted(messages, key=message_key)
+        if self.has_more and self.first_key is not None:
+            messages = [message for message in messages if message_key(message) > self.first_key]
+            if not messages:
+                return
+        loaded = len(self.messages) - self.pending_count
+        if loaded and message_key(messages[0]) < message_key(self.messages[loaded - 1]):
+            self.merge(messages, loaded)
+        elif self.pending_count:
+            # Новые сообщения из базы встают перед ещё не подтверждёнными отправленными
+            self.messages[loaded:loaded] = messages
+            self.mark_dirty(loaded)
+        else:
+            self.ensure_offsets()
+            position = self.offsets[-1]
+            for message in messages:
+                position += self.row_height(message)
+                self.offsets.append(position)
+            self.messages.extend(messages)
+        self.first_key = message_key(self.messages[0])
+        self.update_scrollregion()
+
+    def merge(self, messages, loaded):
+        # Вставка внутрь загруженной истории: верхняя видимая строка остаётся на том же месте экрана
+        self.ensure_offsets()
+        top = self.canvas.canvasy(0)
+        anchor = min(max(bisect.bisect_right(self.offsets, top) - 1, 0), loaded - 1)
+        anchor_id = self.messages[anchor][5]
+        shift = top - self.offsets[anchor]
+        merged = list(heapq.merge(self.messages[:loaded], messages, key=message_key))
+        changed = next(index for index, (old, new) in enumerate(zip(self.messages, merged)) if old is not new)
+        self.messages[:loaded] = merged
+        self.mark_dirty(changed)
+        anchor = next(index for index in range(anchor, len(merged)) if merged[index][5] == anchor_id)
+        self.update_scrollregion()
+        total = self.total_height()
+        if total:
+            self.canvas.yview_moveto((self.offsets[anchor] + shift) / total)
+
+    def prepend(self, messages):
+        if not messages:
+            return
+        added_height = sum(self.row_height(message) for message in messages)
+        top = self.canvas.canvasy(0)
+        self.messages[:0] = messages
+        self.mark_dirty(0)
+        self.first_key = message_key(messages[0])
+        if not self.last_id:
+            self.last_id = max(message[5] for message in messages)
+        # Сохраняем положение прокрутки: добавленная сверху история не должна сдвигать видимые сообщения
+        self.update_scrollregion()
+        total = self.total_height()
+        if total:
+            self.canvas.yview_moveto((top + added_height) / total)
+        self.layout()
+
+    def remove(self, message_ids):
+        removed = set(message_ids)
+        if not removed:
+            return
+        self.messages = [message for message in self.messages if message[5] not in removed]
+        for message_id in removed:
+            self.height_cache.pop(message_id, None)
+            row = self.visible_rows.pop(message_id, None)
+            if row is not None:
+                row.hide()
+                self.free_rows.append(row)
+        self.mark_dirty(0)
+        self.pending_count = sum(1 for message in self.messages if message[5] < 0)
+        # last_id не трогаем: его опускает только apply_updates, когда удалены последние записанные
+        loaded = self.messages[:len(self.messages) - self.pending_count]
+        self.first_key = message_key(loaded[0]) if loaded else None
+        self.update_scrollregion()
+        self.layout()
+
+    def refresh(self, on_done=None):
+        # Не более одного обновления в полёте: следующий тик пропускается, пока не пришёл ответ
+        if self.refreshing:
+            self.refresh_again = self.refresh_again or bool(self.confirmed)
+            return
+        if self.loading:
+            return
+        if not self.opened:
+            self.load_first_page()
+            return
+        self.refreshing = True
+
+        def done(updates):
+            self.refreshing = False
+            if not self.is_alive():
+                return
+            messages = self.apply_updates(updates)
+            if on_done is not None:
+                on_done(messages)
+            self.refresh_if_requested()
+
+        self.submit(self.fetch_updates, self.first_key, self.last_id, on_done=done, on_error=self.report_error)
+
+    def refresh_if_requested(self):
+        # Пока шёл запрос, пришло пакетное обновление или подтвердилась отправка — их сообщения
+        # могли не попасть в этот ответ
+        if self.refresh_again:
+            self.refresh_again = False
+            self.refresh()
+
+    def receive(self, messages, newest_id):
+        # Обновление из общего пакетного запроса (windows.py): новые сообщения этой переписки
+        # и её последний id в базе. Свой запрос нужен, только если часть показанных сообщений удалена,
+        # пакет не довёз всё до последнего id, или список ещё не открыт/обновляется.
+        deleted = self.last_id and (newest_id is None or newest_id < self.last_id)
+        received_id = max([message[5] for message in messages] + [self.last_id])
+        missing = newest_id is not None and newest_id > received_id
+        if self.refreshing or self.loading:
+            self.refresh_again = True
+        elif not self.opened or deleted or missing:
+            self.refresh()
+        else:
+            self.apply_updates((None, self.last_id, messages))
+
+    def fetch_updates(self, first_key, last_id):
+        # Выполняется в рабочем потоке: только запросы, без обращения к виджетам.
+        # Дешёвая проверка: последний id переписки в базе меньше отметки, значит часть
+        # сообщений удалена. Только тогда сверяем список id загруженного диапазона, а отметка
+        # опускается до последнего id в базе: SQLite может снова выдать освободившиеся id.
+        existing_ids = None
+        since_id = last_id
+        if last_id and self.get_last_id is not None and self.load_ids is not None:
+            newest_id = self.get_last_id()
+            if newest_id is None:
+                existing_ids, since_id = set(), 0
+            elif newest_id < last_id:
+                existing_ids = set(self.load_ids(first_key)) if first_key is not None else set()
+                since_id = newest_id
+        return existing_ids, since_id, self.load_since(since_id)
+
+    def apply_updates(self, updates):
+        existing_ids, since_id, messages = updates
+        if existing_ids is not None:
+            self.remove([message[5] for message in self.messages if message[5] > 0 and message[5] not in existing_ids])
+            self.last_id = since_id
+        messages = [message for message in messages if message[5] > self.last_id]
+        self.remove([self.confirmed.pop(message[5]) for message in messages if message[5] in self.confirmed])
+        if messages:
+            at_bottom = self.is_at_bottom()
+            self.insert(messages)
+            if at_bottom:
+                self.scroll_to_bottom()
+            else:
+                self.layout()
+            if self.on_messages is not None:
+                self.on_messages(messages)
+        return messages
+
+    def add_pending(self, message):
+        # message — кортеж сообщения без id; возвращает временный id для confirm_pending/fail_pending
+        pending_id = self.next_pending_id
+        self.next_pending_id -= 1
+        self.messages.append(message[:5] + (pending_id,) + message[5:])
+        self.pending_count += 1
+        self.mark_dirty(len(self.messages) - 1)
+        self.scroll_to_bottom()
+        return pending_id
+
+    def confirm_pending(self, pending_id, message_id):
+        if not self.is_alive():
+            return
+        if message_id <= self.last_id:
+            # Обновление успело загрузить сообщение раньше подтверждения
+            self.remove([pending_id])
+            return
+        self.confirmed[message_id] = pending_id
+        self.refresh()
+
+    def fail_pending(self, pending_id, status):
+        # Неотправленное сообщение остаётся в списке, в заголовке вместо времени — причина ошибки
+        if not self.is_alive():
+            return
+        for index, message in enumerate(self.messages):
+            if message[5] == pending_id:
+                self.messages[index] = message[:2] + (status,) + message[3:]
+                break
+        else:
+            return
+        self.remeasure(index, pending_id)
+
+    def preview_ready(self, message_id):
+        # Превью изображения появилось в кэше: строку нужно перепривязать и заново измерить
+        if not self.is_alive():
+            return
+        for index, message in enumerate(self.messages):
+            if message[5] == message_id:
+                break
+        else:
+            return
+        self.remeasure(index, message_id)
+
+    def remeasure(self, index, message_id):
+        # Строка изменилась: она будет заново привязана и измерена при раскладке
+        self.height_cache.pop(message_id, None)
+        row = self.visible_rows.pop(message_id, None)
+        if row is not None:
+            row.hide()
+            self.free_rows.append(row)
+        self.mark_dirty(index)
+        self.update_scrollregion()
+        self.layout()
+
+    def show_older(self):
+        if not self.has_more:
+            self.loading = False
+            return
+        self.submit(self.load_before, self.first_key, on_done=self.show_older_page, on_error=self.report_error)
+
+    def show_older_page(self, messages):
+        self.loading = False
+        if not self.is_alive():
+            return
+        self.has_more = len(messages) >= self.page_size
+        if self.first_key is not None:
+            messages = [message for message in messages if message_key(message) < self.first_key]
+        self.prepend(messages)
+        self.refresh_if_requested()
+
+    def is_at_bottom(self):
+        return self.canvas.canvasy(0) + self.canvas.winfo_height() >= self.total_height() - 1
+
+    def scroll_to_bottom(self):
+        self.update_scrollregion()
+        self.canvas.yview_moveto(1.0)
+        self.layout()
+
+    def update_scrollregion(self):
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), self.total_height()))
+
+    def layout(self):
+        if self.laying_out:
+            return
+        self.laying_out = True
+        try:
+            measured = self.place_visible_rows()
+            if measured:
+                # Строки, впервые показанные на экране, измерены: позиции ниже них пересчитываются,
+                # а строки расставляются ещё раз уже по точным высотам
+                self.update_scrollregion()
+                self.place_visible_rows()
+        finally:
+            self.laying_out = False
+
+    def place_visible_rows(self):
+        self.ensure_offsets()
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(bisect.bisect_right(self.offsets, top) - 1 - OVERSCAN_ROWS, 0)
+        last = min(bisect.bisect_left(self.offsets, bottom) + OVERSCAN_ROWS, len(self.messages))
+        wanted = {self.messages[index][5]: index for index in range(first, last)}
+
+        for message_id in list(self.visible_rows):
+            if message_id not in wanted:
+                row = self.visible_rows.pop(message_id)
+                row.hide()
+                self.free_rows.append(row)
+
+        width = self.canvas.winfo_width()
+        unmeasured = []
+        for message_id, index in wanted.items():
+            message = self.messages[index]
+            header, align = self.describe_message(message)
+            row = self.visible_rows.get(message_id)
+            if row is None:
+                row = self.free_rows.pop() if self.free_rows else MessageRow(self.canvas, self.on_copy, self.on_download, self.preview_ready)
+                row.bind(message, header, display_name(message))
+                self.visible_rows[message_id] = row
+                if message_id not in self.height_cache:
+                    unmeasured.append((index, row))
+            if align == 'e':
+                row.place(width, self.offsets[index] + ROW_PADDING // 2, 'ne')
+            else:
+                row.place(0, self.offsets[index] + ROW_PADDING // 2, 'nw')
+
+        if not unmeasured:
+            return False
+        self.canvas.update_idletasks()
+        for index, row in unmeasured:
+            height = row.frame.winfo_reqheight() + ROW_PADDING
+            self.height_cache[row.message[5]] = height
+            if height != ESTIMATED_ROW_HEIGHT:
+                self.mark_dirty(index)
+        return self.dirty_from is not None
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.layout()
+        if float(first) <= 0.0 and float(last) < 1.0 and self.has_more and not self.loading:
+            self.loading = True
+            self.after_idle(self.show_older)
+
+    def bind_mouse_wheel(self):
+        self.canvas.bind_all("<MouseWheel>", lambda event: self.canvas.yview_scroll(-1 if event.delta > 0 else 1, "units"))
+        self.canvas.bind_all("<Button-4>", lambda event: self.canvas.yview_scroll(-1, "units"))
+        self.canvas.bind_all("<Button-5>", lambda event: self.canvas.yview_scroll(1, "units"))
+
+    def unbind_mouse_wheel(self):
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.canvas.unbind_all(sequence)
@@ -0,0 +1,36 @@
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+
+FORMAT_CACHE_SIZE = 4096
+DISPLAY_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Время сообщений — целые миллисекунды от эпохи (messages.ts_ms). Гибридные логические часы:
+# метка не меньше системного времени и строго больше предыдущей выданной этим процессом, поэтому
+# сообщения, отправленные в одну миллисекунду или после перевода часов назад, не меняются местами.
+# observe() учитывает чужие метки (например, пришедшие при синхронизации).
+_last = 0
+_lock = threading.Lock()
+
+def now_ms():
+    global _last
+    with _lock:
+        _last = max(int(time.time() * 1000), _last + 1)
+        return _last
+
+def observe(ts_ms):
+    global _last
+    with _lock:
+        _last = max(_last, ts_ms)
+
+def format_ms(ts_ms):
+    # Строки статуса ("Отправка...", текст ошибки) в поле времени показываются как есть
+    if not isinstance(ts_ms, int):
+        return ts_ms
+    return _format_second(ts_ms // 1000)
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def _format_second(seconds):
+    # Сообщения одной переписки обычно приходят пачками в пределах секунд — формат считается один раз
+    return datetime.fromtimestamp(seconds).strftime(DISPLAY_FORMAT)
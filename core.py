@@ -0,0 +1,225 @@
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+import attachment_gc
+import attachments
+import db
+import outbox
+import queries
+import schema
+import transfers
+from queries import (
+    get_last_group_message_id, get_last_message_id, load_group_message_ids, load_message_ids, mark_chat_read,
+)
+
+SESSION_PATH = 'current_user.txt'
+
+# Ядро мессенджера без интерфейса: пользователи, сессия, сообщения, группы, вложения.
+# Не импортирует tkinter и ничего не показывает — ошибки предметной области приходят исключениями
+# CoreError (их текст можно показать пользователю как есть), ошибки базы — sqlite3.Error.
+# Строки возвращаются именованными кортежами: это те же кортежи, что отдаёт queries
+# (окна и VirtualMessageList обращаются к ним по индексам), только с именами полей.
+# Функции блокирующие; окно вызывает их через tasks.submit, сервер и скрипты — напрямую.
+
+User = namedtuple('User', 'id username')
+Group = namedtuple('Group', 'id name')
+Message = namedtuple('Message', 'sender_id content ts_ms file_path image_path id file_name')
+ChatSummary = namedtuple('ChatSummary', 'peer_id username last_ts_ms last_preview unread_count')
+SearchResult = namedtuple('SearchResult', 'id sender_id receiver_id receiver_type ts_ms snippet rank')
+
+class CoreError(Exception):
+    pass
+
+class InvalidInput(CoreError):
+    pass
+
+class UsernameTaken(CoreError):
+    pass
+
+class InvalidCredentials(CoreError):
+    pass
+
+class UserNotFound(CoreError):
+    pass
+
+class AlreadyMember(CoreError):
+    pass
+
+class AttachmentNotFound(CoreError):
+    pass
+
+def start(path=None):
+    # Открыть базу (path — другой файл вместо app_database.db) и довести схему до актуальной.
+    # Время, ключ переписки и основы слов старых сообщений дозаполняются в фоновых потоках, не задерживая старт
+    if path is not None:
+        db.configure(path)
+    schema.migrate()
+    threading.Thread(target=schema.backfill_conversation_key, name='backfill-keys', daemon=True).start()
+    threading.Thread(target=schema.backfill_message_clock, name='backfill', daemon=True).start()
+    threading.Thread(target=schema.backfill_message_stems, name='backfill-stems', daemon=True).start()
+
+def shutdown():
+    transfers.shutdown()
+    outbox.shutdown()
+    db.close_all()
+
+# Пользователи и сессия
+
+def register(username, password):
+    username, password = username.strip(), password.strip()
+    if not username or not password:
+        raise InvalidInput("Логин или пароль нельзя оставить пустыми.")
+    try:
+        user_id = queries.create_user(username, password)
+    except sqlite3.IntegrityError:
+        raise UsernameTaken("Имя пользователя уже существует.") from None
+    return User(user_id, username)
+
+def login(username, password):
+    user_id = queries.authenticate_user(username, password)
+    if not user_id:
+        raise InvalidCredentials("Неверное имя пользователя или пароль.")
+    return User(user_id, username)
+
+def find_user(identifier):
+    # identifier — id (строкой из цифр) или имя пользователя
+    user = queries.find_user(identifier.strip())
+    if user is None:
+        raise UserNotFound("Пользователь не найден.")
+    return User._make(user)
+
+def get_user(user_id):
+    user = queries.get_user_by_id(user_id)
+    if user is None:
+        raise UserNotFound("Пользователь не найден.")
+    return User._make(user)
+
+def update_user(user_id, username=None, password=None):
+    username = username.strip() if username else None
+    password = password.strip() if password else None
+    if not username and not password:
+        raise InvalidInput("Вы не ввели ни логин, ни пароль.")
+    try:
+        queries.update_user(user_id, username, password)
+    except sqlite3.IntegrityError:
+        raise UsernameTaken("Имя пользователя уже существует.") from None
+    return get_user(user_id)
+
+def save_session(user):
+    with open(SESSION_PATH, 'w') as f:
+        f.write(f"{user.id},{user.username}")
+
+def load_session():
+    # Пользователь, вошедший в прошлый раз, или None
+    if not os.path.exists(SESSION_PATH):
+        return None
+    with open(SESSION_PATH, 'r') as f:
+        try:
+            user_id, username = f.read().split(',')
+            return User(int(user_id), username)
+        except ValueError:
+            return None
+
+def clear_session():
+    if os.path.exists(SESSION_PATH):
+        os.remove(SESSION_PATH)
+
+# Сообщения
+
+def send_message(sender_id, receiver_id, content, attachment=None, receiver_type='user', file_path=None,
+                 image_path=None):
+    # Ставит сообщение в очередь отправки и возвращает Future с id записанного сообщения.
+    # attachment — уже сохранённое вложение (attachments.Attachment, см. start_upload)
+    if not (content or attachment or file_path or image_path):
+        raise InvalidInput("Пустое сообщение.")
+    if attachment is not None and image_path is None and attachments.is_image(attachment.name):
+        image_path = attachment.path
+    return outbox.send_message(sender_id, receiver_id, content, file_path, image_path, receiver_type, attachment)
+
+def send_group_message(sender_id, group_id, content, attachment=None, file_path=None, image_path=None):
+    return send_message(sender_id, group_id, content, attachment, 'group', file_path, image_path)
+
+def _messages(rows):
+    return [Message._make(row) for row in rows]
+
+def load_inbox(user_id):
+    return _messages(queries.load_messages(user_id))
+
+def load_messages(user_id, peer_id):
+    return _messages(queries.load_messages(user_id, peer_id))
+
+def load_messages_since(user_id, peer_id, after_id=0):
+    return _messages(queries.load_messages_since(user_id, peer_id, after_id))
+
+def load_messages_before(user_id, peer_id, before_key=None, limit=queries.MESSAGE_PAGE_SIZE):
+    # Страница истории до before_key = (ts_ms, id) сообщения, по умолчанию — последняя
+    return _messages(queries.load_messages_before(user_id, peer_id, before_key, limit))
+
+def load_group_messages(group_id):
+    return _messages(queries.load_group_messages(group_id))
+
+def load_group_messages_since(group_id, after_id=0):
+    return _messages(queries.load_group_messages_since(group_id, after_id))
+
+def load_group_messages_before(group_id, before_key=None, limit=queries.MESSAGE_PAGE_SIZE):
+    return _messages(queries.load_group_messages_before(group_id, before_key, limit))
+
+def get_chat_list(user_id):
+    return [ChatSummary._make(row) for row in queries.get_chat_list(user_id)]
+
+def delete_chat(user_id, peer_id):
+    # Переписка удаляется у обоих собеседников; освободившиеся вложения уберёт attachment_gc
+    queries.delete_chat_messages(user_id, peer_id)
+    attachment_gc.request()
+
+def search_messages(user_id, text, cursor=None, limit=queries.SEARCH_PAGE_SIZE):
+    # (результаты, курсор следующей страницы или None)
+    rows, next_cursor = queries.search_messages(user_id, text, cursor, limit)
+    return [SearchResult._make(row) for row in rows], next_cursor
+
+# Группы
+
+def create_group(name, member_ids):
+    # member_ids — участники вместе с создателем; повторы не мешают
+    name = name.strip()
+    if not name or not member_ids:
+        raise InvalidInput("Название группы или участники не указаны.")
+    member_ids = list(dict.fromkeys(member_ids))
+    return Group(queries.create_group(name, member_ids), name)
+
+def add_member(group_id, user_id):
+    get_user(user_id)
+    try:
+        queries.add_group_member(group_id, user_id)
+    except sqlite3.IntegrityError:
+        raise AlreadyMember("Пользователь уже состоит в группе.") from None
+
+def leave_group(group_id, user_id):
+    # Когда выходит последний участник, группа удаляется вместе с сообщениями
+    queries.leave_group(group_id, user_id)
+    attachment_gc.request()
+
+def get_user_groups(user_id):
+    return [Group._make(row) for row in queries.get_user_groups(user_id)]
+
+def get_group_members(group_id):
+    return [User._make(row) for row in queries.get_group_members(group_id)]
+
+# Вложения
+
+def start_upload(path):
+    # Копирование файла в хранилище в фоне: transfers.Transfer, его future даёт Attachment
+    if not os.path.isfile(path):
+        raise AttachmentNotFound("Файл не найден.")
+    return transfers.start(path)
+
+def store_attachment(path):
+    # То же, что start_upload, но с ожиданием: для скриптов и сервера, где не нужен прогресс
+    return start_upload(path).future.result()
+
+def export_attachment(path, target_path):
+    if not os.path.exists(path):
+        raise AttachmentNotFound("Файл не найден.")
+    attachments.export_file(path, target_path)
@@ -0,0 +1,101 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+DB_PATH = 'app_database.db'
+READ_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+BUSY_TIMEOUT_MS = 5000
+SYNCHRONOUS = 'NORMAL'
+
+_local = threading.local()
+_read_pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+def _open_connection(path=None):
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
+    conn.execute('PRAGMA journal_mode = WAL;')
+    conn.execute(f'PRAGMA synchronous = {SYNCHRONOUS};')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};')
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+def get_connection():
+    # Одно долгоживущее соединение на поток: и для записи, и для чтения внутри транзакций
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'generation', None) != _generation:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.generation = _generation
+    return conn
+
+def dedicated_connection(path=None):
+    # Соединение вне пула и вне потоков (path — другой файл базы); закрывается вместе с остальными
+    # в close_all или раньше — close_connection
+    return _open_connection(path)
+
+def close_connection(conn):
+    _close(conn)
+
+@contextmanager
+def transaction():
+    conn = get_connection()
+    with conn:
+        yield conn
+
+@contextmanager
+def read_connection():
+    generation = _generation
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection()
+    try:
+        yield conn
+    finally:
+        _release(conn, generation)
+
+def _release(conn, generation):
+    if generation != _generation:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _read_pool.put_nowait(conn)
+    except queue.Full:
+        _close(conn)
+
+def _close(conn):
+    with _connections_lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    conn.close()
+
+def close_all():
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        conn.close()
+    while True:
+        try:
+            _read_pool.get_nowait()
+        except queue.Empty:
+            break
+
+def configure(path):
+    global DB_PATH
+    close_all()
+    DB_PATH = path
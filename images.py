@@ -0,0 +1,101 @@
+import base64
+import multiprocessing
+import os
+import tkinter as tk
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import attachments
+import tasks
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+THUMB_SIZE = 240
+IMAGE_WORKERS = 2
+PREVIEW_CACHE_SIZE = 100
+
+# Превью изображений. Полноразмерная картинка декодируется и уменьшается только в пуле процессов
+# (Pillow), уменьшенная копия в PNG кладётся в files/thumbs под хешем содержимого, а на потоке Tk
+# из неё делается PhotoImage. Готовые PhotoImage живут в ограниченном LRU: прокрутка назад
+# по переписке с картинками не обращается ни к диску, ни к пулу.
+# Без Pillow превью нет, изображения показываются как обычные файлы.
+_pool = None
+_previews = OrderedDict()
+_waiting = {}
+_failed = set()
+
+def available():
+    return Image is not None
+
+def thumbnail_path(file_hash, size=THUMB_SIZE):
+    return os.path.join(attachments.THUMBS_DIR, file_hash[:2], f"{file_hash}-{size}.png")
+
+def install():
+    # Процессы пула создаются fork'ом сразу, пока в приложении ещё нет других потоков;
+    # где fork нет, уменьшение идёт в потоках — всё равно не на потоке Tk
+    global _pool
+    if not available() or _pool is not None:
+        return
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        _pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='images')
+        return
+    _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=context)
+    _pool.submit(os.getpid).result()
+
+def render_thumbnail(image_path, thumb_path, size):
+    # Выполняется в процессе пула: возвращает PNG превью в base64 (так его принимает PhotoImage)
+    if not os.path.exists(thumb_path):
+        with Image.open(image_path) as image:
+            # Для JPEG декодер сразу отдаёт уменьшенную в 2-8 раз картинку вместо полной
+            image.draft('RGB', (size, size))
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail((size, size))
+            if thumbnail.mode not in ('RGB', 'RGBA'):
+                thumbnail = thumbnail.convert('RGBA')
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            temp_path = f"{thumb_path}.{os.getpid()}.tmp"
+            thumbnail.save(temp_path, 'PNG')
+            os.replace(temp_path, thumb_path)
+    with open(thumb_path, 'rb') as source:
+        return base64.b64encode(source.read())
+
+def get_preview(image_path, on_ready):
+    # Вызывается на потоке Tk. Возвращает PhotoImage из кэша или None; во втором случае превью
+    # готовится в пуле, и когда оно появится в кэше, вызывается on_ready()
+    if _pool is None or not image_path:
+        return None
+    file_hash = attachments.hash_from_path(image_path)
+    if file_hash is None or file_hash in _failed:
+        return None
+    preview = _previews.get(file_hash)
+    if preview is not None:
+        _previews.move_to_end(file_hash)
+        return preview
+    if file_hash in _waiting:
+        _waiting[file_hash].append(on_ready)
+        return None
+    _waiting[file_hash] = [on_ready]
+    future = _pool.submit(render_thumbnail, image_path, thumbnail_path(file_hash), THUMB_SIZE)
+    tasks.watch(future, on_done=lambda data: _remember(file_hash, data), on_error=lambda error: _forget(file_hash))
+    return None
+
+def _remember(file_hash, data):
+    _previews[file_hash] = tk.PhotoImage(data=data)
+    while len(_previews) > PREVIEW_CACHE_SIZE:
+        _previews.popitem(last=False)
+    for on_ready in _waiting.pop(file_hash, []):
+        on_ready()
+
+def _forget(file_hash):
+    # Файл не читается как изображение: больше не пытаемся, сообщение показывается как файл
+    _failed.add(file_hash)
+    _waiting.pop(file_hash, None)
+
+def shutdown():
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
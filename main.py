@@ -1,100 +1,43 @@
-import sqlite3
 import tkinter as tk
 from tkinter import messagebox, simpledialog, filedialog
 import os
-import shutil
-import time
 import webbrowser
 import pyperclip
 
+import attachment_gc
+import attachments
+import changes
+import clock
+import core
+import images
+import tasks
+import transfers
 import useful_info
+import windows
 import news
+import search
+from chat_view import VirtualMessageList
 
-def create_connection():
-    conn = sqlite3.connect('app_database.db')
-    return conn
-
-def create_tables():
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL
-        );
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            content TEXT,
-            file_path TEXT,
-            image_path TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            receiver_type TEXT DEFAULT 'user',
-            FOREIGN KEY (sender_id) REFERENCES users(id),
-            FOREIGN KEY (receiver_id) REFERENCES users(id)
-        );
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS groups (
-            id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL
-        );
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS group_members (
-            group_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            FOREIGN KEY (group_id) REFERENCES groups(id),
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            CONSTRAINT pk_group_members PRIMARY KEY (group_id, user_id)
-        );
-    ''')
-
-    conn.commit()
-    conn.close()
-
-def create_user(username, password):
-    conn = create_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('INSERT INTO users (username, password) VALUES (?, ?);', (username, password))
-        conn.commit()
+def create_user(username, password, on_created=None):
+    def on_registered(user):
         messagebox.showinfo("Успех", "Пользователь успешно зарегистрирован.")
-        user_id = cursor.lastrowid
-        set_current_user(user_id, username)
+        set_current_user(user.id, user.username)
         update_ui_after_login()
-    except sqlite3.IntegrityError:
-        messagebox.showerror("Ошибка", "Имя пользователя уже существует.")
-    finally:
-        conn.close()
-
-def authenticate_user(username, password):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM users WHERE username = ? AND password = ?;', (username, password))
-    user = cursor.fetchone()
-    conn.close()
-    return user[0] if user else None
+        if on_created is not None:
+            on_created()
+
+    tasks.submit(core.register, username, password, on_done=on_registered, on_error=show_error)
 
 def login():
     username = simpledialog.askstring("Вход", "Введите имя пользователя:")
     if username:
         password = simpledialog.askstring("Вход", "Введите пароль:", show="*")
         if password:
-            user_id = authenticate_user(username, password)
-            if user_id:
-                set_current_user(user_id, username)
+            def on_authenticated(user):
+                set_current_user(user.id, user.username)
                 update_ui_after_login()
-            else:
-                messagebox.showerror("Ошибка", "Неверное имя пользователя или пароль.")
+
+            tasks.submit(core.login, username, password, on_done=on_authenticated, on_error=show_error)
 
 def register():
     register_window = tk.Toplevel(root)
@@ -117,15 +60,7 @@ def register():
             messagebox.showwarning("Ошибка", "Логин или пароль нельзя оставить пустыми.")
             return  
 
-        try:
-            print(f"Регистрируем: {username}, {password}")
-            create_user(username, password)
-            register_window.destroy()
-        except sqlite3.IntegrityError:
-            messagebox.showerror("Ошибка", "Имя пользователя уже используется.")
-        except Exception as e:
-            print(f"Ошибка при создании пользователя: {e}")
-            messagebox.showinfo("Неожиданная ошибка", str(e))
+        create_user(username, password, on_created=register_window.destroy)
 
     submit_button = tk.Button(register_window, text="Зарегистрироваться", command=submit_registration)
     submit_button.pack(pady=10)
@@ -135,45 +70,19 @@ def set_current_user(user_id, username):
     global current_username
     current_user_id = user_id
     current_username = username
-    with open('current_user.txt', 'w') as f:
-        f.write(f"{user_id},{username}")
+    windows.set_user(user_id, on_error=show_database_error)
+    core.save_session(core.User(user_id, username))
     username_label.config(text=f"Пользователь: {current_username} (ID: {current_user_id})")
 
-def get_current_user():
-    if os.path.exists('current_user.txt'):
-        with open('current_user.txt', 'r') as f:
-            try:
-                user_id, username = f.read().split(',')
-                return int(user_id), username
-            except ValueError:
-                return None, None
-    return None, None
-
 def logout():
     global current_user_id
     global current_username
     current_user_id = None
     current_username = None
-    if os.path.exists('current_user.txt'):
-        os.remove('current_user.txt')
+    windows.set_user(None)
+    core.clear_session()
     update_ui_after_logout()
 
-def update_user_details(user_id, new_username=None, new_password=None):
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    if new_username and new_password:
-        hashed_password = new_password
-        cursor.execute('UPDATE users SET username = ?, password = ? WHERE id = ?;', (new_username, hashed_password, user_id))
-    elif new_username:
-        cursor.execute('UPDATE users SET username = ? WHERE id = ?;', (new_username, user_id))
-    elif new_password:
-        hashed_password = new_password
-        cursor.execute('UPDATE users SET password = ? WHERE id = ?;', (hashed_password, user_id))
-
-    conn.commit()
-    conn.close()
-
 def start_video_call(receiver_id):
     room_name = f"ChatApp_Room_{current_user_id}_{receiver_id}"  
     jitsi_url = f"https://meet.jit.si/{room_name}"  
@@ -183,81 +92,25 @@ def start_video_call(receiver_id):
         f"Видеозвонок начнется в браузере в комнате: {room_name}"
     )
 
-def create_group(group_name, member_ids):
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute('INSERT INTO groups (name) VALUES (?);', (group_name,))
-        group_id = cursor.lastrowid
-
-        for user_id in member_ids:
-            cursor.execute('INSERT INTO group_members (group_id, user_id) VALUES (?, ?);', (group_id, user_id))
-
-        conn.commit()
-        return group_id
-    except Exception as e:
-        messagebox.showerror("Ошибка", f"Ошибка при создании группы: {e}")
-    finally:
-        conn.close()
-
-def add_user_to_group(group_id, user_id):
-    conn = create_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('INSERT INTO group_members (group_id, user_id) VALUES (?, ?);', (group_id, user_id))
-        conn.commit()
-    except Exception as e:
-        messagebox.showerror("Ошибка", f"Ошибка: {e}")
-    finally:
-        conn.close()
-
-def get_group_members(group_id):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT users.id, users.username 
-        FROM group_members
-        JOIN users ON group_members.user_id = users.id
-        WHERE group_members.group_id = ?;
-    ''', (group_id,))
-    members = cursor.fetchall()
-    conn.close()
-    return members
-
-def load_group_messages(group_id):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT sender_id, content, timestamp, file_path, image_path 
-        FROM messages 
-        WHERE receiver_id = ? AND receiver_type = 'group'
-        ORDER BY timestamp;
-    ''', (group_id,))
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
-
-def send_group_message(sender_id, group_id, content, file_path=None, image_path=None):
-    conn = create_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-        INSERT INTO messages (sender_id, receiver_id, content, file_path, image_path, receiver_type)
-        VALUES (?, ?, ?, ?, ?, ?);
-            ''', (sender_id, group_id, content, file_path, image_path, 'group'))
-        conn.commit()
-    except Exception as e:
-        messagebox.showerror("Ошибка", f"Ошибка отправки сообщения: {e}")
-    finally:
-        conn.close()
+def send_group_message(sender_id, group_id, content, file_path=None, image_path=None, history_view=None,
+                       attachment=None):
+    return queue_message(history_view, sender_id, group_id, content, file_path, image_path, 'group', attachment)
 
 def show_group_chats():
-    clear_content_frame()
+    generation = clear_content_frame()
     tk.Label(content_frame, text="Групповые чаты", font=("Arial", 16)).pack(pady=10)
+    loading_label = tk.Label(content_frame, text="Загрузка...", font=("Arial", 12))
+    loading_label.pack(pady=5)
 
-    groups = get_user_groups(current_user_id)
+    def on_loaded(groups):
+        if generation != content_generation:
+            return
+        loading_label.destroy()
+        show_group_list(groups)
 
+    tasks.submit(core.get_user_groups, current_user_id, on_done=on_loaded, on_error=show_database_error)
+
+def show_group_list(groups):
     if groups:
         tk.Label(content_frame, text="Ваши группы:", font=("Arial", 14)).pack(pady=5)
 
@@ -289,19 +142,6 @@ def show_group_chats():
         create_group_button = tk.Button(content_frame, text="Создать новую группу", command=create_new_group_window)
         create_group_button.pack(pady=10)
 
-def get_user_groups(user_id):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT groups.id, groups.name 
-        FROM group_members
-        JOIN groups ON group_members.group_id = groups.id
-        WHERE group_members.user_id = ?;
-    ''', (user_id,))
-    groups = cursor.fetchall()
-    conn.close()
-    return groups
-
 def create_new_group_window():
     new_group_window = tk.Toplevel(root)
     new_group_window.title("Создать новую группу")
@@ -323,12 +163,23 @@ def create_new_group_window():
             try:
                 participant_ids = [int(p) for p in participants]
                 participant_ids.append(current_user_id)   
-                create_group(group_name, participant_ids)
-                messagebox.showinfo("Успех", f"Группа '{group_name}' успешно создана!")
-                new_group_window.destroy()
-                show_group_chats()
             except ValueError:
                 messagebox.showerror("Ошибка", "Пожалуйста, введите корректные ID участников.")
+                return
+
+            def on_created(group):
+                messagebox.showinfo("Успех", f"Группа '{group_name}' успешно создана!")
+                if new_group_window.winfo_exists():
+                    new_group_window.destroy()
+                show_group_chats()
+
+            def on_failed(error):
+                if submit_button.winfo_exists():
+                    submit_button.config(state=tk.NORMAL)
+                messagebox.showerror("Ошибка", f"Ошибка при создании группы: {error}")
+
+            submit_button.config(state=tk.DISABLED)
+            tasks.submit(core.create_group, group_name, participant_ids, on_done=on_created, on_error=on_failed)
         else:
             messagebox.showerror("Ошибка", "Название группы или участники не указаны.")
 
@@ -336,73 +187,57 @@ def create_new_group_window():
     submit_button.pack(pady=10)
 
 def open_group_chat_window(group_id):
+    windows.open_window(('group', group_id), lambda: create_group_chat_window(group_id))
+
+def create_group_chat_window(group_id):
     group_chat_window = tk.Toplevel(root)
     group_chat_window.title("Групповой чат")
     group_chat_window.geometry("500x600")
 
-    members = get_group_members(group_id)
     tk.Label(group_chat_window, text="Участники группы:", font=("Arial", 14)).pack(pady=10)
-    for member_id, member_name in members:
-        tk.Label(group_chat_window, text=f"- {member_name} (ID: {member_id})", font=("Arial", 12)).pack(anchor="w")
-
-    tk.Label(group_chat_window, text="Сообщения:", font=("Arial", 14)).pack(pady=10)
-
-    messages_frame = tk.Frame(group_chat_window)
-    messages_frame.pack(fill=tk.BOTH, expand=True)
+    members_frame = tk.Frame(group_chat_window)
+    members_frame.pack(fill=tk.X)
+    members_loading = tk.Label(members_frame, text="Загрузка...", font=("Arial", 12))
+    members_loading.pack(anchor="w")
 
-    def refresh_messages():
-        for widget in messages_frame.winfo_children():
-            widget.destroy()
+    def on_members_loaded(members):
+        if not members_frame.winfo_exists():
+            return
+        members_loading.destroy()
+        for member_id, member_name in members:
+            tk.Label(members_frame, text=f"- {member_name} (ID: {member_id})", font=("Arial", 12)).pack(anchor="w")
 
-        messages = load_group_messages(group_id)
-        for message in messages:
-            sender = "Вы" if message[0] == current_user_id else f"Пользователь {message[0]}"
-            message_text = f"{message[2]} - {sender}: {message[1]}"
-            
-            message_container = tk.Frame(messages_frame)
-            message_container.pack(anchor="w", pady=5)
-
-            tk.Label(message_container, text=message_text).pack(anchor="w")
-
-            if message[3]: 
-                file_name = os.path.basename(message[3])
+    tasks.submit(core.get_group_members, group_id, on_done=on_members_loaded, on_error=show_database_error)
 
-                def download_file(path=message[3]):
-                    if os.path.exists(path):
-                        save_path = filedialog.asksaveasfilename(initialfile=file_name)
-                        if save_path:
-                            shutil.copy(path, save_path)
-                            messagebox.showinfo("Успех", f"Файл сохранен: {save_path}")
-                    else:
-                        messagebox.showerror("Ошибка", "Файл не найден.")
-
-                tk.Button(messages_frame, text=f"Скачать файл: {file_name}", command=download_file).pack(anchor="w")
+    tk.Label(group_chat_window, text="Сообщения:", font=("Arial", 14)).pack(pady=10)
 
-            if message[1]: 
-                copy_button = tk.Button(message_container, text="Копировать", command=lambda msg=message[1]: copy_to_clipboard(msg))
-                copy_button.pack(anchor="w", pady=2)
+    messages_area = tk.Frame(group_chat_window)
+    messages_area.pack(fill=tk.BOTH, expand=True)
+
+    history_view = VirtualMessageList(
+        messages_area,
+        describe_message=describe_message,
+        on_copy=copy_to_clipboard,
+        on_download=download_file,
+        load_since=lambda after_id: core.load_group_messages_since(group_id, after_id),
+        load_before=lambda before_key: core.load_group_messages_before(group_id, before_key),
+        load_ids=lambda from_key: core.load_group_message_ids(group_id, from_key),
+        get_last_id=lambda: core.get_last_group_message_id(group_id),
+        submit=tasks.submit,
+        on_error=show_database_error,
+    )
 
     def submit_group_message():
         content = message_entry.get()
         if not (content.strip() or selected_file_path):  
             return  
 
-        file_destination = None
-        image_destination = None
-
-        if selected_file_path:
-            if not os.path.exists('files'):
-                os.makedirs('files') 
-            unique_filename = f"{current_user_id}_{int(time.time())}_{os.path.basename(selected_file_path)}"
-            file_destination = os.path.join('files', unique_filename)
-            shutil.copy(selected_file_path, file_destination)
-
-        send_group_message(current_user_id, group_id, content, file_path=file_destination, image_path=image_destination)
-
+        file_path = selected_file_path
         message_entry.delete(0, tk.END)
         clear_attachments()
         attachments_label.config(text="Нет прикреплений")
-        refresh_messages()
+        send_with_attachment(attachments_label, file_path, lambda attachment: send_group_message(
+            current_user_id, group_id, content, attachment=attachment, history_view=history_view))
 
     message_entry = tk.Entry(group_chat_window, width=50)
     message_entry.pack(pady=5)
@@ -421,109 +256,131 @@ def open_group_chat_window(group_id):
     send_message_button = tk.Button(button_frame, text="Отправить", command=submit_group_message)
     send_message_button.grid(row=1, column=0, padx=5)
 
-    refresh_messages()
-    group_chat_window.after(1000, refresh_messages)
+    return group_chat_window, history_view
 
 def delete_group_chat(group_id):
     if messagebox.askyesno("Подтверждение", f"Вы действительно хотите удалить группу (ID: {group_id}) из вашего списка?"):
-        conn = create_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                DELETE FROM group_members 
-                WHERE group_id = ? AND user_id = ?;
-            ''', (group_id, current_user_id))
-            conn.commit()
+        def on_left(_):
             messagebox.showinfo("Успех", "Вы были удалены из группы.")
             show_group_chats()
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Ошибка: {e}")
-        finally:
-            conn.close()
-
-def find_user(identifier):
-    conn = create_connection()
-    cursor = conn.cursor()
-    if identifier.isdigit():
-        cursor.execute('SELECT id, username FROM users WHERE id = ?;', (int(identifier),))
-    else:
-        cursor.execute('SELECT id, username FROM users WHERE username = ?;', (identifier,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
-
-def create_message(sender_id, receiver_id, content, file_path=None, image_path=None):
-    conn = create_connection()
-    cursor = conn.cursor()
+
+        tasks.submit(core.leave_group, group_id, current_user_id, on_done=on_left,
+                     on_error=lambda error: messagebox.showerror("Ошибка", f"Ошибка: {error}"))
+
+def create_message(sender_id, receiver_id, content, file_path=None, image_path=None, history_view=None,
+                   attachment=None):
+    return queue_message(history_view, sender_id, receiver_id, content, file_path, image_path, 'user', attachment)
+
+def queue_message(history_view, sender_id, receiver_id, content, file_path, image_path, receiver_type, attachment=None):
+    # Запись идёт через очередь отправки пачками; в окне чата сообщение появляется сразу,
+    # а ошибка показывается в строке именно этого сообщения
+    if attachment is not None and image_path is None and attachments.is_image(attachment.name):
+        image_path = attachment.path
+    future = core.send_message(sender_id, receiver_id, content, attachment, receiver_type, file_path, image_path)
+    changes.poke()
+    if history_view is None:
+        tasks.watch(future, on_error=lambda error: messagebox.showerror("Ошибка", f"Ошибка отправки сообщения: {error}"))
+        return future
+    if attachment is not None:
+        file_path = attachment.path
+    file_name = attachment.name if attachment is not None else None
+    pending_id = history_view.add_pending((sender_id, content, "Отправка...", file_path, image_path, file_name))
+    tasks.watch(
+        future,
+        on_done=lambda message_id: history_view.confirm_pending(pending_id, message_id),
+        on_error=lambda error: history_view.fail_pending(pending_id, f"Не отправлено: {error}"),
+    )
+    return future
+
+def send_with_attachment(label, file_path, send):
+    # Вложение копируется в хранилище в фоне, прогресс идёт в label; send(attachment) вызывается,
+    # только когда файл уже на месте, поэтому сообщение не попадает в базу без своего вложения
+    if not file_path:
+        send(None)
+        return None
     try:
-        cursor.execute('''
-            INSERT INTO messages (sender_id, receiver_id, content, file_path, image_path)
-            VALUES (?, ?, ?, ?, ?);
-        ''', (sender_id, receiver_id, content, file_path, image_path))
-        conn.commit()
-    except Exception as e:
-        messagebox.showerror("Ошибка", f"Ошибка отправки сообщения: {e}")
-    finally:
-        conn.close()
-
-def load_messages(user_id, chat_with_id=None):
-    conn = create_connection()
-    cursor = conn.cursor()
-    if chat_with_id:
-        cursor.execute('''
-            SELECT sender_id, content, timestamp, file_path, image_path 
-            FROM messages 
-            WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
-            AND receiver_type = 'user'
-            AND sender_id != receiver_id  -- Исключить сообщения самому себе
-            ORDER BY timestamp;
-        ''', (user_id, chat_with_id, chat_with_id, user_id))
-    else:
-        cursor.execute('''
-            SELECT sender_id, content, timestamp, file_path, image_path 
-            FROM messages 
-            WHERE receiver_id = ? AND receiver_type = 'user'
-            AND sender_id != receiver_id  -- Исключить сообщения самому себе
-            ORDER BY timestamp;
-        ''', (user_id,))
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
+        transfer = core.start_upload(file_path)
+    except core.CoreError as error:
+        label.config(text="Нет прикреплений")
+        messagebox.showerror("Ошибка", f"Не удалось прикрепить файл: {error}")
+        return None
+    controls = tk.Frame(label.master)
+    if label.winfo_manager() == 'pack':
+        controls.pack(after=label)
+    pause_button = tk.Button(controls, text="Пауза")
+    pause_button.pack(side="left", padx=2)
+    tk.Button(controls, text="Отмена", command=transfer.cancel).pack(side="left", padx=2)
+
+    def toggle_pause():
+        if transfer.state == 'running':
+            transfer.pause()
+            pause_button.config(text="Продолжить")
+        else:
+            transfer.resume()
+            pause_button.config(text="Пауза")
+
+    def show_progress():
+        if transfer.future.done() or not label.winfo_exists():
+            return
+        paused = " (пауза)" if transfer.state in ('pausing', 'paused') else ""
+        label.config(text=f"Отправка {transfer.name}: {transfer.progress:.0%}{paused}")
+        label.after(transfers.PROGRESS_INTERVAL_MS, show_progress)
+
+    def finish(text):
+        if label.winfo_exists():
+            label.config(text=text)
+            controls.destroy()
+
+    def on_done(attachment):
+        finish("Нет прикреплений")
+        send(attachment)
+
+    def on_error(error):
+        if isinstance(error, transfers.TransferCancelled):
+            finish("Отправка файла отменена")
+        else:
+            finish("Нет прикреплений")
+            messagebox.showerror("Ошибка", f"Не удалось прикрепить файл: {error}")
+
+    pause_button.config(command=toggle_pause)
+    show_progress()
+    tasks.watch(transfer.future, on_done=on_done, on_error=on_error)
+    return transfer
 
 def send_message():
     receiver_input = simpledialog.askstring("Отправка сообщения", "Введите ID или имя получателя:")
     if receiver_input:
-        receiver = find_user(receiver_input)
-        if receiver:
-            receiver_id = receiver[0]
+        def on_found(receiver):
+            receiver_id = receiver.id
             content = message_entry.get()
             message_entry.bind("<Return>", lambda event: send_message())
             if receiver_id and (content or selected_file_path):
-                file_destination = None
-                image_destination = None
+                def send(attachment):
+                    sent = create_message(current_user_id, receiver_id, content, attachment=attachment)
+                    tasks.watch(sent, on_done=lambda message_id: refresh_messages())
 
-                if selected_file_path:
-                    if not os.path.exists('files'):
-                        os.makedirs('files')
-                    unique_filename = f"{current_user_id}_{int(time.time())}_{os.path.basename(selected_file_path)}"
-                    file_destination = os.path.join('files', unique_filename)
-                    shutil.copy(selected_file_path, file_destination)
-
-                create_message(current_user_id, receiver_id, content, file_destination, image_destination)
+                file_path = selected_file_path
                 message_entry.delete(0, tk.END)
                 clear_attachments()
                 attachments_label.config(text="Нет прикреплений")
-                refresh_messages()
-            else:
-                pass
-        else:
-            messagebox.showerror("Ошибка", "Пользователь не найден.")
+                send_with_attachment(attachments_label, file_path, send)
+
+        find_receiver(receiver_input, on_found)
 
 def refresh_messages():
-    messages = load_messages(current_user_id)
-    messages_list.delete(0, tk.END)
-    for message in messages:
-        display_message(messages_list, message)
+    # Ответы нескольких подряд запущенных загрузок могут прийти не по порядку — показывается только последняя
+    global inbox_generation
+    inbox_generation += 1
+    generation = inbox_generation
+
+    def on_loaded(messages):
+        if generation != inbox_generation or not messages_list.winfo_exists():
+            return
+        messages_list.delete(0, tk.END)
+        for message in messages:
+            display_message(messages_list, message)
+
+    tasks.submit(core.load_inbox, current_user_id, on_done=on_loaded, on_error=show_database_error)
 
 def update_ui_after_login():
     login_button.pack_forget()
@@ -542,6 +399,9 @@ def update_ui_after_logout():
 def open_chat_window(receiver_id):
     global global_receiver_id
     global_receiver_id = receiver_id
+    windows.open_window(('user', receiver_id), lambda: create_chat_window(receiver_id))
+
+def create_chat_window(receiver_id):
     chat_window = tk.Toplevel(root)
     chat_window.title(f"Чат с пользователем {receiver_id}")
     chat_window.geometry("500x600")
@@ -549,22 +409,6 @@ def open_chat_window(receiver_id):
     chat_messages_frame = tk.Frame(chat_window)
     chat_messages_frame.pack(pady=10, fill=tk.BOTH, expand=True)
 
-    chat_canvas = tk.Canvas(chat_messages_frame)
-    chat_scrollbar = tk.Scrollbar(chat_messages_frame, orient="vertical", command=chat_canvas.yview)
-    chat_scrollable_frame = tk.Frame(chat_canvas)
-
-    chat_scrollable_frame.bind(
-        "<Configure>",
-        lambda e: chat_canvas.configure(
-            scrollregion=chat_canvas.bbox("all")
-        )
-    )
-    chat_canvas.create_window((0, 0), window=chat_scrollable_frame, anchor='nw')
-    chat_canvas.configure(yscrollcommand=chat_scrollbar.set)
-    
-    chat_canvas.pack(side="left", fill="both", expand=True)
-    chat_scrollbar.pack(side="right", fill="y")
-
     chat_message_entry = tk.Entry(chat_window, width=50)
     chat_message_entry.pack(pady=10)
     chat_message_entry.bind("<Return>", lambda event: send_chat_message())
@@ -579,88 +423,64 @@ def open_chat_window(receiver_id):
     def send_chat_message():
         content = chat_message_entry.get()
         if content or selected_chat_file_path:
-            file_destination = None
-            image_destination = None
-
-            if selected_chat_file_path:
-                if not os.path.exists('files'):
-                    os.makedirs('files')
-                unique_filename = f"{current_user_id}_{int(time.time())}_{os.path.basename(selected_chat_file_path)}"
-                file_destination = os.path.join('files', unique_filename)
-                shutil.copy(selected_chat_file_path, file_destination)
-
-            create_message(current_user_id, receiver_id, content, file_destination, image_destination)
+            file_path = selected_chat_file_path
             chat_message_entry.delete(0, tk.END)
             clear_chat_attachments()
             chat_attachments_label.config(text="Нет прикреплений")
-            refresh_chat_messages(chat_scrollable_frame, receiver_id)
+            send_with_attachment(chat_attachments_label, file_path, lambda attachment: create_message(
+                current_user_id, receiver_id, content, attachment=attachment, history_view=history_view))
         else:
             pass
 
     chat_send_button = tk.Button(chat_window, text="Отправить", command=send_chat_message)
     chat_send_button.pack(pady=5)
 
-    def refresh_chat():
-        refresh_chat_messages(chat_scrollable_frame, receiver_id)
-        chat_window.after(1000, refresh_chat)
-
-    refresh_chat()
-
-def refresh_chat_messages(container, receiver_id):
-    for widget in container.winfo_children():
-        widget.destroy()
-
-    messages = load_messages(current_user_id, receiver_id)
-
-    for message in messages:
-        message_frame = tk.Frame(container)
-        message_frame.pack(pady=5, anchor='w' if message[0] == current_user_id else 'e')
-
-        sender = "Вы" if message[0] == current_user_id else f"Пользователь {message[0]}"
-        timestamp_label = tk.Label(message_frame, text=f"{message[2]} - {sender}")
-        timestamp_label.pack(anchor='w')
-
-        if message[1]:
-            content_label = tk.Label(message_frame, text=message[1], bg='lightgrey', wraplength=300)
-            content_label.pack(anchor='w')
-            
-            copy_button = tk.Button(message_frame, text="Копировать", command=lambda msg=message[1]: copy_to_clipboard(msg))
-            copy_button.pack(anchor='w', pady=2)
-
-
-        if message[3]:
-            file_name = os.path.basename(message[3])
-
-            def download_file(path=message[3]):
-                if os.path.exists(path):
-                    save_path = filedialog.asksaveasfilename(initialfile=file_name)
-                    if save_path:
-                        shutil.copy(path, save_path)
-                        messagebox.showinfo("Успех", f"Файл сохранен: {save_path}")
-                else:
-                    messagebox.showerror("Ошибка", "Файл не найден.")
+    def on_new_messages(messages):
+        if any(message[0] == receiver_id for message in messages):
+            tasks.submit(core.mark_chat_read, current_user_id, receiver_id)
+
+    history_view = VirtualMessageList(
+        chat_messages_frame,
+        describe_message=describe_message,
+        on_copy=copy_to_clipboard,
+        on_download=download_file,
+        load_since=lambda after_id: core.load_messages_since(current_user_id, receiver_id, after_id),
+        load_before=lambda before_key: core.load_messages_before(current_user_id, receiver_id, before_key),
+        load_ids=lambda from_key: core.load_message_ids(current_user_id, receiver_id, from_key),
+        get_last_id=lambda: core.get_last_message_id(current_user_id, receiver_id),
+        submit=tasks.submit,
+        on_error=show_database_error,
+        on_messages=on_new_messages,
+    )
+    tasks.submit(core.mark_chat_read, current_user_id, receiver_id)
+    return chat_window, history_view
 
-            file_button = tk.Button(message_frame, text=f"Скачать файл: {file_name}", command=download_file)
-            file_button.pack(anchor='w')
+def describe_message(message):
+    sender = "Вы" if message[0] == current_user_id else f"Пользователь {message[0]}"
+    return f"{clock.format_ms(message[2])} - {sender}", 'w' if message[0] == current_user_id else 'e'
+
+def download_file(path, file_name=None):
+    if os.path.exists(path):
+        save_path = filedialog.asksaveasfilename(initialfile=file_name or os.path.basename(path))
+        if save_path:
+            tasks.submit(core.export_attachment, path, save_path,
+                         on_done=lambda _: messagebox.showinfo("Успех", f"Файл сохранен: {save_path}"),
+                         on_error=show_error)
+    else:
+        messagebox.showerror("Ошибка", "Файл не найден.")
 
 def start_chat():
     receiver_input = simpledialog.askstring("Начать чат", "Введите ID или имя собеседника:")
     if receiver_input:
-        receiver = find_user(receiver_input)
-        if receiver:
-            receiver_id = receiver[0]
-            open_chat_window(receiver_id)
-        else:
-            messagebox.showerror("Ошибка", "Пользователь не найден.")
+        find_receiver(receiver_input, lambda receiver: open_chat_window(receiver.id))
+
+def find_receiver(identifier, on_found):
+    tasks.submit(core.find_user, identifier, on_done=on_found, on_error=show_error)
 
 def auto_login():
-    user_id, username = get_current_user()
-    if user_id:
-        global current_user_id
-        global current_username
-        current_user_id = user_id
-        current_username = username
-        set_current_user(user_id, username)
+    user = core.load_session()
+    if user is not None:
+        set_current_user(user.id, user.username)
         update_ui_after_login()
 
 def open_profile_section():
@@ -670,6 +490,7 @@ def open_profile_section():
     tk.Label(content_frame, text=f"Имя пользователя: {current_username}", font=("Arial", 14)).pack(pady=10)
 
 def open_settings_section():
+    global settings_cleanup_label
     clear_content_frame()
     tk.Label(content_frame, text="Настройки пользователя", font=("Arial", 16)).pack(pady=20)
 
@@ -682,19 +503,39 @@ def open_settings_section():
     new_password_entry.pack(pady=5)
 
     def save_changes():
-        new_username = new_username_entry.get().strip()
-        new_password = new_password_entry.get().strip()
-        if new_username or new_password:
-            update_user_details(current_user_id, new_username=new_username, new_password=new_password)
-            if new_username:
-                set_current_user(current_user_id, new_username)
+        def on_saved(user):
+            set_current_user(user.id, user.username)
             messagebox.showinfo("Успех", "Изменения сохранены.")
-        else:
-            messagebox.showerror("Ошибка", "Вы не ввели ни логин, ни пароль.")
+
+        tasks.submit(core.update_user, current_user_id, new_username_entry.get(), new_password_entry.get(),
+                     on_done=on_saved, on_error=show_error)
 
     save_button = tk.Button(content_frame, text="Сохранить изменения", command=save_changes)
     save_button.pack(pady=10)
 
+    cleanup_label = tk.Label(content_frame, text=describe_cleanup(attachment_gc.last_report))
+    cleanup_label.pack(pady=10)
+
+    def run_cleanup():
+        cleanup_label.config(text="Очистка неиспользуемых вложений...")
+        attachment_gc.run_now()
+
+    tk.Button(content_frame, text="Очистить неиспользуемые вложения", command=run_cleanup).pack(pady=5)
+    settings_cleanup_label = cleanup_label
+
+def describe_cleanup(report):
+    if report is None:
+        return "Неиспользуемые вложения ещё не проверялись"
+    reclaimed, quarantined = report
+    text = f"Освобождено места от неиспользуемых вложений: {reclaimed / (1024 * 1024):.1f} МБ"
+    if quarantined:
+        text += f", в карантине: {quarantined / (1024 * 1024):.1f} МБ"
+    return text
+
+def show_cleanup_report(report):
+    if settings_cleanup_label is not None and settings_cleanup_label.winfo_exists():
+        settings_cleanup_label.config(text=describe_cleanup(report))
+
 
 
 
@@ -703,17 +544,11 @@ def open_settings_section():
 def delete_chat(peer_id):
 
     if messagebox.askyesno("Подтверждение", f"Вы действительно хотите удалить чат с пользователем {peer_id}?"):
-        conn = create_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            DELETE FROM messages 
-            WHERE (sender_id = ? AND receiver_id = ?) 
-               OR (sender_id = ? AND receiver_id = ?);
-        ''', (current_user_id, peer_id, peer_id, current_user_id))
-        conn.commit()
-        conn.close()
-        messagebox.showinfo("Успех", "Чат был успешно удален.")
-        show_chat_section() 
+        def on_deleted(_):
+            messagebox.showinfo("Успех", "Чат был успешно удален.")
+            show_chat_section()
+
+        tasks.submit(core.delete_chat, current_user_id, peer_id, on_done=on_deleted, on_error=show_database_error)
 
 def show_chat_options():
     clear_content_frame()
@@ -726,10 +561,45 @@ def show_chat_options():
     create_group_button.pack(pady=5)
 
 def show_chat_section():
-    clear_content_frame()
+    generation = clear_content_frame()
     tk.Label(content_frame, text="Раздел 'Чат'", font=("Arial", 16)).pack(pady=10)
-    previous_chats = get_previous_chats(current_user_id)
-    
+    loading_label = tk.Label(content_frame, text="Загрузка...", font=("Arial", 12))
+    loading_label.pack(pady=5)
+
+    def on_loaded(previous_chats):
+        if generation != content_generation:
+            return
+        loading_label.destroy()
+        show_chat_list(previous_chats)
+
+    tasks.submit(core.get_chat_list, current_user_id, on_done=on_loaded, on_error=show_database_error)
+
+def show_search_section():
+    clear_content_frame()
+    search.show_search_section(
+        content_frame,
+        search=lambda text, cursor: core.search_messages(current_user_id, text, cursor),
+        open_result=open_search_result,
+        describe_result=describe_search_result,
+        submit=tasks.submit,
+        on_error=show_database_error,
+    )
+
+def describe_search_result(result):
+    message_id, sender_id, receiver_id, receiver_type, timestamp = result[:5]
+    sender = "Вы" if sender_id == current_user_id else f"Пользователь {sender_id}"
+    if receiver_type == 'group':
+        return f"{clock.format_ms(timestamp)} - {sender}, группа {receiver_id}"
+    return f"{clock.format_ms(timestamp)} - {sender}"
+
+def open_search_result(result):
+    sender_id, receiver_id, receiver_type = result[1:4]
+    if receiver_type == 'group':
+        open_group_chat_window(receiver_id)
+    else:
+        open_chat_window(receiver_id if sender_id == current_user_id else sender_id)
+
+def show_chat_list(previous_chats):
     if previous_chats:
         tk.Label(content_frame, text="Предыдущие чаты:", font=("Arial", 14)).pack(pady=5)
         
@@ -740,12 +610,13 @@ def show_chat_section():
         chats_container.columnconfigure(1, weight=0)  
         chats_container.columnconfigure(2, weight=1)  
         
-        for chat_partner_id in previous_chats:
-            user = get_user_by_id(chat_partner_id)
-            partner_name = user[1] if user else f"Пользователь {chat_partner_id}"
+        for row, (chat_partner_id, username, last_timestamp, last_preview, unread_count) in enumerate(previous_chats):
+            partner_name = username if username else f"Пользователь {chat_partner_id}"
+            if unread_count:
+                partner_name += f" (+{unread_count})"
     
             chat_frame = tk.Frame(chats_container)
-            chat_frame.grid(row=previous_chats.index(chat_partner_id), column=1, pady=5, sticky="ew")
+            chat_frame.grid(row=row, column=1, pady=5, sticky="ew")
             
             chat_frame.columnconfigure(0, weight=1)  
             chat_frame.columnconfigure(1, weight=0)  
@@ -757,6 +628,9 @@ def show_chat_section():
     
             delete_button = tk.Button(chat_frame, text="Удалить", command=lambda partner_id=chat_partner_id: delete_chat(partner_id))
             delete_button.grid(row=0, column=2, sticky="w")
+
+            if last_preview:
+                tk.Label(chat_frame, text=last_preview, fg="grey", wraplength=250).grid(row=1, column=1, columnspan=2, sticky="w")
     else:
         tk.Label(content_frame, text="У вас нет предыдущих чатов.", font=("Arial", 12)).pack(pady=5)
     
@@ -764,15 +638,30 @@ def show_chat_section():
     start_chat_button.pack(pady=5)
 
 def clear_content_frame():
+    # Номер текущего содержимого: фоновые запросы, завершившиеся после перехода в другой раздел, не рисуют ничего
+    global content_generation
+    content_generation += 1
     for widget in content_frame.winfo_children():
         widget.pack_forget()
+    return content_generation
+
+def show_database_error(error):
+    messagebox.showerror("Ошибка", f"Ошибка базы данных: {error}")
+
+def show_error(error):
+    # Ошибки ядра (неверный пароль, пользователь не найден...) показываются своим текстом
+    if isinstance(error, core.CoreError):
+        messagebox.showerror("Ошибка", str(error))
+    else:
+        show_database_error(error)
 
 def attach_file(label):
     global selected_file_path
     file_path = filedialog.askopenfilename()
     if file_path:
         selected_file_path = file_path
-        label.config(text=f"Прикреплен файл: {os.path.basename(file_path)}")
+        kind = "Прикреплено изображение" if attachments.is_image(file_path) else "Прикреплен файл"
+        label.config(text=f"{kind}: {os.path.basename(file_path)}")
     else:
         selected_file_path = None
         label.config(text="Нет прикреплений")
@@ -782,7 +671,8 @@ def attach_chat_file(label):
     file_path = filedialog.askopenfilename()
     if file_path:
         selected_chat_file_path = file_path
-        label.config(text=f"Прикреплен файл: {os.path.basename(file_path)}")
+        kind = "Прикреплено изображение" if attachments.is_image(file_path) else "Прикреплен файл"
+        label.config(text=f"{kind}: {os.path.basename(file_path)}")
     else:
         selected_chat_file_path = None
         label.config(text="Прикрепления: Нет")
@@ -800,7 +690,7 @@ def copy_to_clipboard(text):
     
 
 def display_message(listbox, message):
-    display_text = f"{message[2]}: "
+    display_text = f"{clock.format_ms(message[2])}: "
     sender = "Вы" if message[0] == current_user_id else f"Пользователь {message[0]}"
     display_text += f"{sender}: "
     if message[1]:
@@ -808,97 +698,100 @@ def display_message(listbox, message):
 
     listbox.insert(tk.END, display_text + "\n")
 
-def get_previous_chats(user_id):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT receiver_id, MAX(timestamp) as last_msg_time
-        FROM messages
-        WHERE sender_id = ? AND receiver_type = 'user'
-        AND sender_id != receiver_id  -- Исключить сообщения самому себе
-        GROUP BY receiver_id
-        UNION
-        SELECT sender_id, MAX(timestamp) as last_msg_time
-        FROM messages
-        WHERE receiver_id = ? AND receiver_type = 'user'
-        AND sender_id != receiver_id  -- Исключить сообщения самому себе
-        GROUP BY sender_id
-        ORDER BY last_msg_time DESC
-    ''', (user_id, user_id))
-    result = cursor.fetchall()
-    conn.close()
-    return [row[0] for row in result]
-
-def get_user_by_id(user_id):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, username FROM users WHERE id = ?;', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+current_user_id = None
+current_username = None
+content_generation = 0
+inbox_generation = 0
+global_receiver_id = None
+selected_file_path = None
 
-root = tk.Tk()
-root.title("Приложение")
-root.geometry("800x900")
+selected_chat_file_path = None
+settings_cleanup_label = None
 
-content_frame = tk.Frame(root)
+root = None
+content_frame = None
+top_frame = None
+username_label = None
+message_entry = None
+attachments_label = None
+messages_list = None
+login_button = None
+register_button = None
 
-top_frame = tk.Frame(root)
+def build_main_window():
+    # Виджеты главного окна, к которым обращаются обработчики, — глобальные
+    global root, content_frame, top_frame, username_label, message_entry, attachments_label, messages_list
+    global login_button, register_button
+    root = tk.Tk()
+    root.title("Приложение")
+    root.geometry("800x900")
 
-left_frame = tk.Frame(top_frame)
-left_frame.pack(side=tk.LEFT)
+    content_frame = tk.Frame(root)
 
-settings_button = tk.Button(left_frame, text="Настройки", command=open_settings_section)
-settings_button.pack(padx=10, pady=5)
+    top_frame = tk.Frame(root)
 
-nav_frame = tk.Frame(top_frame)
-nav_frame.pack(side=tk.LEFT, expand=True)
+    left_frame = tk.Frame(top_frame)
+    left_frame.pack(side=tk.LEFT)
 
-useful_info_button = tk.Button(nav_frame, text="Полезно узнать", command=lambda: useful_info.show_useful_info_section(content_frame))
-chat_button = tk.Button(nav_frame, text="Чат", command=show_chat_section)
-group_chat_button = tk.Button(nav_frame, text="Групповые чаты", command=show_group_chats)
-video_call_menu = tk.Button(nav_frame, text="Видеозвонок", command=lambda: start_video_call(global_receiver_id))
+    settings_button = tk.Button(left_frame, text="Настройки", command=open_settings_section)
+    settings_button.pack(padx=10, pady=5)
 
+    nav_frame = tk.Frame(top_frame)
+    nav_frame.pack(side=tk.LEFT, expand=True)
 
-useful_info_button.pack(side=tk.LEFT, padx=5, pady=5)
-chat_button.pack(side=tk.LEFT, padx=5, pady=5)
-group_chat_button.pack(side=tk.LEFT, padx=5, pady=5)
-video_call_menu.pack(side=tk.LEFT, padx=5, pady=5)
+    useful_info_button = tk.Button(nav_frame, text="Полезно узнать", command=lambda: useful_info.show_useful_info_section(content_frame))
+    chat_button = tk.Button(nav_frame, text="Чат", command=show_chat_section)
+    group_chat_button = tk.Button(nav_frame, text="Групповые чаты", command=show_group_chats)
+    search_button = tk.Button(nav_frame, text="Поиск", command=show_search_section)
+    video_call_menu = tk.Button(nav_frame, text="Видеозвонок", command=lambda: start_video_call(global_receiver_id))
 
-right_frame = tk.Frame(top_frame)
-right_frame.pack(side=tk.RIGHT)
 
-profile_button = tk.Button(right_frame, text="Профиль", command=open_profile_section)
-profile_button.pack(padx=10, pady=5)
+    useful_info_button.pack(side=tk.LEFT, padx=5, pady=5)
+    chat_button.pack(side=tk.LEFT, padx=5, pady=5)
+    group_chat_button.pack(side=tk.LEFT, padx=5, pady=5)
+    search_button.pack(side=tk.LEFT, padx=5, pady=5)
+    video_call_menu.pack(side=tk.LEFT, padx=5, pady=5)
 
-logout_button = tk.Button(right_frame, text="Выход", command=logout)
-logout_button.pack(padx=10, pady=5)
+    right_frame = tk.Frame(top_frame)
+    right_frame.pack(side=tk.RIGHT)
 
-username_label = tk.Label(root, text="", font=("Arial", 14))
+    profile_button = tk.Button(right_frame, text="Профиль", command=open_profile_section)
+    profile_button.pack(padx=10, pady=5)
 
-message_entry = tk.Entry(content_frame, width=50)
+    logout_button = tk.Button(right_frame, text="Выход", command=logout)
+    logout_button.pack(padx=10, pady=5)
 
-attachments_label = tk.Label(content_frame, text="Нет прикреплений")
-attach_file_button = tk.Button(content_frame, text="Прикрепить файл", command=lambda: attach_file(attachments_label))
-send_button = tk.Button(content_frame, text="Отправить сообщение", command=send_message)
+    username_label = tk.Label(root, text="", font=("Arial", 14))
 
-messages_list = tk.Listbox(content_frame, width=70, height=15)
+    message_entry = tk.Entry(content_frame, width=50)
 
-current_user_id = None
-current_username = None
-global_receiver_id = None
-selected_file_path = None
-
-selected_chat_file_path = None
+    attachments_label = tk.Label(content_frame, text="Нет прикреплений")
+    attach_file_button = tk.Button(content_frame, text="Прикрепить файл", command=lambda: attach_file(attachments_label))
+    send_button = tk.Button(content_frame, text="Отправить сообщение", command=send_message)
 
-login_button = tk.Button(root, text="Вход", command=login)
-register_button = tk.Button(root, text="Регистрация", command=register)
+    messages_list = tk.Listbox(content_frame, width=70, height=15)
 
-username_label.pack(pady=10)
-login_button.pack(pady=5)
-register_button.pack(pady=5)
+    login_button = tk.Button(root, text="Вход", command=login)
+    register_button = tk.Button(root, text="Регистрация", command=register)
 
-create_tables()
-auto_login()
+    username_label.pack(pady=10)
+    login_button.pack(pady=5)
+    register_button.pack(pady=5)
 
-root.mainloop()
\ No newline at end of file
+def main():
+    # Пул превью создаётся fork'ом до любых других потоков, в том числе до фонового потока core.start
+    images.install()
+    core.start()
+    build_main_window()
+    tasks.install(root)
+    changes.install(root)
+    attachment_gc.install(root, on_report=show_cleanup_report)
+    auto_login()
+
+    root.mainloop()
+    images.shutdown()
+    tasks.shutdown()
+    core.shutdown()
+
+if __name__ == '__main__':
+    main()
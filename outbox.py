@@ -0,0 +1,114 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import clock
+import db
+from queries import insert_message
+
+FLUSH_INTERVAL_MS = 5
+MAX_BATCH_SIZE = 64
+
+class Outbox:
+    # Очередь исходящих сообщений с групповой фиксацией: отдельный поток собирает сообщения,
+    # накопившиеся за FLUSH_INTERVAL_MS (но не больше MAX_BATCH_SIZE), и записывает их одной транзакцией.
+    # Каждое сообщение вставляется под своим SAVEPOINT, так что ошибка в одном не роняет остальные,
+    # а результат (id сообщения или исключение) приходит в Future конкретного сообщения.
+
+    def __init__(self, flush_interval_ms=FLUSH_INTERVAL_MS, max_batch_size=MAX_BATCH_SIZE):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.closed = False
+                self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+                self.thread.start()
+
+    def send(self, sender_id, receiver_id, content, file_path=None, image_path=None, receiver_type='user',
+             attachment=None):
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Очередь отправки закрыта.")
+            # Время отправки, а не записи; под блокировкой — чтобы порядок очереди совпадал с порядком времени
+            values = (sender_id, receiver_id, content, file_path, image_path, receiver_type, attachment, clock.now_ms())
+            self.pending.append((future, values))
+            self.condition.notify()
+        self.start()
+        return future
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+        with self.condition:
+            self.thread = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending and self.closed:
+                    return
+                # Небольшое ожидание, чтобы собрать пачку: сообщения, отправленные подряд, попадут в одну транзакцию
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.pending) < self.max_batch_size and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.max_batch_size]
+                del self.pending[:self.max_batch_size]
+            self.flush(batch)
+
+    def flush(self, batch):
+        batch = [(future, values) for future, values in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        conn = db.get_connection()
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE;')
+            for future, values in batch:
+                conn.execute('SAVEPOINT outbox_message;')
+                try:
+                    message_id = insert_message(conn, *values)
+                except sqlite3.Error as error:
+                    conn.execute('ROLLBACK TO outbox_message;')
+                    results.append((future, None, error))
+                else:
+                    results.append((future, message_id, None))
+                conn.execute('RELEASE outbox_message;')
+            conn.commit()
+        except Exception as error:
+            if conn.in_transaction:
+                conn.rollback()
+            for future, _ in batch:
+                future.set_exception(error)
+            return
+
+        for future, message_id, error in results:
+            if error is None:
+                future.set_result(message_id)
+            else:
+                future.set_exception(error)
+
+_outbox = Outbox()
+
+def send_message(sender_id, receiver_id, content, file_path=None, image_path=None, receiver_type='user',
+                 attachment=None):
+    return _outbox.send(sender_id, receiver_id, content, file_path, image_path, receiver_type, attachment)
+
+def shutdown():
+    _outbox.close()
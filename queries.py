@@ -0,0 +1,518 @@
+import heapq
+import json
+
+import clock
+import db
+from search_index import make_snippet, query_terms
+from stemmer import stem_text
+
+# Время сообщения в миллисекундах; у строк, до которых ещё не дошёл schema.backfill_message_clock, —
+# из текстового timestamp (то же значение запишет backfill). По этому выражению построены индексы
+# schema._add_message_time_order: меняется только вместе с ними
+MESSAGE_TIME_SQL = "COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0)"
+
+# Ключ переписки (conversation_key()); у строк, до которых ещё не дошёл schema.backfill_conversation_key, —
+# вычисленный из отправителя и получателя (то же значение запишет backfill). По этому выражению построены
+# индексы schema._add_conversation_key и _add_message_time_order: меняется только вместе с ними
+CONVERSATION_KEY_SQL = ("COALESCE(conversation_key, CASE WHEN receiver_type = 'group' THEN -receiver_id "
+                        "ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id) END)")
+
+# Сообщение: (sender_id, content, ts_ms, file_path, image_path, id, file_name), время — clock.format_ms.
+# id и новые поля в конце, чтобы старый код с индексами message[0]..message[4] продолжал работать.
+MESSAGE_COLUMNS = f'sender_id, content, {MESSAGE_TIME_SQL}, file_path, image_path, id, file_name'
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_ID = 2 ** 63 - 1
+MAX_MESSAGE_KEY = (MAX_MESSAGE_ID, MAX_MESSAGE_ID)
+SEARCH_PAGE_SIZE = 20
+
+# Переписка — один диапазон индекса (conversation_key, время): ключ пары пользователей или группы,
+# см. conversation_key(). Сообщения самому себе в переписки не попадают.
+# Сообщения упорядочены по (время, id) — message_key(); курсор страницы — такая пара крайнего сообщения.
+# Сравнение пары раскрыто в «время <= ? AND (время < ? OR id < ?)»: по сравнению пар значений SQLite
+# не сужает диапазон индекса по выражению. Запросы *_SINCE — не страницы, а всё записанное после
+# отметки id (новые строки получают большие id); на место по времени их ставит VirtualMessageList.
+LOAD_CHAT_MESSAGES_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ?
+    AND sender_id != receiver_id
+    ORDER BY {MESSAGE_TIME_SQL}, id;
+'''
+
+LOAD_CHAT_MESSAGES_SINCE_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ? AND id > ?
+    AND sender_id != receiver_id
+    ORDER BY id;
+'''
+
+LOAD_CHAT_MESSAGES_BEFORE_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ?1 AND {MESSAGE_TIME_SQL} <= ?2 AND ({MESSAGE_TIME_SQL} < ?2 OR id < ?3)
+    AND sender_id != receiver_id
+    ORDER BY {MESSAGE_TIME_SQL} DESC, id DESC LIMIT ?4;
+'''
+
+LOAD_CHAT_MESSAGE_IDS_SQL = f'''
+    SELECT id
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ?1 AND {MESSAGE_TIME_SQL} >= ?2 AND ({MESSAGE_TIME_SQL} > ?2 OR id >= ?3)
+    AND sender_id != receiver_id;
+'''
+
+LOAD_INBOX_MESSAGES_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE receiver_id = ? AND receiver_type = 'user'
+    AND sender_id != receiver_id  -- Исключить сообщения самому себе
+    ORDER BY {MESSAGE_TIME_SQL}, id;
+'''
+
+LOAD_GROUP_MESSAGES_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ?
+    ORDER BY {MESSAGE_TIME_SQL}, id;
+'''
+
+LOAD_GROUP_MESSAGES_SINCE_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ? AND id > ?
+    ORDER BY id;
+'''
+
+LOAD_GROUP_MESSAGES_BEFORE_SQL = f'''
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ?1 AND {MESSAGE_TIME_SQL} <= ?2 AND ({MESSAGE_TIME_SQL} < ?2 OR id < ?3)
+    ORDER BY {MESSAGE_TIME_SQL} DESC, id DESC LIMIT ?4;
+'''
+
+LOAD_GROUP_MESSAGE_IDS_SQL = f'''
+    SELECT id
+    FROM messages
+    WHERE {CONVERSATION_KEY_SQL} = ?1 AND {MESSAGE_TIME_SQL} >= ?2 AND ({MESSAGE_TIME_SQL} > ?2 OR id >= ?3);
+'''
+
+# Переписки — по времени последнего сообщения (schema._order_conversations_by_time)
+CHAT_LIST_SQL = '''
+    SELECT conversations.peer_id, users.username, conversations.last_ts_ms,
+           conversations.last_preview, conversations.unread_count
+    FROM conversations
+    LEFT JOIN users ON users.id = conversations.peer_id
+    WHERE conversations.user_id = ?
+    ORDER BY conversations.last_ts_ms DESC, conversations.last_message_id DESC;
+'''
+
+# Новые сообщения для всех открытых окон одним проходом по диапазону id выше общей отметки
+# (NOT INDEXED: иначе OR превращается в поиск по всем личным сообщениям через индекс receiver_type).
+# Группы передаются JSON-массивом, чтобы текст запроса (и кэш подготовленных выражений) не зависел от их числа
+WINDOW_UPDATES_SQL = f'''
+    SELECT receiver_id, receiver_type, {MESSAGE_COLUMNS}
+    FROM messages NOT INDEXED
+    WHERE id > ?
+    AND (
+        (receiver_type = 'user' AND (sender_id = ? OR receiver_id = ?) AND sender_id != receiver_id)
+        OR (receiver_type = 'group' AND receiver_id IN (SELECT value FROM json_each(?)))
+    )
+    ORDER BY id;
+'''
+
+# Последний записанный id переписки (не conversations.last_message_id — то последнее по времени):
+# по нему окно узнаёт, что что-то удалено или не довезено
+WINDOW_CHAT_LAST_IDS_SQL = f'''
+    SELECT value, (SELECT MAX(id) FROM messages WHERE {CONVERSATION_KEY_SQL} = (min(?1, value) << 32 | max(?1, value)))
+    FROM json_each(?2);
+'''
+
+WINDOW_GROUP_LAST_IDS_SQL = f'''
+    SELECT value, (SELECT MAX(id) FROM messages WHERE {CONVERSATION_KEY_SQL} = -value)
+    FROM json_each(?);
+'''
+
+# Хвост messages для ретранслятора (relay.py): всё записанное после after_id по порядку, кем бы ни было
+# записано. RELAY_USER_MESSAGES_SQL — то же для одного пользователя (догнать пропущенное после переподключения)
+RELAY_COLUMNS = f'id, sender_id, receiver_id, receiver_type, {MESSAGE_TIME_SQL}, content, file_name'
+
+RELAY_MESSAGES_SQL = f'''
+    SELECT {RELAY_COLUMNS}
+    FROM messages
+    WHERE id > ?
+    ORDER BY id LIMIT ?;
+'''
+
+RELAY_USER_MESSAGES_SQL = f'''
+    SELECT {RELAY_COLUMNS}
+    FROM messages NOT INDEXED
+    WHERE id > ?
+    AND (
+        (receiver_type = 'user' AND (sender_id = ? OR receiver_id = ?) AND sender_id != receiver_id)
+        OR (receiver_type = 'group' AND receiver_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+    )
+    ORDER BY id LIMIT ?;
+'''
+
+RELAY_GROUP_MEMBERS_SQL = '''
+    SELECT group_id, user_id FROM group_members
+    WHERE group_id IN (SELECT value FROM json_each(?));
+'''
+
+# Записи журнала изменений одной базы-источника после seq (sync.export_changes) вместе с текущим
+# содержимым строки: её нет, если строку уже удалили. Ссылки сообщения на отправителя и получателя —
+# их gid, локальные id другой базе ничего не говорят. Пароли не передаются.
+SYNC_CHANGES_SQL = '''
+    SELECT change_log.id, change_log.origin, change_log.seq, change_log.tbl, change_log.op,
+           change_log.row_gid, change_log.ref_gid,
+           users.username, groups.name,
+           (SELECT gid FROM sync_rows WHERE tbl = 'users' AND local_id = messages.sender_id LIMIT 1),
+           (SELECT gid FROM sync_rows
+            WHERE tbl = CASE messages.receiver_type WHEN 'group' THEN 'groups' ELSE 'users' END
+            AND local_id = messages.receiver_id LIMIT 1),
+           messages.receiver_type, messages.content, messages.file_path, messages.image_path,
+           messages.file_hash, messages.file_name, attachments.size, messages.ts_ms, messages.timestamp
+    FROM change_log
+    LEFT JOIN sync_rows AS mapped ON mapped.gid = change_log.row_gid AND change_log.op != 'delete'
+    LEFT JOIN users ON change_log.tbl = 'users' AND users.id = mapped.local_id
+    LEFT JOIN groups ON change_log.tbl = 'groups' AND groups.id = mapped.local_id
+    LEFT JOIN messages ON change_log.tbl = 'messages' AND messages.id = mapped.local_id
+    LEFT JOIN attachments ON attachments.hash = messages.file_hash
+    WHERE change_log.origin = ? AND change_log.seq > ?
+    ORDER BY change_log.seq
+    LIMIT ?;
+'''
+
+# Результат поиска: (id, sender_id, receiver_id, receiver_type, ts_ms, текст, rank); текст затем
+# заменяется фрагментом. Только переписки пользователя и его группы; сортировка по bm25
+# (rank: чем меньше, тем лучше), курсор — пара (rank, id) последнего результата предыдущей страницы.
+SEARCH_MESSAGES_SQL = f'''
+    SELECT messages.id, messages.sender_id, messages.receiver_id, messages.receiver_type, {MESSAGE_TIME_SQL},
+           messages.content, messages_stems.rank
+    FROM messages_stems
+    JOIN messages ON messages.id = messages_stems.rowid
+    WHERE messages_stems MATCH ?
+    AND (
+        (messages.receiver_type = 'user' AND (messages.sender_id = ? OR messages.receiver_id = ?))
+        OR (messages.receiver_type = 'group' AND messages.receiver_id IN (
+            SELECT group_id FROM group_members WHERE user_id = ?
+        ))
+    )
+    AND (messages_stems.rank, messages.id) > (?, ?)
+    ORDER BY messages_stems.rank, messages.id
+    LIMIT ?;
+'''
+
+# Пути вложений по возрастанию для сборщика (attachment_gc.py): читаются частичные индексы
+# idx_messages_file_path/idx_messages_image_path по порядку, без сортировки во временном B-дереве
+ATTACHMENT_FILE_PATHS_SQL = '''
+    SELECT DISTINCT file_path FROM messages WHERE file_path > ? ORDER BY file_path;
+'''
+
+ATTACHMENT_IMAGE_PATHS_SQL = '''
+    SELECT DISTINCT image_path FROM messages WHERE image_path > ? ORDER BY image_path;
+'''
+
+# Запросы, которые выполняются на каждом обновлении окон; для них проверяется план выполнения
+# (benchmarks/query_plans.py). Параметры — примерные значения для EXPLAIN QUERY PLAN.
+HOT_QUERIES = {
+    'load_messages': (LOAD_CHAT_MESSAGES_SQL, (1 << 32 | 2,)),
+    'load_messages_since': (LOAD_CHAT_MESSAGES_SINCE_SQL, (1 << 32 | 2, 0)),
+    'load_messages_before': (LOAD_CHAT_MESSAGES_BEFORE_SQL, (1 << 32 | 2, 1700000000000, 100, 50)),
+    'load_message_ids': (LOAD_CHAT_MESSAGE_IDS_SQL, (1 << 32 | 2, 1700000000000, 100)),
+    'load_messages_inbox': (LOAD_INBOX_MESSAGES_SQL, (1,)),
+    'load_group_messages': (LOAD_GROUP_MESSAGES_SQL, (-1,)),
+    'load_group_messages_since': (LOAD_GROUP_MESSAGES_SINCE_SQL, (-1, 0)),
+    'load_group_messages_before': (LOAD_GROUP_MESSAGES_BEFORE_SQL, (-1, 1700000000000, 100, 50)),
+    'load_group_message_ids': (LOAD_GROUP_MESSAGE_IDS_SQL, (-1, 1700000000000, 100)),
+    'get_chat_list': (CHAT_LIST_SQL, (1,)),
+    'window_updates': (WINDOW_UPDATES_SQL, (100, 1, 1, '[1, 2]')),
+    'window_chat_last_ids': (WINDOW_CHAT_LAST_IDS_SQL, (1, '[2, 3]')),
+    'window_group_last_ids': (WINDOW_GROUP_LAST_IDS_SQL, ('[1, 2]',)),
+    'relay_messages': (RELAY_MESSAGES_SQL, (100, 1000)),
+    'relay_user_messages': (RELAY_USER_MESSAGES_SQL, (100, 1, 1, 1, 1000)),
+    'relay_group_members': (RELAY_GROUP_MEMBERS_SQL, ('[1, 2]',)),
+    'sync_changes': (SYNC_CHANGES_SQL, ('0123456789abcdef', 100, 1000)),
+    'search_messages': (SEARCH_MESSAGES_SQL, ('"прив"*', 1, 1, 1, float('-inf'), 0, SEARCH_PAGE_SIZE)),
+}
+
+def message_key(message):
+    # Место сообщения в переписке: (время, id), как в ORDER BY запросов выше
+    return message[2], message[5]
+
+def chat_key(user_id, peer_id):
+    # Ключ переписки двух пользователей; id пользователей меньше 2**31
+    return min(user_id, peer_id) << 32 | max(user_id, peer_id)
+
+def group_key(group_id):
+    return -group_id
+
+def conversation_key(receiver_type, sender_id, receiver_id):
+    # messages.conversation_key, то же выражение — в schema.backfill_conversation_key
+    if receiver_type == 'group':
+        return group_key(receiver_id)
+    return chat_key(sender_id, receiver_id)
+
+def create_user(username, password):
+    with db.transaction() as conn:
+        cursor = conn.execute('INSERT INTO users (username, password) VALUES (?, ?);', (username, password))
+    return cursor.lastrowid
+
+def update_user(user_id, username=None, password=None):
+    with db.transaction() as conn:
+        if username:
+            conn.execute('UPDATE users SET username = ? WHERE id = ?;', (username, user_id))
+        if password:
+            conn.execute('UPDATE users SET password = ? WHERE id = ?;', (password, user_id))
+
+def authenticate_user(username, password):
+    with db.read_connection() as conn:
+        # Учётные записи других баз (users.origin) здесь не входят: их пароля здесь нет
+        user = conn.execute('''
+            SELECT id FROM users WHERE username = ? AND password = ? AND origin IS NULL;
+        ''', (username, password)).fetchone()
+    return user[0] if user else None
+
+def create_group(group_name, member_ids):
+    with db.transaction() as conn:
+        cursor = conn.execute('INSERT INTO groups (name) VALUES (?);', (group_name,))
+        group_id = cursor.lastrowid
+        conn.executemany(
+            'INSERT INTO group_members (group_id, user_id) VALUES (?, ?);',
+            [(group_id, user_id) for user_id in member_ids],
+        )
+    return group_id
+
+def add_group_member(group_id, user_id):
+    with db.transaction() as conn:
+        conn.execute('INSERT INTO group_members (group_id, user_id) VALUES (?, ?);', (group_id, user_id))
+
+def leave_group(group_id, user_id):
+    # Последний участник уносит с собой сообщения группы: иначе их вложения не освободятся никогда
+    with db.transaction() as conn:
+        conn.execute('DELETE FROM group_members WHERE group_id = ? AND user_id = ?;', (group_id, user_id))
+        if conn.execute('SELECT 1 FROM group_members WHERE group_id = ? LIMIT 1;', (group_id,)).fetchone() is None:
+            conn.execute("DELETE FROM messages WHERE receiver_type = 'group' AND receiver_id = ?;", (group_id,))
+            conn.execute('DELETE FROM groups WHERE id = ?;', (group_id,))
+
+def insert_message(conn, sender_id, receiver_id, content, file_path=None, image_path=None, receiver_type='user',
+                   attachment=None, ts_ms=None):
+    # Вставка без своей транзакции: вызывающий код решает, сколько сообщений фиксировать за раз.
+    # attachment — attachments.Attachment; счётчик ссылок увеличит триггер. ts_ms — время отправки
+    # (clock.now_ms), по умолчанию — момент вставки
+    if ts_ms is None:
+        ts_ms = clock.now_ms()
+    file_hash = file_name = None
+    if attachment is not None:
+        conn.execute('''
+            INSERT INTO attachments (hash, size) VALUES (?, ?) ON CONFLICT (hash) DO NOTHING;
+        ''', (attachment.file_hash, attachment.size))
+        file_path, file_hash, file_name = attachment.path, attachment.file_hash, attachment.name
+    cursor = conn.execute('''
+        INSERT INTO messages (sender_id, receiver_id, content, file_path, image_path, receiver_type, file_hash, file_name,
+                              ts_ms, conversation_key, stems)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+    ''', (sender_id, receiver_id, content, file_path, image_path, receiver_type, file_hash, file_name,
+          ts_ms, conversation_key(receiver_type, sender_id, receiver_id), stem_text(content)))
+    return cursor.lastrowid
+
+def iter_attachment_paths(conn, after=''):
+    # Все пути из file_path и image_path, большие after, по возрастанию и без повторов
+    file_paths = (row[0] for row in conn.execute(ATTACHMENT_FILE_PATHS_SQL, (after,)))
+    image_paths = (row[0] for row in conn.execute(ATTACHMENT_IMAGE_PATHS_SQL, (after,)))
+    previous = None
+    for path in heapq.merge(file_paths, image_paths):
+        if path != previous:
+            yield path
+            previous = path
+
+def is_attachment_referenced(conn, path):
+    return conn.execute('''
+        SELECT 1 FROM messages WHERE file_path = ? OR image_path = ? LIMIT 1;
+    ''', (path, path)).fetchone() is not None
+
+def release_attachment(conn, file_hash):
+    # Удаляет строку attachments, если на блоб больше не ссылается ни одно сообщение; False — ссылки есть
+    row = conn.execute('SELECT refcount FROM attachments WHERE hash = ?;', (file_hash,)).fetchone()
+    if row is not None and row[0] > 0:
+        return False
+    conn.execute('DELETE FROM attachments WHERE hash = ?;', (file_hash,))
+    return True
+
+def get_group_members(group_id):
+    with db.read_connection() as conn:
+        members = conn.execute('''
+            SELECT users.id, users.username
+            FROM group_members
+            JOIN users ON group_members.user_id = users.id
+            WHERE group_members.group_id = ?;
+        ''', (group_id,)).fetchall()
+    return members
+
+def load_group_messages(group_id):
+    with db.read_connection() as conn:
+        messages = conn.execute(LOAD_GROUP_MESSAGES_SQL, (group_key(group_id),)).fetchall()
+    return messages
+
+def load_group_messages_since(group_id, after_id=0):
+    with db.read_connection() as conn:
+        messages = conn.execute(LOAD_GROUP_MESSAGES_SINCE_SQL, (group_key(group_id), after_id)).fetchall()
+    return messages
+
+def load_group_messages_before(group_id, before_key=None, limit=MESSAGE_PAGE_SIZE):
+    # До limit сообщений раньше before_key — message_key() сообщения, по умолчанию самые новые
+    ts_ms, message_id = before_key or MAX_MESSAGE_KEY
+    with db.read_connection() as conn:
+        messages = conn.execute(LOAD_GROUP_MESSAGES_BEFORE_SQL,
+                                (group_key(group_id), ts_ms, message_id, limit)).fetchall()
+    messages.reverse()
+    return messages
+
+def get_last_group_message_id(group_id):
+    with db.read_connection() as conn:
+        row = conn.execute(f'''
+            SELECT MAX(id) FROM messages WHERE {CONVERSATION_KEY_SQL} = ?;
+        ''', (group_key(group_id),)).fetchone()
+    return row[0]
+
+def load_group_message_ids(group_id, from_key=(0, 0)):
+    ts_ms, message_id = from_key
+    with db.read_connection() as conn:
+        rows = conn.execute(LOAD_GROUP_MESSAGE_IDS_SQL, (group_key(group_id), ts_ms, message_id)).fetchall()
+    return [row[0] for row in rows]
+
+def get_user_groups(user_id):
+    with db.read_connection() as conn:
+        groups = conn.execute('''
+            SELECT groups.id, groups.name
+            FROM group_members
+            JOIN groups ON group_members.group_id = groups.id
+            WHERE group_members.user_id = ?;
+        ''', (user_id,)).fetchall()
+    return groups
+
+def find_user(identifier):
+    with db.read_connection() as conn:
+        if identifier.isdigit():
+            user = conn.execute('SELECT id, username FROM users WHERE id = ?;', (int(identifier),)).fetchone()
+        else:
+            user = conn.execute('SELECT id, username FROM users WHERE username = ?;', (identifier,)).fetchone()
+    return user
+
+def load_messages(user_id, chat_with_id=None):
+    with db.read_connection() as conn:
+        if chat_with_id:
+            messages = conn.execute(LOAD_CHAT_MESSAGES_SQL, (chat_key(user_id, chat_with_id),)).fetchall()
+        else:
+            messages = conn.execute(LOAD_INBOX_MESSAGES_SQL, (user_id,)).fetchall()
+    return messages
+
+def load_messages_since(user_id, peer_id, after_id=0):
+    with db.read_connection() as conn:
+        messages = conn.execute(LOAD_CHAT_MESSAGES_SINCE_SQL, (chat_key(user_id, peer_id), after_id)).fetchall()
+    return messages
+
+def load_messages_before(user_id, peer_id, before_key=None, limit=MESSAGE_PAGE_SIZE):
+    ts_ms, message_id = before_key or MAX_MESSAGE_KEY
+    with db.read_connection() as conn:
+        messages = conn.execute(LOAD_CHAT_MESSAGES_BEFORE_SQL,
+                                (chat_key(user_id, peer_id), ts_ms, message_id, limit)).fetchall()
+    messages.reverse()
+    return messages
+
+def get_last_message_id(user_id, peer_id):
+    with db.read_connection() as conn:
+        row = conn.execute(f'''
+            SELECT MAX(id) FROM messages WHERE {CONVERSATION_KEY_SQL} = ? AND sender_id != receiver_id;
+        ''', (chat_key(user_id, peer_id),)).fetchone()
+    return row[0]
+
+def load_message_ids(user_id, peer_id, from_key=(0, 0)):
+    # id сообщений переписки начиная с from_key (message_key() первого показанного)
+    ts_ms, message_id = from_key
+    with db.read_connection() as conn:
+        rows = conn.execute(LOAD_CHAT_MESSAGE_IDS_SQL, (chat_key(user_id, peer_id), ts_ms, message_id)).fetchall()
+    return [row[0] for row in rows]
+
+def delete_chat_messages(user_id, peer_id):
+    with db.transaction() as conn:
+        conn.execute(f'''
+            DELETE FROM messages WHERE {CONVERSATION_KEY_SQL} = ? AND sender_id != receiver_id;
+        ''', (chat_key(user_id, peer_id),))
+
+def load_window_updates(user_id, after_id, peer_ids, group_ids):
+    # Возвращает (новая отметка, новые сообщения, последние id переписок, последние id групп).
+    # Все три запроса читают один снимок базы.
+    with db.read_connection() as conn:
+        conn.execute('BEGIN;')
+        if after_id is None:
+            after_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages;').fetchone()[0]
+        rows = conn.execute(WINDOW_UPDATES_SQL, (after_id, user_id, user_id, json.dumps(group_ids))).fetchall()
+        chat_last_ids = dict(conn.execute(WINDOW_CHAT_LAST_IDS_SQL, (user_id, json.dumps(peer_ids))).fetchall())
+        group_last_ids = dict(conn.execute(WINDOW_GROUP_LAST_IDS_SQL, (json.dumps(group_ids),)).fetchall())
+    high_water = rows[-1][7] if rows else after_id
+    return high_water, rows, chat_last_ids, group_last_ids
+
+def build_search_query(query_stems):
+    # Основы слов пользователя превращаются в префиксные термы FTS5 в кавычках: операторы и спецсимволы
+    # из ввода не интерпретируются, все слова должны встретиться (неявный AND)
+    return ' '.join(f'"{query_stem}"*' for query_stem in query_stems)
+
+def search_messages(user_id, text, cursor=None, limit=SEARCH_PAGE_SIZE):
+    # Возвращает (результаты, курсор следующей страницы или None)
+    query_stems = query_terms(text)
+    if not query_stems:
+        return [], None
+    after_rank, after_id = cursor if cursor is not None else (float('-inf'), 0)
+    with db.read_connection() as conn:
+        rows = conn.execute(
+            SEARCH_MESSAGES_SQL,
+            (build_search_query(query_stems), user_id, user_id, user_id, after_rank, after_id, limit),
+        ).fetchall()
+    next_cursor = (rows[-1][6], rows[-1][0]) if len(rows) == limit else None
+    rows = [row[:5] + (make_snippet(row[5], query_stems),) + row[6:] for row in rows]
+    return rows, next_cursor
+
+def get_chat_list(user_id):
+    with db.read_connection() as conn:
+        chats = conn.execute(CHAT_LIST_SQL, (user_id,)).fetchall()
+    return chats
+
+def get_previous_chats(user_id):
+    return [row[0] for row in get_chat_list(user_id)]
+
+def mark_chat_read(user_id, peer_id):
+    with db.transaction() as conn:
+        conn.execute('''
+            UPDATE conversations SET unread_count = 0
+            WHERE user_id = ? AND peer_id = ? AND unread_count != 0;
+        ''', (user_id, peer_id))
+
+def get_user_by_id(user_id):
+    with db.read_connection() as conn:
+        user = conn.execute('SELECT id, username FROM users WHERE id = ?;', (user_id,)).fetchone()
+    return user
+
+def get_max_message_id(conn):
+    return conn.execute('SELECT MAX(id) FROM messages;').fetchone()[0] or 0
+
+def load_relay_messages(conn, after_id, limit):
+    return conn.execute(RELAY_MESSAGES_SQL, (after_id, limit)).fetchall()
+
+def load_relay_user_messages(user_id, after_id, limit):
+    with db.read_connection() as conn:
+        return conn.execute(RELAY_USER_MESSAGES_SQL, (after_id, user_id, user_id, user_id, limit)).fetchall()
+
+def get_members_of_groups(conn, group_ids):
+    # {id группы: [id участников]} одним запросом
+    members = {group_id: [] for group_id in group_ids}
+    for group_id, user_id in conn.execute(RELAY_GROUP_MEMBERS_SQL, (json.dumps(list(group_ids)),)):
+        members[group_id].append(user_id)
+    return members
+
+def is_group_member(group_id, user_id):
+    with db.read_connection() as conn:
+        return conn.execute('''
+            SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?;
+        ''', (group_id, user_id)).fetchone() is not None
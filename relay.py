@@ -0,0 +1,551 @@
+import argparse
+import asyncio
+import heapq
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socket
+import sqlite3
+import stat
+import tempfile
+import threading
+import traceback
+from collections import defaultdict
+from operator import itemgetter
+
+import core
+import db
+import queries
+import schema
+import wire
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+POLL_INTERVAL_MS = 50
+TAIL_BATCH_SIZE = 1000
+SYNC_BATCH_SIZE = 1000
+MAX_LINE_BYTES = 64 * 1024
+MAX_WRITE_BUFFER = 1024 * 1024
+MAX_PENDING_ROWS = 10000
+READ_SIZE = 64 * 1024
+LISTEN_BACKLOG = 1024
+
+# Ретранслятор: клиенты держат соединение (TCP или Unix-сокет) и получают новые сообщения сразу,
+# вместо того чтобы каждый раз в секунду опрашивать app_database.db. Протокол — двоичный (wire.py,
+# соединение начинается с wire.MAGIC) или строки JSON с теми же командами:
+#   {"op": "auth", "username": ..., "password": ..., "after_id": N}  -> {"op": "auth_ok", "user_id", "last_id"}
+#   {"op": "send", "to": id, "type": "user"|"group", "content": ..., "ref": ...} -> {"op": "sent", "ref", "id"}
+#   сервер -> клиенту: {"op": "message", "id", "sender_id", "receiver_id", "receiver_type", "ts_ms", "content", "file_name"}
+#   ошибка: {"op": "error", "ref", "message"}
+# Рассылка идёт из одного места — хвоста таблицы messages (tail): сервер читает всё, что записано
+# после last_id, и раздаёт получателям. Так доходят и сообщения, отправленные через сервер (после записи
+# хвост будится сразу), и записанные в базу кем-то ещё — окнами приложения на этой машине (их замечает
+# проверка PRAGMA data_version раз в POLL_INTERVAL_MS). after_id в auth — последний полученный клиентом id:
+# всё пропущенное между ним и last_id придёт сразу после auth_ok, без повторов и пропусков (вперемешку
+# с новыми: порядок сообщений клиент восстанавливает по id).
+# Клиент, который не читает и у которого набралось больше MAX_WRITE_BUFFER неотправленного, отключается:
+# он догонит своё при переподключении через after_id, а остальные из-за него не ждут. Клиент двоичного
+# протокола притормаживает сервер кредитами: пока их нет, его сообщения копятся (до MAX_PENDING_ROWS)
+# и уходят пакетами BATCH.
+# Один процесс упирается в GIL, поэтому с --workers N сервер — это N процессов на одном адресе
+# (serve_workers): TCP-соединения раскладывает между ними ядро (SO_REUSEPORT), Unix-сокет у всех
+# общий. Каждый процесс читает хвост сам и рассылает только своим клиентам, так что рассылка групповых
+# сообщений делится между ядрами; о записанных сообщениях процессы извещают друг друга через Bus.
+
+class Client:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.user = None
+
+    def send(self, payload):
+        self.push(encode(payload))
+
+    def deliver(self, row, encoded):
+        # encoded — кэш закодированной строки на время рассылки: кодируется один раз на протокол
+        data = encoded.get('json')
+        if data is None:
+            data = encoded['json'] = encode_message(row)
+        self.push(data)
+
+    def deliver_rows(self, rows):
+        for row in rows:
+            self.push(encode_message(row))
+
+    def grant(self, credits):
+        # В JSON-протоколе кредитов нет: клиента ограничивает только MAX_WRITE_BUFFER
+        pass
+
+    def push(self, data):
+        transport = self.writer.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            transport.abort()
+            return
+        self.writer.write(data)
+
+class WireClient(Client):
+
+    def __init__(self, reader, writer):
+        super().__init__(reader, writer)
+        self.credits = 0
+        self.pending = []
+
+    def send(self, payload):
+        self.push(wire.encode_request(payload))
+
+    def deliver(self, row, encoded):
+        if not self.credits or self.pending:
+            self.deliver_rows([row])
+            return
+        data = encoded.get('wire')
+        if data is None:
+            data = encoded['wire'] = wire.encode_message(row)
+        self.credits -= 1
+        self.push(data)
+
+    def deliver_rows(self, rows):
+        # Очередь держится по возрастанию id без повторов: id в кадре BATCH только растут, а строки хвоста
+        # могут попасть в неё раньше ещё не прочитанных пакетов догона
+        if self.pending and rows and rows[0][0] <= self.pending[-1][0]:
+            merged = []
+            for row in heapq.merge(self.pending, rows, key=itemgetter(0)):
+                if not merged or row[0] != merged[-1][0]:
+                    merged.append(row)
+            self.pending = merged
+        else:
+            self.pending.extend(rows)
+        self.flush()
+
+    def grant(self, credits):
+        self.credits += credits
+        self.flush()
+
+    def flush(self):
+        while self.credits and self.pending:
+            batch = self.pending[:wire.BATCH_MAX_ROWS]
+            del self.pending[:wire.BATCH_MAX_ROWS]
+            self.credits -= 1
+            self.push(wire.encode_batch(batch) if len(batch) > 1 else wire.encode_message(batch[0]))
+        if len(self.pending) > MAX_PENDING_ROWS:
+            self.writer.transport.abort()
+
+def encode(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+def encode_message(row):
+    message_id, sender_id, receiver_id, receiver_type, ts_ms, content, file_name = row
+    return encode({
+        'op': 'message', 'id': message_id, 'sender_id': sender_id, 'receiver_id': receiver_id,
+        'receiver_type': receiver_type, 'ts_ms': ts_ms, 'content': content, 'file_name': file_name,
+    })
+
+def request_credits(request):
+    # Кредиты из auth и credit; без поля — 0, отрицательные не отнимают уже выданные
+    credits = request.get('credits')
+    if credits is None:
+        return 0
+    if not isinstance(credits, int):
+        raise core.InvalidInput("Некорректное число кредитов.")
+    return max(credits, 0)
+
+class Bus(asyncio.DatagramProtocol):
+    # Канал между рабочими процессами: у каждого свой Unix-сокет дейтаграмм в общем каталоге.
+    # Сами сообщения по нему не ходят — все процессы читают их из одной базы. Процесс, записавший
+    # сообщения, рассылает остальным свой последний id (varint), и их хвосты просыпаются сразу, не дожидаясь
+    # проверки data_version. Потерянное извещение ничего не ломает: его заменит следующий опрос.
+
+    def __init__(self, directory, index, count):
+        self.paths = [os.path.join(directory, f'{number}.sock') for number in range(count)]
+        self.index = index
+        self.transport = None
+        self.on_notify = None
+        self.published = 0
+        self.scheduled = False
+
+    async def start(self, on_notify):
+        self.on_notify = on_notify
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=self.paths[self.index], family=socket.AF_UNIX)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def publish(self, last_id):
+        # Все отправки за один проход цикла событий уходят одной дейтаграммой каждому соседу
+        self.published = max(self.published, last_id)
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        data = bytearray()
+        wire.write_varint(data, self.published)
+        data = bytes(data)
+        for number, path in enumerate(self.paths):
+            if number != self.index:
+                self.transport.sendto(data, path)
+
+    def datagram_received(self, data, addr):
+        try:
+            last_id, _ = wire.read_varint(data, 0)
+        except wire.ProtocolError:
+            return
+        if last_id is not None:
+            self.on_notify(last_id)
+
+    def error_received(self, exc):
+        # Сосед ещё не запустился или уже вышел
+        pass
+
+class Relay:
+
+    def __init__(self, poll_interval_ms=POLL_INTERVAL_MS, bus=None):
+        self.poll_interval = poll_interval_ms / 1000
+        self.bus = bus
+        self.clients = defaultdict(set)
+        self.last_id = 0
+        self.version = None
+        self.conn = None
+        self.wakeup = None
+        self.servers = []
+        self.tail_task = None
+        self.closing = False
+        self.connections = {}
+
+    async def start(self, host=DEFAULT_HOST, port=None, unix_path=None, unix_sock=None, reuse_port=False):
+        # Слушать TCP (port), Unix-сокет (unix_path или уже открытый unix_sock) или оба сразу
+        self.wakeup = asyncio.Event()
+        # Своё соединение: хвост читается в отдельном потоке, data_version на нём меняют чужие фиксации
+        self.conn = db.dedicated_connection()
+        self.last_id = await asyncio.to_thread(queries.get_max_message_id, self.conn)
+        if self.bus is not None:
+            await self.bus.start(self.notify)
+        if unix_sock is not None:
+            self.servers.append(await asyncio.start_unix_server(self.handle, sock=unix_sock, limit=MAX_LINE_BYTES))
+        elif unix_path is not None:
+            self.servers.append(await asyncio.start_unix_server(self.handle, unix_path, limit=MAX_LINE_BYTES))
+        if port is not None:
+            self.servers.append(await asyncio.start_server(
+                self.handle, host, port, limit=MAX_LINE_BYTES, reuse_port=reuse_port or None,
+                backlog=LISTEN_BACKLOG))
+        self.tail_task = asyncio.create_task(self.tail())
+
+    def addresses(self):
+        return [sock.getsockname() for server in self.servers for sock in server.sockets]
+
+    async def close(self):
+        # Новые соединения больше не принимаются, открытые рвутся, и их обработчики завершаются сами
+        for server in self.servers:
+            server.close()
+        for writer in self.connections.values():
+            writer.transport.abort()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        if self.tail_task is not None:
+            # Не cancel(): в 3.11 wait_for теряет отмену, если событие выставлено в тот же момент,
+            # и хвост крутится дальше. Флаг хвост проверит на следующем проходе
+            self.closing = True
+            self.wakeup.set()
+            await self.tail_task
+        if self.bus is not None:
+            self.bus.close()
+
+    async def handle(self, reader, writer):
+        client = None
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            head = await reader.readexactly(1)
+            if head == wire.MAGIC[:1]:
+                if await reader.readexactly(len(wire.MAGIC) - 1) != wire.MAGIC[1:]:
+                    return
+                client = WireClient(reader, writer)
+                await self.serve_wire(client)
+            else:
+                client = Client(reader, writer)
+                await self.serve_json(client, head)
+        except (ConnectionError, asyncio.LimitOverrunError, asyncio.IncompleteReadError, ValueError):
+            # ValueError — в том числе wire.ProtocolError и испорченный UTF-8
+            pass
+        finally:
+            if client is not None and client.user is not None:
+                connections = self.clients[client.user.id]
+                connections.discard(client)
+                if not connections:
+                    del self.clients[client.user.id]
+            del self.connections[task]
+            writer.close()
+
+    async def serve_json(self, client, head):
+        line = head + await client.reader.readline()
+        while line:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                client.send({'op': 'error', 'message': "Некорректный запрос."})
+                return
+            await self.dispatch(client, request)
+            line = await client.reader.readline()
+
+    async def serve_wire(self, client):
+        frames = wire.FrameReader()
+        while True:
+            data = await client.reader.read(READ_SIZE)
+            if not data:
+                return
+            frames.feed(data)
+            for frame_type, payload in frames.frames():
+                await self.dispatch(client, wire.decode_request(frame_type, payload))
+
+    async def dispatch(self, client, request):
+        if not isinstance(request, dict):
+            client.send({'op': 'error', 'message': "Некорректный запрос."})
+            return
+        op = request.get('op')
+        ref = request.get('ref')
+        try:
+            if op == 'auth':
+                await self.authenticate(client, request)
+            elif client.user is None:
+                raise core.InvalidCredentials("Сначала нужно войти.")
+            elif op == 'send':
+                message_id = await self.send_message(client.user, request)
+                client.send({'op': 'sent', 'ref': ref, 'id': message_id})
+            elif op == 'credit':
+                client.grant(request_credits(request))
+            else:
+                raise core.InvalidInput(f"Неизвестная команда: {op}")
+        except (core.CoreError, sqlite3.Error) as error:
+            client.send({'op': 'error', 'ref': ref, 'message': str(error)})
+
+    async def authenticate(self, client, request):
+        credits = request_credits(request)
+        user = await asyncio.to_thread(core.login, str(request.get('username', '')), str(request.get('password', '')))
+        if client.user is not None:
+            self.clients[client.user.id].discard(client)
+        client.user = user
+        # После регистрации клиента всё новее last_id придёт из хвоста; пропущенное до last_id — отсюда
+        self.clients[user.id].add(client)
+        upto = self.last_id
+        client.send({'op': 'auth_ok', 'user_id': user.id, 'last_id': upto})
+        client.grant(credits)
+        after_id = request.get('after_id')
+        while isinstance(after_id, int) and after_id < upto:
+            rows = await asyncio.to_thread(queries.load_relay_user_messages, user.id, after_id, SYNC_BATCH_SIZE)
+            client.deliver_rows([row for row in rows if row[0] <= upto])
+            if len(rows) < SYNC_BATCH_SIZE or rows[-1][0] >= upto:
+                return
+            after_id = rows[-1][0]
+
+    async def send_message(self, user, request):
+        receiver_type = request.get('type', 'user')
+        if receiver_type not in ('user', 'group'):
+            raise core.InvalidInput(f"Неизвестный тип получателя: {receiver_type}")
+        receiver_id = request.get('to')
+        if not isinstance(receiver_id, int):
+            raise core.InvalidInput("Не указан получатель.")
+        if receiver_type == 'group' and not await asyncio.to_thread(queries.is_group_member, receiver_id, user.id):
+            raise core.InvalidInput("Вы не состоите в этой группе.")
+        future = core.send_message(user.id, receiver_id, str(request.get('content') or ''), receiver_type=receiver_type)
+        message_id = await asyncio.wrap_future(future)
+        self.wakeup.set()
+        if self.bus is not None:
+            self.bus.publish(message_id)
+        return message_id
+
+    def notify(self, last_id):
+        # Извещение от другого рабочего процесса: в базе есть сообщения до last_id
+        if last_id > self.last_id:
+            self.wakeup.set()
+
+    async def tail(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                rows, members = await asyncio.to_thread(self.read_new)
+            except sqlite3.Error:
+                traceback.print_exc()
+                continue
+            if len(rows) == TAIL_BATCH_SIZE:
+                # Осталось ещё: следующий проход сразу
+                self.wakeup.set()
+            # Между чтением и рассылкой других корутин нет: клиент, вошедший после этой точки,
+            # получит эти сообщения из догоняющей выборки в authenticate, а не отсюда
+            self.fan_out(rows, members)
+
+    def read_new(self):
+        # Выполняется в рабочем потоке. Пока data_version не изменился, таблицы не читаются
+        version = self.conn.execute('PRAGMA data_version;').fetchone()[0]
+        if version == self.version:
+            return [], {}
+        rows = queries.load_relay_messages(self.conn, self.last_id, TAIL_BATCH_SIZE)
+        if len(rows) < TAIL_BATCH_SIZE:
+            # Прочитано не всё — версию не запоминаем, чтобы следующий проход дочитал
+            self.version = version
+        group_ids = {row[2] for row in rows if row[3] == 'group'}
+        members = queries.get_members_of_groups(self.conn, group_ids) if group_ids else {}
+        return rows, members
+
+    def fan_out(self, rows, members):
+        for row in rows:
+            message_id, sender_id, receiver_id, receiver_type = row[:4]
+            if receiver_type == 'group':
+                recipients = members.get(receiver_id, ())
+            else:
+                recipients = (sender_id,) if sender_id == receiver_id else (sender_id, receiver_id)
+            encoded = {}
+            for user_id in recipients:
+                for client in self.clients.get(user_id, ()):
+                    client.deliver(row, encoded)
+            self.last_id = message_id
+
+async def wait_for_stop():
+    # SIGTERM останавливает сервер штатно, как и Ctrl+C: соединения закрываются,
+    # очередь отправки дописывает принятое
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    await stop.wait()
+
+async def serve(host, port, unix_path):
+    relay = Relay()
+    await relay.start(host, port, unix_path)
+    print("Ретранслятор слушает:", ", ".join(str(address) for address in relay.addresses()), flush=True)
+    try:
+        await wait_for_stop()
+    finally:
+        await relay.close()
+
+async def serve_worker(index, count, bus_dir, host, port, unix_sock, ready):
+    relay = Relay(bus=Bus(bus_dir, index, count))
+    await relay.start(host, port, unix_sock=unix_sock, reuse_port=True)
+    ready.put(index)
+    try:
+        await wait_for_stop()
+    finally:
+        await relay.close()
+
+def run_worker(index, count, bus_dir, host, port, unix_sock, ready):
+    # Рабочий процесс (fork из serve_workers): база уже выбрана и обновлена родителем
+    try:
+        asyncio.run(serve_worker(index, count, bus_dir, host, port, unix_sock, ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        core.shutdown()
+
+def listen_unix(path):
+    # SO_REUSEPORT для Unix-сокетов не работает: слушающий сокет один на всех, accept делят процессы
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+def reserve_port(host):
+    # Порт 0: свободный порт выбирается здесь, чтобы все процессы слушали один и тот же
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, 0))
+    return sock
+
+def exit_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+def serve_workers(host, port, unix_path, count, database=None):
+    # Родитель только запускает рабочих и ждёт их; SIGTERM ему — как Ctrl+C, рабочим он передаёт его сам
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    if database is not None:
+        db.configure(database)
+    # Схема обновляется до fork, и соединения закрываются: открытое соединение sqlite
+    # нельзя переносить через fork
+    schema.migrate()
+    db.close_all()
+    context = multiprocessing.get_context('fork')
+    unix_sock = listen_unix(unix_path) if unix_path is not None else None
+    port_sock = None
+    if port == 0:
+        port_sock = reserve_port(host)
+        port = port_sock.getsockname()[1]
+    bus_dir = tempfile.mkdtemp(prefix='relay-bus-')
+    ready = context.Queue()
+    workers = [
+        context.Process(target=run_worker, args=(index, count, bus_dir, host, port, unix_sock, ready),
+                        name=f'relay-{index}')
+        for index in range(count)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        started = 0
+        while started < count:
+            try:
+                ready.get(timeout=1)
+                started += 1
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError("Рабочий процесс ретранслятора завершился при запуске.") from None
+        if port_sock is not None:
+            port_sock.close()
+        addresses = ([unix_path] if unix_path is not None else []) + ([(host, port)] if port is not None else [])
+        print("Ретранслятор слушает:", ", ".join(str(address) for address in addresses),
+              f"(рабочих процессов: {count})", flush=True)
+        threading.Thread(target=schema.backfill_conversation_key, name='backfill-keys', daemon=True).start()
+        threading.Thread(target=schema.backfill_message_clock, name='backfill', daemon=True).start()
+        threading.Thread(target=schema.backfill_message_stems, name='backfill-stems', daemon=True).start()
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Сигнал часто приходит всей группе процессов сразу: повторный не должен прервать ожидание рабочих
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            if worker.pid is not None:
+                worker.join()
+        if unix_sock is not None:
+            unix_sock.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+        db.close_all()
+
+def main():
+    parser = argparse.ArgumentParser(description="Ретранслятор сообщений с доставкой подключённым клиентам")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=None, help=f"порт TCP (по умолчанию {DEFAULT_PORT}, если не задан --unix)")
+    parser.add_argument('--unix', default=None, help="путь Unix-сокета")
+    parser.add_argument('--database', default=None, help="файл базы вместо app_database.db")
+    parser.add_argument('--workers', type=int, default=1, help="число рабочих процессов")
+    args = parser.parse_args()
+
+    port = args.port if args.port is not None or args.unix else DEFAULT_PORT
+    if args.workers > 1:
+        serve_workers(args.host, port, args.unix, args.workers, args.database)
+        return
+    core.start(args.database)
+    try:
+        asyncio.run(serve(args.host, port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        core.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,697 @@
+import time
+
+import db
+import stemmer
+
+BACKFILL_BATCH_SIZE = 5000
+BACKFILL_PAUSE_S = 0.05
+
+def _create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        );
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            content TEXT,
+            file_path TEXT,
+            image_path TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            receiver_type TEXT DEFAULT 'user',
+            FOREIGN KEY (sender_id) REFERENCES users(id),
+            FOREIGN KEY (receiver_id) REFERENCES users(id)
+        );
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
+        );
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (group_id) REFERENCES groups(id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            CONSTRAINT pk_group_members PRIMARY KEY (group_id, user_id)
+        );
+    ''')
+
+def _add_message_indexes(conn):
+    # Групповые сообщения и входящие: WHERE receiver_type = ? AND receiver_id = ? ORDER BY timestamp
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_receiver
+        ON messages (receiver_type, receiver_id, timestamp);
+    ''')
+    # Переписка двух пользователей и исходящие для списка чатов: WHERE receiver_type = ? AND sender_id = ? [AND receiver_id = ?]
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_pair
+        ON messages (receiver_type, sender_id, receiver_id, timestamp);
+    ''')
+    # Входящие для списка чатов: WHERE receiver_type = ? AND receiver_id = ? GROUP BY sender_id
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_receiver_sender
+        ON messages (receiver_type, receiver_id, sender_id, timestamp);
+    ''')
+
+def _create_conversations(conn):
+    # Материализованный список чатов: по строке на каждого участника переписки (user_id, peer_id).
+    # Поддерживается триггерами, поэтому любой код, пишущий в messages, обновляет его в той же транзакции.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_timestamp DATETIME,
+            last_preview TEXT,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id)
+        ) WITHOUT ROWID;
+    ''')
+    # Список чатов больше не собирается из messages, индекс по исходящим ему не нужен
+    conn.execute('DROP INDEX IF EXISTS idx_messages_pair;')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_recent
+        ON conversations (user_id, last_message_id);
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_message_insert
+        AFTER INSERT ON messages
+        WHEN NEW.receiver_type = 'user' AND NEW.sender_id != NEW.receiver_id
+        BEGIN
+            INSERT INTO conversations (user_id, peer_id, last_message_id, last_timestamp, last_preview, unread_count)
+            VALUES (NEW.sender_id, NEW.receiver_id, NEW.id, NEW.timestamp, substr(COALESCE(NEW.content, ''), 1, 100), 0)
+            ON CONFLICT (user_id, peer_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_timestamp = excluded.last_timestamp,
+                last_preview = excluded.last_preview;
+
+            INSERT INTO conversations (user_id, peer_id, last_message_id, last_timestamp, last_preview, unread_count)
+            VALUES (NEW.receiver_id, NEW.sender_id, NEW.id, NEW.timestamp, substr(COALESCE(NEW.content, ''), 1, 100), 1)
+            ON CONFLICT (user_id, peer_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_timestamp = excluded.last_timestamp,
+                last_preview = excluded.last_preview,
+                unread_count = unread_count + 1;
+        END;
+    ''')
+
+    # Пересчёт нужен, только если удалено последнее сообщение переписки
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_message_delete
+        AFTER DELETE ON messages
+        WHEN OLD.receiver_type = 'user' AND OLD.sender_id != OLD.receiver_id
+        BEGIN
+            UPDATE conversations
+            SET (last_message_id, last_timestamp, last_preview) = (
+                SELECT id, timestamp, substr(COALESCE(content, ''), 1, 100)
+                FROM messages
+                WHERE id = (
+                    SELECT MAX(id) FROM messages
+                    WHERE receiver_type = 'user'
+                    AND ((sender_id = OLD.sender_id AND receiver_id = OLD.receiver_id)
+                      OR (sender_id = OLD.receiver_id AND receiver_id = OLD.sender_id))
+                )
+            )
+            WHERE last_message_id = OLD.id
+            AND ((user_id = OLD.sender_id AND peer_id = OLD.receiver_id)
+              OR (user_id = OLD.receiver_id AND peer_id = OLD.sender_id));
+
+            DELETE FROM conversations
+            WHERE last_message_id IS NULL
+            AND ((user_id = OLD.sender_id AND peer_id = OLD.receiver_id)
+              OR (user_id = OLD.receiver_id AND peer_id = OLD.sender_id));
+        END;
+    ''')
+
+    conn.execute('''
+        INSERT OR IGNORE INTO conversations (user_id, peer_id, last_message_id, last_timestamp, last_preview)
+        SELECT pairs.user_id, pairs.peer_id, messages.id, messages.timestamp, substr(COALESCE(messages.content, ''), 1, 100)
+        FROM (
+            SELECT user_id, peer_id, MAX(last_id) AS last_id
+            FROM (
+                SELECT sender_id AS user_id, receiver_id AS peer_id, MAX(id) AS last_id
+                FROM messages
+                WHERE receiver_type = 'user' AND sender_id != receiver_id
+                GROUP BY sender_id, receiver_id
+                UNION ALL
+                SELECT receiver_id, sender_id, MAX(id)
+                FROM messages
+                WHERE receiver_type = 'user' AND sender_id != receiver_id
+                GROUP BY receiver_id, sender_id
+            )
+            GROUP BY user_id, peer_id
+        ) AS pairs
+        JOIN messages ON messages.id = pairs.last_id;
+    ''')
+
+def _add_keyset_indexes(conn):
+    # Курсорная подгрузка идёт по id: в конце индекса неявно лежит rowid, поэтому
+    # условие id > ? / id < ? становится диапазоном внутри той же переписки
+    conn.execute('DROP INDEX IF EXISTS idx_messages_receiver;')
+    conn.execute('DROP INDEX IF EXISTS idx_messages_receiver_sender;')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_receiver_id
+        ON messages (receiver_type, receiver_id);
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (receiver_type, receiver_id, sender_id);
+    ''')
+
+def _create_message_search(conn):
+    # Полнотекстовый поиск по основам слов: «сообщение», «сообщения», «сообщений» дают одну основу.
+    # Основы (stemmer.stem_text) пишет в messages.stems код, вставляющий сообщение, индекс строится
+    # по этому столбцу (external content, rowid = messages.id). Триггеры — чистый SQL: писать в messages
+    # может и соединение без Python-функций, а удаление берёт сохранённые основы, а не считает их заново.
+    # Основы старых строк и строк, записанных без них, заполняет backfill_message_stems; частичный
+    # индекс — очередь незаполненных строк. До конца заполнения поиск их не находит.
+    conn.execute('ALTER TABLE messages ADD COLUMN stems TEXT;')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_stems_backfill
+        ON messages (id) WHERE stems IS NULL;
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_stems USING fts5(
+            stems, content = 'messages', content_rowid = 'id'
+        );
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_stems_insert AFTER INSERT ON messages
+        WHEN NEW.stems IS NOT NULL
+        BEGIN
+            INSERT INTO messages_stems (rowid, stems) VALUES (NEW.id, NEW.stems);
+        END;
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_stems_delete AFTER DELETE ON messages
+        WHEN OLD.stems IS NOT NULL
+        BEGIN
+            INSERT INTO messages_stems (messages_stems, rowid, stems) VALUES ('delete', OLD.id, OLD.stems);
+        END;
+    ''')
+    # Изменённый текст теряет основы и снова попадает в очередь backfill_message_stems
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_stems_content_update AFTER UPDATE OF content ON messages
+        WHEN NEW.content IS NOT OLD.content AND NEW.stems IS OLD.stems AND NEW.stems IS NOT NULL
+        BEGIN
+            UPDATE messages SET stems = NULL WHERE id = NEW.id;
+        END;
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_stems_update AFTER UPDATE OF stems ON messages
+        BEGIN
+            INSERT INTO messages_stems (messages_stems, rowid, stems)
+            SELECT 'delete', OLD.id, OLD.stems WHERE OLD.stems IS NOT NULL;
+            INSERT INTO messages_stems (rowid, stems)
+            SELECT NEW.id, NEW.stems WHERE NEW.stems IS NOT NULL;
+        END;
+    ''')
+    # Поиск ограничивается группами пользователя: WHERE user_id = ? без прохода по всем участникам
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_group_members_user
+        ON group_members (user_id, group_id);
+    ''')
+
+def _create_attachments(conn):
+    # Вложения хранятся по хешу содержимого (attachments.py): сообщение ссылается на блоб через file_hash,
+    # file_name — исходное имя для показа и сохранения. refcount ведут триггеры на вставку и удаление сообщений;
+    # строку attachments создаёт insert_message до вставки сообщения.
+    conn.execute('ALTER TABLE messages ADD COLUMN file_hash TEXT;')
+    conn.execute('ALTER TABLE messages ADD COLUMN file_name TEXT;')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID;
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS attachments_message_insert AFTER INSERT ON messages
+        WHEN NEW.file_hash IS NOT NULL
+        BEGIN
+            UPDATE attachments SET refcount = refcount + 1 WHERE hash = NEW.file_hash;
+        END;
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS attachments_message_delete AFTER DELETE ON messages
+        WHEN OLD.file_hash IS NOT NULL
+        BEGIN
+            UPDATE attachments SET refcount = refcount - 1 WHERE hash = OLD.file_hash;
+        END;
+    ''')
+
+def _add_attachment_path_indexes(conn):
+    # Сборщик неиспользуемых вложений (attachment_gc.py) сливает отсортированный список файлов
+    # с отсортированными путями из сообщений; частичные индексы содержат только сообщения с вложениями
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_file_path
+        ON messages (file_path) WHERE file_path IS NOT NULL;
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_image_path
+        ON messages (image_path) WHERE image_path IS NOT NULL;
+    ''')
+
+def _add_message_clock(conn):
+    # Целое время в миллисекундах (clock.now_ms) вместо текста CURRENT_TIMESTAMP с точностью до секунды.
+    # Старые строки заполняет backfill_message_clock по частям уже после миграции: одним UPDATE
+    # большая таблица держала бы блокировку записи минутами. Частичный индекс — очередь незаполненных строк.
+    conn.execute('ALTER TABLE messages ADD COLUMN ts_ms INTEGER;')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_ts_backfill
+        ON messages (id) WHERE ts_ms IS NULL;
+    ''')
+
+def _add_conversation_key(conn):
+    # Одна переписка — одно целое число (queries.conversation_key): пара пользователей
+    # (меньший id << 32 | больший id) или группа (-id группы). Вместо OR двух пар или UNION ALL
+    # двух поисков любая выборка переписки — один диапазон индекса (conversation_key, id).
+    # Старые строки заполняет backfill_conversation_key по частям, как ts_ms; частичный индекс — очередь
+    # незаполненных строк. Индексы построены по выражению queries.CONVERSATION_KEY_SQL: до заполнения
+    # ключ строки вычисляется из отправителя и получателя, и выборки находят её сразу, не дожидаясь backfill.
+    # Так же ищет новое последнее сообщение триггер удаления: у OLD ключ может быть ещё не заполнен.
+    conn.execute('ALTER TABLE messages ADD COLUMN conversation_key INTEGER;')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_key_backfill
+        ON messages (id) WHERE conversation_key IS NULL;
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_key
+        ON messages (COALESCE(conversation_key, CASE WHEN receiver_type = 'group' THEN -receiver_id
+            ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id) END));
+    ''')
+    # Переписка двух пользователей больше не ищется по (receiver_id, sender_id)
+    conn.execute('DROP INDEX IF EXISTS idx_messages_conversation;')
+    conn.execute('DROP TRIGGER IF EXISTS conversations_message_delete;')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_message_delete
+        AFTER DELETE ON messages
+        WHEN OLD.receiver_type = 'user' AND OLD.sender_id != OLD.receiver_id
+        BEGIN
+            UPDATE conversations
+            SET (last_message_id, last_timestamp, last_preview) = (
+                SELECT id, timestamp, substr(COALESCE(content, ''), 1, 100)
+                FROM messages
+                WHERE id = (
+                    SELECT MAX(id) FROM messages
+                    WHERE COALESCE(conversation_key, CASE WHEN receiver_type = 'group' THEN -receiver_id
+                        ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id) END)
+                        = COALESCE(OLD.conversation_key, (min(OLD.sender_id, OLD.receiver_id) << 32) | max(OLD.sender_id, OLD.receiver_id))
+                )
+            )
+            WHERE last_message_id = OLD.id
+            AND ((user_id = OLD.sender_id AND peer_id = OLD.receiver_id)
+              OR (user_id = OLD.receiver_id AND peer_id = OLD.sender_id));
+
+            DELETE FROM conversations
+            WHERE last_message_id IS NULL
+            AND ((user_id = OLD.sender_id AND peer_id = OLD.receiver_id)
+              OR (user_id = OLD.receiver_id AND peer_id = OLD.sender_id));
+        END;
+    ''')
+
+def _create_change_log(conn):
+    # Журнал изменений для синхронизации нескольких баз (sync.py). У базы свой идентификатор (site),
+    # каждое изменение users, groups, group_members и messages записывается триггером в change_log
+    # с парой (origin, seq): база, где оно сделано, и её порядковый номер. Чужие изменения sync.py
+    # кладёт в журнал с их исходными (origin, seq), пока sync_state.applying = 1 — триггеры в это время
+    # молчат. sync_origins — последний seq каждой базы, известный здесь: по нему другая сторона отдаёт
+    # только то, чего здесь ещё нет.
+    # Локальные id в разных базах разные, поэтому строки в журнале названы глобально: gid = 'site:seq'
+    # записи о вставке. sync_rows сопоставляет gid и локальный id; при удалении строки сопоставление
+    # уходит вместе с ней, и повторно выданный SQLite id не спутается со старым.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            site TEXT NOT NULL,
+            applying INTEGER NOT NULL DEFAULT 0
+        );
+    ''')
+    conn.execute("INSERT INTO sync_state (site) VALUES (lower(hex(randomblob(8))));")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_origins (
+            origin TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+    conn.execute('INSERT INTO sync_origins (origin, seq) SELECT site, 0 FROM sync_state;')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            id INTEGER PRIMARY KEY,
+            origin TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            tbl TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_gid TEXT NOT NULL,
+            ref_gid TEXT,
+            UNIQUE (origin, seq)
+        );
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_rows (
+            gid TEXT PRIMARY KEY,
+            tbl TEXT NOT NULL,
+            local_id INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sync_rows_local
+        ON sync_rows (tbl, local_id);
+    ''')
+    conn.execute('''
+        CREATE VIEW IF NOT EXISTS sync_local AS
+        SELECT site, seq FROM sync_state JOIN sync_origins ON origin = site;
+    ''')
+
+    # Уже существующие строки попадают в журнал как вставки этой базы: users и groups раньше
+    # group_members и messages, которые на них ссылаются
+    for table in ('users', 'groups'):
+        _seed_change_log(conn, table)
+    conn.execute('''
+        INSERT INTO change_log (origin, seq, tbl, op, row_gid, ref_gid)
+        SELECT site, seq + ROW_NUMBER() OVER (ORDER BY group_id, user_id), 'group_members', 'insert', g.gid, u.gid
+        FROM group_members
+        JOIN sync_rows AS g ON g.tbl = 'groups' AND g.local_id = group_id
+        JOIN sync_rows AS u ON u.tbl = 'users' AND u.local_id = user_id, sync_local
+        ORDER BY group_id, user_id;
+    ''')
+    _bump_local_seq(conn)
+    _seed_change_log(conn, 'messages')
+
+    for table in ('users', 'groups', 'messages'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_insert AFTER INSERT ON {table}
+            WHEN (SELECT applying FROM sync_state) = 0
+            BEGIN
+                UPDATE sync_origins SET seq = seq + 1 WHERE origin = (SELECT site FROM sync_state);
+                INSERT INTO sync_rows (gid, tbl, local_id) SELECT site || ':' || seq, '{table}', NEW.id FROM sync_local;
+                INSERT INTO change_log (origin, seq, tbl, op, row_gid)
+                SELECT site, seq, '{table}', 'insert', site || ':' || seq FROM sync_local;
+            END;
+        ''')
+    for table in ('groups', 'messages'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_delete AFTER DELETE ON {table}
+            WHEN (SELECT applying FROM sync_state) = 0
+            BEGIN
+                UPDATE sync_origins SET seq = seq + 1 WHERE origin = (SELECT site FROM sync_state);
+                INSERT INTO change_log (origin, seq, tbl, op, row_gid)
+                SELECT site, seq, '{table}', 'delete', gid
+                FROM sync_local, sync_rows WHERE sync_rows.tbl = '{table}' AND local_id = OLD.id;
+                DELETE FROM sync_rows WHERE tbl = '{table}' AND local_id = OLD.id;
+            END;
+        ''')
+    # Один пользователь может носить несколько gid: одноимённые учётные записи разных баз сливаются
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS sync_users_update AFTER UPDATE OF username, password ON users
+        WHEN (SELECT applying FROM sync_state) = 0
+        BEGIN
+            UPDATE sync_origins SET seq = seq + 1 WHERE origin = (SELECT site FROM sync_state);
+            INSERT INTO change_log (origin, seq, tbl, op, row_gid)
+            SELECT site, seq, 'users', 'update', gid
+            FROM sync_local, (SELECT gid FROM sync_rows WHERE tbl = 'users' AND local_id = NEW.id LIMIT 1);
+        END;
+    ''')
+    for event, row in (('insert', 'NEW'), ('delete', 'OLD')):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS sync_group_members_{event} AFTER {event.upper()} ON group_members
+            WHEN (SELECT applying FROM sync_state) = 0
+            BEGIN
+                UPDATE sync_origins SET seq = seq + 1 WHERE origin = (SELECT site FROM sync_state);
+                INSERT INTO change_log (origin, seq, tbl, op, row_gid, ref_gid)
+                SELECT site, seq, 'group_members', '{event}', g.gid, u.gid
+                FROM sync_local,
+                    (SELECT gid FROM sync_rows WHERE tbl = 'groups' AND local_id = {row}.group_id) AS g,
+                    (SELECT gid FROM sync_rows WHERE tbl = 'users' AND local_id = {row}.user_id LIMIT 1) AS u;
+            END;
+        ''')
+
+def _seed_change_log(conn, table):
+    conn.execute(f'''
+        INSERT INTO sync_rows (gid, tbl, local_id)
+        SELECT site || ':' || (seq + ROW_NUMBER() OVER (ORDER BY id)), '{table}', id FROM {table}, sync_local;
+    ''')
+    conn.execute(f'''
+        INSERT INTO change_log (origin, seq, tbl, op, row_gid)
+        SELECT site, seq + ROW_NUMBER() OVER (ORDER BY id), '{table}', 'insert',
+               site || ':' || (seq + ROW_NUMBER() OVER (ORDER BY id))
+        FROM {table}, sync_local
+        ORDER BY id;
+    ''')
+    _bump_local_seq(conn)
+
+def _bump_local_seq(conn):
+    conn.execute('''
+        UPDATE sync_origins SET seq = (SELECT COALESCE(MAX(seq), 0) FROM change_log WHERE origin = sync_origins.origin)
+        WHERE origin = (SELECT site FROM sync_state);
+    ''')
+
+def _add_message_time_order(conn):
+    # Сообщения показываются по времени отправки, а не по id: id — порядок записи в эту базу, и сообщение,
+    # пришедшее синхронизацией (sync.py) или записанное другим процессом ретранслятора, получает id позже
+    # уже записанных, хотя отправлено раньше. Порядок — (время, id), индексы заканчиваются временем,
+    # id в конце индекса лежит неявно (rowid). Время — выражение queries.MESSAGE_TIME_SQL, а не столбец
+    # ts_ms: у строк, до которых ещё не дошёл backfill_message_clock, оно берётся из timestamp, то же
+    # значение потом записывает backfill, и строка не меняет места в индексе. Ключ переписки — так же
+    # выражение queries.CONVERSATION_KEY_SQL (_add_conversation_key). Запросы должны использовать
+    # те же выражения, иначе SQLite не узнает индекс.
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_time
+        ON messages (
+            COALESCE(conversation_key, CASE WHEN receiver_type = 'group' THEN -receiver_id
+                ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id) END),
+            COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0)
+        );
+    ''')
+    # Входящие пользователя: WHERE receiver_type = 'user' AND receiver_id = ? по времени
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_receiver_time
+        ON messages (receiver_type, receiver_id, COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0));
+    ''')
+    conn.execute('DROP INDEX IF EXISTS idx_messages_receiver_id;')
+
+def _order_conversations_by_time(conn):
+    # Последнее сообщение переписки в списке чатов — самое позднее по (время, id), как в окне чата,
+    # а не последнее записанное: синхронизированное старое сообщение не должно становиться «последним».
+    # last_ts_ms хранит его время, по нему же сортируется список.
+    conn.execute('ALTER TABLE conversations ADD COLUMN last_ts_ms INTEGER;')
+    conn.execute('''
+        UPDATE conversations SET last_ts_ms = (
+            SELECT COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0)
+            FROM messages WHERE id = last_message_id
+        );
+    ''')
+    # Переписки, где уже есть более позднее по времени сообщение, чем последнее записанное
+    conn.execute('''
+        UPDATE conversations
+        SET (last_message_id, last_timestamp, last_preview, last_ts_ms) = (
+            SELECT id, timestamp, substr(COALESCE(content, ''), 1, 100),
+                   COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0)
+            FROM messages
+            WHERE COALESCE(conversation_key, CASE WHEN receiver_type = 'group' THEN -receiver_id
+                ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id) END)
+                = (min(user_id, peer_id) << 32 | max(user_id, peer_id))
+            ORDER BY COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0) DESC, id DESC
+            LIMIT 1
+        )
+        WHERE EXISTS (
+            SELECT 1 FROM messages
+            WHERE COALESCE(conversation_key, CASE WHEN receiver_type = 'group' THEN -receiver_id
+                ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id) END)
+                = (min(user_id, peer_id) << 32 | max(user_id, peer_id))
+            AND COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0) > last_ts_ms
+        );
+    ''')
+    conn.execute('DROP INDEX IF EXISTS idx_conversations_recent;')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_recent_time
+        ON conversations (user_id, last_ts_ms, last_message_id);
+    ''')
+
+    # Новое сообщение создаёт строки переписки и увеличивает непрочитанные, а последним становится,
+    # только если оно позже текущего последнего
+    conn.execute('DROP TRIGGER IF EXISTS conversations_message_insert;')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_message_insert
+        AFTER INSERT ON messages
+        WHEN NEW.receiver_type = 'user' AND NEW.sender_id != NEW.receiver_id
+        BEGIN
+            INSERT INTO conversations (user_id, peer_id, last_message_id, last_timestamp, last_preview, unread_count,
+                                       last_ts_ms)
+            VALUES (NEW.sender_id, NEW.receiver_id, NEW.id, NEW.timestamp, substr(COALESCE(NEW.content, ''), 1, 100), 0,
+                    COALESCE(NEW.ts_ms, CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000, 0))
+            ON CONFLICT (user_id, peer_id) DO NOTHING;
+
+            INSERT INTO conversations (user_id, peer_id, last_message_id, last_timestamp, last_preview, unread_count,
+                                       last_ts_ms)
+            VALUES (NEW.receiver_id, NEW.sender_id, NEW.id, NEW.timestamp, substr(COALESCE(NEW.content, ''), 1, 100), 1,
+                    COALESCE(NEW.ts_ms, CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000, 0))
+            ON CONFLICT (user_id, peer_id) DO UPDATE SET unread_count = unread_count + 1;
+
+            UPDATE conversations
+            SET (last_message_id, last_timestamp, last_preview, last_ts_ms) = (
+                NEW.id, NEW.timestamp, substr(COALESCE(NEW.content, ''), 1, 100),
+                COALESCE(NEW.ts_ms, CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000, 0)
+            )
+            WHERE ((user_id = NEW.sender_id AND peer_id = NEW.receiver_id)
+                OR (user_id = NEW.receiver_id AND peer_id = NEW.sender_id))
+            AND (last_ts_ms, last_message_id)
+                < (COALESCE(NEW.ts_ms, CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000, 0), NEW.id);
+        END;
+    ''')
+    conn.execute('DROP TRIGGER IF EXISTS conversations_message_delete;')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_message_delete
+        AFTER DELETE ON messages
+        WHEN OLD.receiver_type = 'user' AND OLD.sender_id != OLD.receiver_id
+        BEGIN
+            UPDATE conversations
+            SET (last_message_id, last_timestamp, last_preview, last_ts_ms) = (
+                SELECT id, timestamp, substr(COALESCE(content, ''), 1, 100),
+                       COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0)
+                FROM messages
+                WHERE COALESCE(conversation_key, CASE WHEN receiver_type = 'group' THEN -receiver_id
+                    ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id) END)
+                    = COALESCE(OLD.conversation_key, (min(OLD.sender_id, OLD.receiver_id) << 32) | max(OLD.sender_id, OLD.receiver_id))
+                ORDER BY COALESCE(ts_ms, CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0) DESC, id DESC
+                LIMIT 1
+            )
+            WHERE last_message_id = OLD.id
+            AND ((user_id = OLD.sender_id AND peer_id = OLD.receiver_id)
+              OR (user_id = OLD.receiver_id AND peer_id = OLD.sender_id));
+
+            DELETE FROM conversations
+            WHERE last_message_id IS NULL
+            AND ((user_id = OLD.sender_id AND peer_id = OLD.receiver_id)
+              OR (user_id = OLD.receiver_id AND peer_id = OLD.sender_id));
+        END;
+    ''')
+
+def _add_user_origin(conn):
+    # Учётные записи из других баз (sync.py) — отдельные строки users: origin — site базы, где запись
+    # создана, у своих NULL. Пароли между базами не передаются, поэтому чужая запись здесь не входит
+    # (queries.authenticate_user), и журнал больше не пишет изменение пароля — только имени.
+    # Строки, пришедшие синхронизацией раньше, остаются как есть: по журналу не отличить копию базы от чужой.
+    conn.execute('ALTER TABLE users ADD COLUMN origin TEXT;')
+    conn.execute('DROP TRIGGER IF EXISTS sync_users_update;')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS sync_users_update AFTER UPDATE OF username ON users
+        WHEN (SELECT applying FROM sync_state) = 0 AND NEW.username != OLD.username
+        BEGIN
+            UPDATE sync_origins SET seq = seq + 1 WHERE origin = (SELECT site FROM sync_state);
+            INSERT INTO change_log (origin, seq, tbl, op, row_gid)
+            SELECT site, seq, 'users', 'update', gid
+            FROM sync_local, (SELECT gid FROM sync_rows WHERE tbl = 'users' AND local_id = NEW.id LIMIT 1);
+        END;
+    ''')
+
+# Порядок важен: номер миграции = её позиция в списке, он же PRAGMA user_version после применения.
+# Уже выпущенные миграции не редактируются, изменения схемы добавляются в конец.
+MIGRATIONS = [
+    _create_base_tables,
+    _add_message_indexes,
+    _create_conversations,
+    _add_keyset_indexes,
+    _create_message_search,
+    _create_attachments,
+    _add_attachment_path_indexes,
+    _add_message_clock,
+    _add_conversation_key,
+    _create_change_log,
+    _add_message_time_order,
+    _order_conversations_by_time,
+    _add_user_origin,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version;').fetchone()[0]
+
+def migrate(conn=None):
+    if conn is None:
+        conn = db.get_connection()
+
+    # Быстрый путь при каждом запуске: схема актуальна, лишних CREATE ... IF NOT EXISTS не выполняем
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return
+
+    while True:
+        # BEGIN IMMEDIATE сериализует миграцию между несколькими запущенными копиями приложения
+        conn.execute('BEGIN IMMEDIATE;')
+        try:
+            version = get_schema_version(conn)
+            if version >= SCHEMA_VERSION:
+                conn.rollback()
+                return
+            MIGRATIONS[version](conn)
+            conn.execute(f'PRAGMA user_version = {version + 1};')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def backfill_message_clock(batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE_S):
+    # Заполняет messages.ts_ms у строк, записанных до _add_message_clock, короткими транзакциями:
+    # между ними успевают пройти запись новых сообщений и чтение. Возвращает число заполненных строк.
+    conn = db.get_connection()
+    total = 0
+    while True:
+        with conn:
+            updated = conn.execute('''
+                UPDATE messages
+                SET ts_ms = COALESCE(CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0)
+                WHERE id IN (SELECT id FROM messages WHERE ts_ms IS NULL LIMIT ?);
+            ''', (batch_size,)).rowcount
+        total += updated
+        if updated < batch_size:
+            return total
+        time.sleep(pause)
+
+def backfill_conversation_key(conn=None, batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE_S):
+    # То же для messages.conversation_key после _add_conversation_key; выражение — queries.conversation_key
+    if conn is None:
+        conn = db.get_connection()
+    total = 0
+    while True:
+        with conn:
+            updated = conn.execute('''
+                UPDATE messages SET conversation_key = CASE
+                    WHEN receiver_type = 'group' THEN -receiver_id
+                    ELSE (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id)
+                END
+                WHERE id IN (SELECT id FROM messages WHERE conversation_key IS NULL LIMIT ?);
+            ''', (batch_size,)).rowcount
+        total += updated
+        if updated < batch_size:
+            return total
+        time.sleep(pause)
+
+def backfill_message_stems(conn=None, batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE_S):
+    # То же для messages.stems (_create_message_search): основы считаются здесь, в Python, по порядку id
+    if conn is None:
+        conn = db.get_connection()
+    total = 0
+    while True:
+        with conn:
+            rows = conn.execute('''
+                SELECT id, content FROM messages WHERE stems IS NULL ORDER BY id LIMIT ?;
+            ''', (batch_size,)).fetchall()
+            conn.executemany('UPDATE messages SET stems = ? WHERE id = ?;',
+                             [(stemmer.stem_text(content), message_id) for message_id, content in rows])
+        total += len(rows)
+        if len(rows) < batch_size:
+            return total
+        time.sleep(pause)
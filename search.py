@@ -0,0 +1,118 @@
+import tkinter as tk
+
+import news
+import tasks
+import useful_info
+from search_index import SearchIndex, make_snippet, query_terms
+
+_articles_index = None
+
+def get_articles_index():
+    # Новости и полезная информация: индекс строится при первом поиске
+    global _articles_index
+    if _articles_index is None:
+        index = SearchIndex()
+        for section, items in (("Новости", news.NEWS_DATA), ("Полезно узнать", useful_info.USEFUL_INFO_DATA)):
+            for number, item in enumerate(items):
+                title = item.get("title", "")
+                content = item.get("content", "")
+                index.add((section, number), f"{title} {content}", (section, title, content))
+        _articles_index = index
+    return _articles_index
+
+def search_articles(text, limit=20):
+    # Возвращает [(раздел, заголовок, фрагмент)]
+    query_stems = query_terms(text)
+    return [(section, title, make_snippet(content, query_stems))
+            for _, _, (section, title, content) in get_articles_index().search(text, limit)]
+
+def show_search_section(content_frame, search, open_result, describe_result, submit=tasks.run_inline, on_error=None):
+    # search(text, cursor) -> (результаты, курсор следующей страницы или None);
+    # запросы идут через submit, устаревшие ответы (после нового поиска) отбрасываются.
+    # Новости и полезная информация ищутся в памяти и показываются над сообщениями.
+    section = tk.Frame(content_frame)
+    section.pack(fill="both", expand=True)
+
+    tk.Label(section, text="Поиск", font=("Arial", 16)).pack(pady=10)
+
+    query_frame = tk.Frame(section)
+    query_frame.pack(pady=5)
+    query_entry = tk.Entry(query_frame, width=40)
+    query_entry.pack(side="left", padx=5)
+    search_button = tk.Button(query_frame, text="Найти")
+    search_button.pack(side="left")
+
+    status_label = tk.Label(section, text="", font=("Arial", 12))
+    status_label.pack(pady=5)
+
+    canvas = tk.Canvas(section, highlightthickness=0)
+    scrollbar = tk.Scrollbar(section, orient="vertical", command=canvas.yview)
+    results_frame = tk.Frame(canvas)
+    canvas.create_window((0, 0), window=results_frame, anchor="nw")
+    results_frame.bind("<Configure>", lambda event: canvas.configure(scrollregion=canvas.bbox("all")))
+    canvas.configure(yscrollcommand=scrollbar.set)
+    canvas.pack(side="left", fill="both", expand=True)
+    scrollbar.pack(side="right", fill="y")
+
+    state = {'generation': 0, 'text': '', 'cursor': None, 'found': 0}
+    more_button = tk.Button(results_frame, text="Показать ещё", command=lambda: load_page())
+
+    def start_search():
+        text = query_entry.get().strip()
+        state['generation'] += 1
+        state['text'] = text
+        state['cursor'] = None
+        state['found'] = 0
+        for widget in results_frame.winfo_children():
+            if widget is not more_button:
+                widget.destroy()
+        more_button.pack_forget()
+        if not text:
+            status_label.config(text="")
+            return
+        for article in search_articles(text):
+            show_article(article)
+        load_page()
+
+    def load_page():
+        generation = state['generation']
+        more_button.pack_forget()
+        status_label.config(text="Поиск...")
+
+        def on_done(page):
+            if generation != state['generation'] or not section.winfo_exists():
+                return
+            rows, cursor = page
+            state['cursor'] = cursor
+            state['found'] += len(rows)
+            for row in rows:
+                show_result(row)
+            status_label.config(text=f"Найдено: {state['found']}{'+' if cursor else ''}" if state['found'] else "Ничего не найдено")
+            if cursor is not None:
+                more_button.pack(pady=10)
+
+        def on_failed(error):
+            if generation == state['generation'] and section.winfo_exists():
+                status_label.config(text="")
+                if on_error is not None:
+                    on_error(error)
+
+        submit(search, state['text'], state['cursor'], on_done=on_done, on_error=on_failed)
+
+    def show_article(article):
+        section_name, title, snippet = article
+        article_frame = tk.Frame(results_frame)
+        article_frame.pack(fill="x", pady=5, anchor="w")
+        tk.Label(article_frame, text=f"{section_name}: {title}", fg="darkred", wraplength=500, justify="left").pack(anchor="w")
+        tk.Label(article_frame, text=snippet, wraplength=500, justify="left").pack(anchor="w")
+
+    def show_result(row):
+        result_frame = tk.Frame(results_frame)
+        result_frame.pack(fill="x", pady=5, anchor="w")
+        tk.Label(result_frame, text=describe_result(row), fg="darkblue").pack(anchor="w")
+        tk.Label(result_frame, text=row[5], bg="lightgrey", wraplength=500, justify="left").pack(anchor="w")
+        tk.Button(result_frame, text="Открыть", command=lambda: open_result(row)).pack(anchor="w", pady=2)
+
+    search_button.config(command=start_search)
+    query_entry.bind("<Return>", lambda event: start_search())
+    query_entry.focus_set()
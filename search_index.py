@@ -0,0 +1,84 @@
+import bisect
+import math
+from collections import Counter, defaultdict
+
+from stemmer import WORD, stem, stem_tokens
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+SNIPPET_WORDS = 12
+
+class SearchIndex:
+    # Инвертированный индекс в памяти по основам слов: для небольших статичных текстов (новости,
+    # полезная информация), которые не лежат в базе. Все слова запроса обязательны и ищутся по префиксу
+    # основы, как "основа"* в FTS5; ранжирование — BM25.
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.documents = {}
+        self.sorted_stems = None
+
+    def add(self, doc_id, text, document=None):
+        stems = stem_tokens(text)
+        for token_stem, count in Counter(stems).items():
+            self.postings[token_stem][doc_id] = count
+        self.lengths[doc_id] = len(stems)
+        self.documents[doc_id] = document
+        self.sorted_stems = None
+        return len(stems)
+
+    def matching_stems(self, prefix):
+        if self.sorted_stems is None:
+            self.sorted_stems = sorted(self.postings)
+        start = bisect.bisect_left(self.sorted_stems, prefix)
+        end = bisect.bisect_left(self.sorted_stems, prefix + '￿')
+        return self.sorted_stems[start:end]
+
+    def search(self, text, limit=20):
+        # Возвращает [(score, doc_id, document)], лучшие первыми
+        query_stems = query_terms(text)
+        if not query_stems or not self.lengths:
+            return []
+        average_length = sum(self.lengths.values()) / len(self.lengths)
+        scores = None
+        for query_stem in query_stems:
+            term_scores = defaultdict(float)
+            for token_stem in self.matching_stems(query_stem):
+                documents = self.postings[token_stem]
+                idf = math.log(1 + (len(self.lengths) - len(documents) + 0.5) / (len(documents) + 0.5))
+                for doc_id, count in documents.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / average_length)
+                    term_scores[doc_id] += idf * count * (BM25_K1 + 1) / (count + norm)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc_id: score + term_scores[doc_id] for doc_id, score in scores.items() if doc_id in term_scores}
+            if not scores:
+                return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(score, doc_id, self.documents[doc_id]) for doc_id, score in ranked]
+
+def query_terms(text):
+    return list(dict.fromkeys(stem_tokens(text)))
+
+def make_snippet(text, query_stems, words=SNIPPET_WORDS):
+    # Фрагмент исходного текста вокруг первого совпадения; совпавшие слова в [скобках], как snippet() в FTS5
+    if not text:
+        return ''
+    matches = list(WORD.finditer(text))
+    if not matches:
+        return text[:words * 8]
+    hits = {index for index, match in enumerate(matches)
+            if any(stem(match.group().lower()).startswith(query_stem) for query_stem in query_stems)}
+    first = max(min(min(hits, default=0) - words // 3, len(matches) - words), 0)
+    last = min(first + words, len(matches))
+    pieces = ['…' if first > 0 else '']
+    position = matches[first].start()
+    for index in range(first, last):
+        match = matches[index]
+        pieces.append(text[position:match.start()])
+        pieces.append(f"[{match.group()}]" if index in hits else match.group())
+        position = match.end()
+    pieces.append('…' if last < len(matches) else text[position:])
+    return ''.join(pieces)
@@ -0,0 +1,138 @@
+import re
+from functools import lru_cache
+
+# Стеммер русского языка по алгоритму Snowball (snowballstem.org/algorithms/russian/stemmer.html).
+# Окончания ищутся самым длинным совпадением внутри области RV, «ость» — внутри R2.
+STEM_CACHE_SIZE = 100000
+WORD = re.compile(r'\w+')
+VOWELS = frozenset('аеиоуыэюя')
+
+PERFECTIVE_GERUND_1 = ('в', 'вши', 'вшись')
+PERFECTIVE_GERUND_2 = ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись')
+ADJECTIVE = (
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом',
+    'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею',
+)
+PARTICIPLE_1 = ('ем', 'нн', 'вш', 'ющ', 'щ')
+PARTICIPLE_2 = ('ивш', 'ывш', 'ующ')
+REFLEXIVE = ('ся', 'сь')
+VERB_1 = ('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно')
+VERB_2 = (
+    'ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен',
+    'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю',
+)
+NOUN = (
+    'а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий', 'й',
+    'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я',
+)
+SUPERLATIVE = ('ейш', 'ейше')
+DERIVATIONAL = ('ост', 'ость')
+
+def _endings(plain, after_a=()):
+    # Окончание -> требуется ли перед ним «а» или «я»; плюс длины окончаний от большей к меньшей,
+    # чтобы самое длинное совпадение находилось парой срезов и поисков в словаре
+    endings = {ending: False for ending in plain}
+    endings.update((ending, True) for ending in after_a)
+    return endings, sorted({len(ending) for ending in endings}, reverse=True)
+
+_PERFECTIVE_GERUND = _endings(PERFECTIVE_GERUND_2, after_a=PERFECTIVE_GERUND_1)
+_ADJECTIVE = _endings(ADJECTIVE)
+_PARTICIPLE = _endings(PARTICIPLE_2, after_a=PARTICIPLE_1)
+_REFLEXIVE = _endings(REFLEXIVE)
+_VERB = _endings(VERB_2, after_a=VERB_1)
+_NOUN = _endings(NOUN)
+_SUPERLATIVE = _endings(SUPERLATIVE)
+_DERIVATIONAL = _endings(DERIVATIONAL)
+
+def _regions(word):
+    # RV — после первой гласной; R1 — после первой согласной, идущей за гласной; R2 — то же внутри R1
+    rv = r1 = r2 = len(word)
+    for index, char in enumerate(word):
+        if char in VOWELS:
+            rv = index + 1
+            break
+    for index in range(1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            r1 = index + 1
+            break
+    for index in range(r1 + 1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            r2 = index + 1
+            break
+    return rv, r2
+
+def _remove(word, endings, start):
+    # Самое длинное окончание внутри word[start:]. Как в Snowball, если у него не выполнено условие
+    # про «а»/«я», более короткие окончания не пробуются.
+    endings, lengths = endings
+    for length in lengths:
+        stem_length = len(word) - length
+        if stem_length < start:
+            continue
+        after_a = endings.get(word[stem_length:])
+        if after_a is None:
+            continue
+        if after_a and (stem_length <= start or word[stem_length - 1] not in 'ая'):
+            return None
+        return word[:stem_length]
+    return None
+
+def _remove_adjectival(word, start):
+    stem = _remove(word, _ADJECTIVE, start)
+    if stem is None:
+        return None
+    participle_stem = _remove(stem, _PARTICIPLE, start)
+    return stem if participle_stem is None else participle_stem
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    word = word.lower().replace('ё', 'е')
+    rv, r2 = _regions(word)
+    if rv >= len(word):
+        return word
+
+    # Шаг 1: деепричастие, иначе возвратная частица и затем прилагательное, глагол или существительное
+    stemmed = _remove(word, _PERFECTIVE_GERUND, rv)
+    if stemmed is None:
+        without_reflexive = _remove(word, _REFLEXIVE, rv)
+        if without_reflexive is not None:
+            word = without_reflexive
+        stemmed = _remove_adjectival(word, rv)
+        if stemmed is None:
+            stemmed = _remove(word, _VERB, rv)
+        if stemmed is None:
+            stemmed = _remove(word, _NOUN, rv)
+    if stemmed is not None:
+        word = stemmed
+
+    # Шаг 2: конечное «и»
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3: словообразовательный суффикс в R2
+    stemmed = _remove(word, _DERIVATIONAL, max(r2, rv))
+    if stemmed is not None:
+        word = stemmed
+
+    # Шаг 4: «нн» -> «н», либо превосходная степень (и затем «нн» -> «н»), либо мягкий знак
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        return word[:-1]
+    stemmed = _remove(word, _SUPERLATIVE, rv)
+    if stemmed is not None:
+        word = stemmed
+        if word.endswith('нн') and len(word) - 2 >= rv:
+            word = word[:-1]
+        return word
+    if word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+def tokenize(text):
+    return WORD.findall(text.lower()) if text else []
+
+def stem_tokens(text):
+    return [stem(token) for token in tokenize(text)]
+
+def stem_text(text):
+    # Основы через пробел — текст для индекса FTS5, где токенизатор разобьёт его обратно на основы
+    return ' '.join(stem_tokens(text))
@@ -0,0 +1,212 @@
+import argparse
+import heapq
+import json
+import zlib
+from collections import namedtuple
+from itertools import islice
+
+import clock
+import db
+import queries
+import schema
+import stemmer
+
+BATCH_SIZE = 1000
+
+# Синхронизация двух баз приложения по журналу изменений (schema._create_change_log): стороны обмениваются
+# только записями, которых у другой ещё нет. Что есть у базы, описывает вектор {origin: последний seq} из
+# sync_origins; источник отдаёт по каждой базе-автору записи после этого seq — по индексу (origin, seq),
+# так что объём передачи и работа пропорциональны числу изменений, а не размеру базы. Записи идут в том
+# порядке, в каком появились у источника: сообщение не придёт раньше своего отправителя или группы,
+# и через третью базу изменения пересылаются так же, как напрямую.
+# Запись несёт текущее содержимое строки, а не снимок на момент изменения: вставка строки, которую затем
+# удалили, приходит пустой, удаление — следом за ней. Пользователь другой базы — всегда отдельная учётная
+# запись (users.origin), даже одноимённая со здешней: по имени нельзя узнать, один ли это человек. Имя,
+# уже занятое здесь, получает приписку базы-автора. Пароли не передаются, и чужая запись здесь не входит;
+# переименование из другой базы меняет только чужие записи. Группы и сообщения тоже всегда разные.
+# Файлы вложений не переносятся: приходят пути и хеш, сами файлы копируются отдельно.
+
+Change = namedtuple('Change', 'origin seq tbl op row_gid ref_gid data')
+SyncStats = namedtuple('SyncStats', 'received sent received_bytes sent_bytes')
+
+def get_site(conn):
+    return conn.execute('SELECT site FROM sync_state;').fetchone()[0]
+
+def reset_site(conn):
+    # Копия базы, сделанная копированием файла, должна получить свой идентификатор до первых изменений:
+    # иначе у двух баз совпадут пары (origin, seq). Прежние записи журнала остаются за старым site
+    with conn:
+        site = conn.execute('SELECT lower(hex(randomblob(8)));').fetchone()[0]
+        conn.execute('UPDATE sync_state SET site = ?;', (site,))
+        conn.execute('INSERT INTO sync_origins (origin, seq) VALUES (?, 0);', (site,))
+    return site
+
+def get_vector(conn):
+    return dict(conn.execute('SELECT origin, seq FROM sync_origins;'))
+
+def export_changes(conn, vector, limit=BATCH_SIZE):
+    # До limit записей, которых нет у стороны с вектором vector, в порядке их появления здесь.
+    # Записи каждой базы-автора уже упорядочены по id журнала — остаётся слить их
+    streams = []
+    for origin, seq in get_vector(conn).items():
+        known = vector.get(origin, 0)
+        if seq > known:
+            streams.append(conn.execute(queries.SYNC_CHANGES_SQL, (origin, known, limit)).fetchall())
+    return [_make_change(row) for row in islice(heapq.merge(*streams), limit)]
+
+def _make_change(row):
+    _, origin, seq, table, op, row_gid, ref_gid = row[:7]
+    data = None
+    if op != 'delete':
+        if table == 'users' and row[7] is not None:
+            data = [row[7]]
+        elif table == 'groups' and row[8] is not None:
+            data = [row[8]]
+        elif table == 'messages' and row[11] is not None:
+            # sender_gid, receiver_gid, receiver_type, content, file_path, image_path, file_hash, file_name,
+            # размер вложения, ts_ms, timestamp
+            data = list(row[9:20])
+    return Change(origin, seq, table, op, row_gid, ref_gid, data)
+
+def apply_changes(conn, changes):
+    # Применяет чужие записи одной транзакцией и добавляет их в свой журнал с исходными (origin, seq),
+    # уже известные пропускает. Возвращает число применённых
+    applied = 0
+    with conn:
+        conn.execute('UPDATE sync_state SET applying = 1;')
+        vector = get_vector(conn)
+        for change in changes:
+            if change.seq <= vector.get(change.origin, 0):
+                continue
+            _apply(conn, change)
+            conn.execute('''
+                INSERT INTO change_log (origin, seq, tbl, op, row_gid, ref_gid) VALUES (?, ?, ?, ?, ?, ?);
+            ''', change[:6])
+            vector[change.origin] = change.seq
+            applied += 1
+        conn.executemany('''
+            INSERT INTO sync_origins (origin, seq) VALUES (?, ?)
+            ON CONFLICT (origin) DO UPDATE SET seq = max(seq, excluded.seq);
+        ''', vector.items())
+        conn.execute('UPDATE sync_state SET applying = 0;')
+    return applied
+
+def _local_id(conn, gid):
+    row = conn.execute('SELECT local_id FROM sync_rows WHERE gid = ?;', (gid,)).fetchone()
+    return row[0] if row else None
+
+def _map(conn, gid, table, local_id):
+    conn.execute('INSERT OR IGNORE INTO sync_rows (gid, tbl, local_id) VALUES (?, ?, ?);', (gid, table, local_id))
+
+def _delete(conn, table, gid):
+    local_id = _local_id(conn, gid)
+    if local_id is not None:
+        conn.execute(f'DELETE FROM {table} WHERE id = ?;', (local_id,))
+        conn.execute('DELETE FROM sync_rows WHERE gid = ?;', (gid,))
+
+def _apply(conn, change):
+    # Ссылки, которых здесь нет (строку уже удалили), и пустые вставки пропускаются: запись всё равно
+    # попадает в журнал, чтобы вектор продвинулся
+    if change.op == 'delete' and change.tbl != 'group_members':
+        _delete(conn, change.tbl, change.row_gid)
+    elif change.tbl == 'group_members':
+        group_id, user_id = _local_id(conn, change.row_gid), _local_id(conn, change.ref_gid)
+        if group_id is None or user_id is None:
+            return
+        if change.op == 'insert':
+            conn.execute('INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?);', (group_id, user_id))
+        else:
+            conn.execute('DELETE FROM group_members WHERE group_id = ? AND user_id = ?;', (group_id, user_id))
+    elif change.data is None:
+        return
+    elif change.tbl == 'users' and change.op == 'insert':
+        # Пустой пароль не откроет вход: authenticate_user пускает только записи с origin IS NULL
+        cursor = conn.execute("INSERT INTO users (username, password, origin) VALUES (?, '', ?);",
+                              (_free_username(conn, change.data[0], change.row_gid), _origin(change.row_gid)))
+        _map(conn, change.row_gid, 'users', cursor.lastrowid)
+    elif change.tbl == 'users':
+        user_id = _local_id(conn, change.row_gid)
+        if user_id is not None:
+            conn.execute('UPDATE users SET username = ? WHERE id = ? AND origin IS NOT NULL;',
+                         (_free_username(conn, change.data[0], change.row_gid, user_id), user_id))
+    elif change.tbl == 'groups':
+        cursor = conn.execute('INSERT INTO groups (name) VALUES (?);', change.data)
+        _map(conn, change.row_gid, 'groups', cursor.lastrowid)
+    elif change.tbl == 'messages':
+        _insert_message(conn, change.row_gid, *change.data)
+
+def _origin(gid):
+    return gid.split(':', 1)[0]
+
+def _free_username(conn, username, gid, user_id=None):
+    # Имя для чужой учётной записи: её собственное, если здесь оно свободно, иначе с припиской базы-автора
+    for candidate in (username, f"{username}@{_origin(gid)[:8]}", f"{username}@{gid}"):
+        row = conn.execute('SELECT id FROM users WHERE username = ?;', (candidate,)).fetchone()
+        if row is None or row[0] == user_id:
+            return candidate
+    return candidate
+
+def _insert_message(conn, gid, sender_gid, receiver_gid, receiver_type, content, file_path, image_path, file_hash,
+                    file_name, size, ts_ms, timestamp):
+    sender_id, receiver_id = _local_id(conn, sender_gid), _local_id(conn, receiver_gid)
+    if sender_id is None or receiver_id is None:
+        return
+    if file_hash is not None and size is not None:
+        conn.execute('INSERT INTO attachments (hash, size) VALUES (?, ?) ON CONFLICT (hash) DO NOTHING;',
+                     (file_hash, size))
+    if ts_ms is not None:
+        clock.observe(ts_ms)
+    cursor = conn.execute('''
+        INSERT INTO messages (sender_id, receiver_id, content, file_path, image_path, timestamp, receiver_type,
+                              file_hash, file_name, ts_ms, conversation_key, stems)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+    ''', (sender_id, receiver_id, content, file_path, image_path, timestamp, receiver_type, file_hash, file_name,
+          ts_ms, queries.conversation_key(receiver_type, sender_id, receiver_id), stemmer.stem_text(content)))
+    _map(conn, gid, 'messages', cursor.lastrowid)
+
+def encode_changes(changes):
+    return zlib.compress(json.dumps(changes, ensure_ascii=False, separators=(',', ':')).encode())
+
+def decode_changes(data):
+    return [Change._make(change) for change in json.loads(zlib.decompress(data))]
+
+def pull(target, source, batch_size=BATCH_SIZE):
+    # Переносит в target всё, чего там нет, из source пакетами по batch_size. Между базами ходят только
+    # вектор target и закодированные записи; возвращает (применено записей, передано байт)
+    applied = transferred = 0
+    while True:
+        request = json.dumps(get_vector(target)).encode()
+        changes = export_changes(source, json.loads(request), batch_size)
+        response = encode_changes(changes)
+        transferred += len(request) + len(response)
+        applied += apply_changes(target, decode_changes(response))
+        if len(changes) < batch_size:
+            return applied, transferred
+
+def sync_files(path, other_path, batch_size=BATCH_SIZE):
+    # Двусторонняя синхронизация двух файлов базы: после неё в обоих одни и те же изменения
+    conn = db.dedicated_connection(path)
+    other = db.dedicated_connection(other_path)
+    try:
+        schema.migrate(conn)
+        schema.migrate(other)
+        received, received_bytes = pull(conn, other, batch_size)
+        sent, sent_bytes = pull(other, conn, batch_size)
+    finally:
+        db.close_connection(conn)
+        db.close_connection(other)
+    return SyncStats(received, sent, received_bytes, sent_bytes)
+
+def main():
+    parser = argparse.ArgumentParser(description="Синхронизация двух баз приложения по журналу изменений")
+    parser.add_argument('other', help="файл другой базы")
+    parser.add_argument('--database', default=db.DB_PATH, help="своя база (по умолчанию app_database.db)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    stats = sync_files(args.database, args.other, args.batch_size)
+    print(f"получено изменений: {stats.received:,} ({stats.received_bytes:,} байт), "
+          f"отправлено: {stats.sent:,} ({stats.sent_bytes:,} байт)")
+
+if __name__ == '__main__':
+    main()
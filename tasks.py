@@ -0,0 +1,65 @@
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+DB_WORKERS = 2
+DRAIN_INTERVAL_MS = 15
+
+# Запросы к базе выполняются в рабочих потоках, а их результаты складываются в потокобезопасную
+# очередь. Tk не потокобезопасен, поэтому колбэки вызываются только из mainloop, при разборе очереди.
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+_results = queue.SimpleQueue()
+_root = None
+
+def install(root):
+    global _root
+    _root = root
+    _schedule_drain()
+
+def submit(fn, *args, on_done=None, on_error=None):
+    return watch(_executor.submit(fn, *args), on_done=on_done, on_error=on_error)
+
+def watch(future, on_done=None, on_error=None):
+    # Колбэки для Future, созданного вне пула (например, очередью отправки), тоже вызываются из mainloop
+    if on_done is not None or on_error is not None:
+        future.add_done_callback(lambda finished: _results.put((finished, on_done, on_error)))
+    return future
+
+def run_inline(fn, *args, on_done=None, on_error=None):
+    # Синхронный вариант submit с тем же интерфейсом — для кода без mainloop (скрипты, бенчмарки)
+    try:
+        result = fn(*args)
+    except Exception as error:
+        if on_error is None:
+            raise
+        on_error(error)
+        return
+    if on_done is not None:
+        on_done(result)
+
+def _schedule_drain():
+    _root.after(DRAIN_INTERVAL_MS, lambda: _root.after_idle(_drain))
+
+def _drain():
+    while True:
+        try:
+            future, on_done, on_error = _results.get_nowait()
+        except queue.Empty:
+            break
+        if future.cancelled():
+            continue
+        try:
+            error = future.exception()
+            if error is None:
+                if on_done is not None:
+                    on_done(future.result())
+            elif on_error is not None:
+                on_error(error)
+            else:
+                traceback.print_exception(error)
+        except Exception:
+            traceback.print_exc()
+    _schedule_drain()
+
+def shutdown():
+    _executor.shutdown(wait=True, cancel_futures=True)
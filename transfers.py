@@ -0,0 +1,190 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import attachments
+
+TRANSFER_WORKERS = 2
+PROGRESS_INTERVAL_MS = 100
+
+# Фоновые загрузки вложений в хранилище. Файл сначала хешируется (если такой блоб уже есть — копирования
+# нет), затем копируется во временный файл блоками по attachments.COPY_STEP. Между блоками проверяются
+# пауза и отмена: на паузе рабочий поток освобождается, а состояние (хеш, смещения, временный файл)
+# остаётся в Transfer, и resume() продолжает с того же места. Future завершается Attachment'ом,
+# только когда блоб на месте, — сообщение с вложением пишется в базу уже после этого.
+_executor = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS, thread_name_prefix='transfer')
+_active = set()
+_lock = threading.Lock()
+
+class TransferCancelled(Exception):
+    pass
+
+class _Paused(Exception):
+    pass
+
+class Transfer:
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.future = Future()
+        self.state = 'running'
+        self.file_stat = None
+        self.size = 0
+        self.hasher = None
+        self.hashed = 0
+        self.copied = 0
+        self.file_hash = None
+        self.temp_path = None
+
+    @property
+    def progress(self):
+        # Доля от 0 до 1: хеширование и копирование считаются за половину каждое
+        if self.future.done():
+            return 1.0
+        if not self.size:
+            return 0.0
+        return (self.hashed + self.copied) / (2 * self.size)
+
+    def pause(self):
+        with _lock:
+            if self.state == 'running':
+                self.state = 'pausing'
+
+    def resume(self):
+        with _lock:
+            if self.state == 'pausing':
+                self.state = 'running'
+                return
+            if self.state != 'paused':
+                return
+            self.state = 'running'
+        _executor.submit(self._run)
+
+    def cancel(self):
+        with _lock:
+            if self.future.done():
+                return
+            state, self.state = self.state, 'cancelled'
+        if state == 'paused':
+            self._finish(error=TransferCancelled(self.path))
+
+    def _check(self):
+        # Вызывается между блоками: на паузе и при отмене прерывает работу исключением
+        with _lock:
+            if self.state == 'pausing':
+                self.state = 'paused'
+                raise _Paused()
+            if self.state == 'cancelled':
+                raise TransferCancelled(self.path)
+
+    def _run(self):
+        try:
+            attachment = self._transfer()
+        except _Paused:
+            return
+        except BaseException as error:
+            self._finish(error=error)
+        else:
+            self._finish(attachment)
+
+    def _transfer(self):
+        if self.file_stat is not None and not _same_file(self.path, self.file_stat):
+            # Файл изменили, пока загрузка стояла на паузе: начинаем заново
+            self._remove_temp()
+            self.file_stat = None
+        if self.file_stat is None:
+            stored = attachments.find_stored(self.path)
+            if stored is not None:
+                return stored
+            self.file_stat = os.stat(self.path)
+            self.size = self.file_stat.st_size
+            self.hasher = hashlib.sha256()
+            self.hashed = self.copied = 0
+            self.file_hash = None
+
+        if self.file_hash is None:
+            self._hash()
+            self.file_hash = self.hasher.hexdigest()
+        if not attachments.pin_blob(self.file_hash):
+            self._copy()
+            attachments.check_unchanged(self.path, self.file_stat)
+            attachments.commit_blob(self.temp_path, self.file_hash)
+            self.temp_path = None
+        self.copied = self.size
+        attachments.remember_hash(self.path, self.file_stat, self.file_hash)
+        return attachments.Attachment(self.file_hash, attachments.blob_path(self.file_hash), self.name, self.size)
+
+    def _hash(self):
+        buffer = bytearray(attachments.CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(self.path, 'rb') as source:
+            source.seek(self.hashed)
+            while True:
+                self._check()
+                read = source.readinto(buffer)
+                if not read:
+                    break
+                self.hasher.update(view[:read])
+                self.hashed += read
+
+    def _copy(self):
+        if self.temp_path is None:
+            os.makedirs(attachments.STORE_TMP_DIR, exist_ok=True)
+            self.temp_path = os.path.join(attachments.STORE_TMP_DIR, f"{self.file_hash}.{os.getpid()}.{id(self)}.partial")
+            self.copied = 0
+            if attachments.clone_file(self.path, self.temp_path):
+                return
+            open(self.temp_path, 'xb').close()
+
+        def on_progress(offset):
+            self.copied = offset
+            self._check()
+
+        with open(self.path, 'rb') as source, open(self.temp_path, 'r+b') as target:
+            attachments.copy_data(source, target, self.copied, on_progress)
+
+    def _remove_temp(self):
+        if self.temp_path is not None and os.path.lexists(self.temp_path):
+            os.remove(self.temp_path)
+        self.temp_path = None
+
+    def _finish(self, attachment=None, error=None):
+        with _lock:
+            _active.discard(self)
+            if self.future.done():
+                return
+            if self.state == 'cancelled' and error is None:
+                # Отмена пришла, когда данные уже скопированы: блоб остаётся в хранилище, сообщение не пишется
+                error = TransferCancelled(self.path)
+            if error is None:
+                self.state = 'done'
+            elif not isinstance(error, TransferCancelled):
+                self.state = 'failed'
+        if error is not None:
+            self._remove_temp()
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(attachment)
+
+def _same_file(path, file_stat):
+    try:
+        attachments.check_unchanged(path, file_stat)
+    except OSError:
+        return False
+    return True
+
+def start(path):
+    transfer = Transfer(path)
+    with _lock:
+        _active.add(transfer)
+    _executor.submit(transfer._run)
+    return transfer
+
+def shutdown():
+    with _lock:
+        active = list(_active)
+    for transfer in active:
+        transfer.cancel()
+    _executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,111 @@
+from collections import defaultdict
+
+import changes
+import tasks
+from queries import load_window_updates
+
+# Реестр открытых окон переписки. Ключ — ('user', id собеседника) или ('group', id группы):
+# повторное открытие поднимает уже существующее окно. Все окна обновляются из одного тика
+# (подписка на changes) одним пакетным запросом, результат раскладывается по окнам.
+_windows = {}
+_user_id = None
+_token = None
+_high_water = None
+_in_flight = False
+_tick_again = False
+_on_error = None
+
+def set_user(user_id, on_error=None):
+    global _user_id, _on_error
+    if user_id != _user_id:
+        close_all()
+    _user_id = user_id
+    _on_error = on_error
+
+def open_window(key, create):
+    # create() строит окно и возвращает (Toplevel, VirtualMessageList)
+    global _token
+    entry = _windows.get(key)
+    if entry is not None and entry[0].winfo_exists():
+        window = entry[0]
+        window.deiconify()
+        window.lift()
+        window.focus_set()
+        return entry
+
+    window, view = create()
+    _windows[key] = (window, view)
+
+    def on_destroy(event):
+        if event.widget is window:
+            _forget(key, window)
+
+    window.bind("<Destroy>", on_destroy, add="+")
+    if _token is None:
+        _token = changes.subscribe(_tick)
+    return window, view
+
+def close_all():
+    for window, _ in list(_windows.values()):
+        window.destroy()
+    _windows.clear()
+    _stop()
+
+def _forget(key, window):
+    entry = _windows.get(key)
+    if entry is not None and entry[0] is window:
+        del _windows[key]
+    if not _windows:
+        _stop()
+
+def _stop():
+    global _token, _high_water
+    if _token is not None:
+        changes.unsubscribe(_token)
+        _token = None
+    _high_water = None
+
+def _tick():
+    global _in_flight, _tick_again
+    if not _windows or _user_id is None:
+        return
+    if _in_flight:
+        _tick_again = True
+        return
+    _in_flight = True
+    peer_ids = [key[1] for key in _windows if key[0] == 'user']
+    group_ids = [key[1] for key in _windows if key[0] == 'group']
+    tasks.submit(load_window_updates, _user_id, _high_water, peer_ids, group_ids,
+                 on_done=_dispatch, on_error=_report_error)
+
+def _report_error(error):
+    global _in_flight
+    _in_flight = False
+    if _on_error is not None:
+        _on_error(error)
+
+def _dispatch(result):
+    global _in_flight, _tick_again, _high_water
+    _in_flight = False
+    high_water, rows, chat_last_ids, group_last_ids = result
+    if _token is not None:
+        _high_water = high_water
+
+    updates = defaultdict(list)
+    for row in rows:
+        receiver_id, receiver_type, message = row[0], row[1], row[2:]
+        if receiver_type == 'group':
+            updates[('group', receiver_id)].append(message)
+        else:
+            peer_id = receiver_id if message[0] == _user_id else message[0]
+            updates[('user', peer_id)].append(message)
+
+    for key, (window, view) in list(_windows.items()):
+        if not view.is_alive():
+            continue
+        last_ids = group_last_ids if key[0] == 'group' else chat_last_ids
+        view.receive(updates.get(key, []), last_ids.get(key[1]))
+
+    if _tick_again:
+        _tick_again = False
+        _tick()
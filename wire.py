@@ -0,0 +1,256 @@
+MAGIC = b'\xffMSG1'
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+BATCH_MAX_ROWS = 512
+
+# Типы кадров. Клиент -> сервер: AUTH, SEND, CREDIT; сервер -> клиенту: AUTH_OK, SENT, ERROR, MESSAGE, BATCH
+AUTH = 1
+AUTH_OK = 2
+SEND = 3
+SENT = 4
+ERROR = 5
+MESSAGE = 6
+BATCH = 7
+CREDIT = 8
+
+RECEIVER_TYPES = ('user', 'group')
+
+# Двоичный протокол клиент-сервер. Соединение начинается с MAGIC от клиента, дальше — кадры:
+#   varint длина (тип + данные) | байт типа | данные
+# Целые — беззнаковые varint (LEB128), знаковые разности — через zigzag; строка — varint (длина + 1)
+# и UTF-8, 0 вместо длины — None. Строка сообщения (как RELAY_COLUMNS в queries):
+#   id, sender_id, receiver_id, байт receiver_type, ts_ms, content, file_name
+# MESSAGE несёт одну строку, BATCH — varint число строк и строки, где id и ts_ms записаны разностью
+# с предыдущей строкой пакета: в истории переписки это один-два байта вместо пяти-шести.
+# Разбор идёт по memoryview приёмного буфера (FrameReader): данные кадра не копируются, строки
+# декодируются прямо из буфера.
+#
+# Управление потоком: клиент выдаёт серверу кредиты (в AUTH и кадрами CREDIT) — сколько кадров MESSAGE/BATCH
+# он готов принять. Каждый такой кадр тратит один кредит; без кредитов сервер копит строки у себя
+# и, когда кредит придёт, отправляет накопленное одним BATCH. Ответы на запросы (AUTH_OK, SENT, ERROR)
+# кредитов не тратят: клиент и так ограничивает их числом своих запросов.
+
+class ProtocolError(ValueError):
+    pass
+
+def write_varint(out, value):
+    if value < 0:
+        raise ProtocolError(f"varint не может быть отрицательным: {value}")
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(view, offset):
+    # (значение, смещение после него) или (None, offset), если varint ещё не пришёл целиком
+    result = 0
+    shift = 0
+    end = len(view)
+    while offset < end:
+        byte = view[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+        if shift > 63:
+            raise ProtocolError("Слишком длинный varint.")
+    return None, offset
+
+def _read_varint(view, offset):
+    # Внутри уже полученного кадра varint обязан быть целым. Однобайтовые (до 127) — без цикла:
+    # это почти все длины строк и разности id в BATCH
+    try:
+        byte = view[offset]
+    except IndexError:
+        raise ProtocolError("Кадр обрывается посреди числа.") from None
+    if byte < 0x80:
+        return byte, offset + 1
+    value, offset = read_varint(view, offset)
+    if value is None:
+        raise ProtocolError("Кадр обрывается посреди числа.")
+    return value, offset
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+def write_str(out, text):
+    if text is None:
+        out.append(0)
+        return
+    data = text.encode()
+    write_varint(out, len(data) + 1)
+    out += data
+
+def read_str(view, offset):
+    length, offset = _read_varint(view, offset)
+    if length == 0:
+        return None, offset
+    end = offset + length - 1
+    if end > len(view):
+        raise ProtocolError("Строка выходит за границу кадра.")
+    return str(view[offset:end], 'utf-8'), end
+
+def _read_receiver_type(view, offset):
+    if offset >= len(view) or view[offset] >= len(RECEIVER_TYPES):
+        raise ProtocolError("Неизвестный тип получателя.")
+    return RECEIVER_TYPES[view[offset]], offset + 1
+
+def frame(frame_type, payload=b''):
+    out = bytearray()
+    write_varint(out, len(payload) + 1)
+    out.append(frame_type)
+    out += payload
+    return bytes(out)
+
+def _write_row(out, row, previous_id, previous_ts):
+    message_id, sender_id, receiver_id, receiver_type, ts_ms, content, file_name = row
+    write_varint(out, message_id - previous_id)
+    write_varint(out, sender_id)
+    write_varint(out, receiver_id)
+    out.append(RECEIVER_TYPES.index(receiver_type))
+    write_varint(out, zigzag(ts_ms - previous_ts))
+    write_str(out, content)
+    write_str(out, file_name)
+
+def _read_row(view, offset, previous_id, previous_ts):
+    delta, offset = _read_varint(view, offset)
+    sender_id, offset = _read_varint(view, offset)
+    receiver_id, offset = _read_varint(view, offset)
+    receiver_type, offset = _read_receiver_type(view, offset)
+    ts_delta, offset = _read_varint(view, offset)
+    content, offset = read_str(view, offset)
+    file_name, offset = read_str(view, offset)
+    row = (previous_id + delta, sender_id, receiver_id, receiver_type, previous_ts + unzigzag(ts_delta), content, file_name)
+    return row, offset
+
+def encode_message(row):
+    out = bytearray()
+    _write_row(out, row, 0, 0)
+    return frame(MESSAGE, out)
+
+def encode_batch(rows):
+    out = bytearray()
+    write_varint(out, len(rows))
+    previous_id = previous_ts = 0
+    for row in rows:
+        _write_row(out, row, previous_id, previous_ts)
+        previous_id, previous_ts = row[0], row[4]
+    return frame(BATCH, out)
+
+def decode_rows(frame_type, view):
+    # Строки сообщений из кадра MESSAGE или BATCH
+    if frame_type == MESSAGE:
+        row, _ = _read_row(view, 0, 0, 0)
+        return [row]
+    count, offset = _read_varint(view, 0)
+    rows = []
+    previous_id = previous_ts = 0
+    for _ in range(count):
+        row, offset = _read_row(view, offset, previous_id, previous_ts)
+        rows.append(row)
+        previous_id, previous_ts = row[0], row[4]
+    return rows
+
+def encode_request(payload):
+    # Запросы и ответы в виде словарей, как в JSON-протоколе relay.py, — в кадры
+    op = payload['op']
+    out = bytearray()
+    if op == 'auth':
+        write_str(out, payload['username'])
+        write_str(out, payload['password'])
+        after_id = payload.get('after_id')
+        write_varint(out, 0 if after_id is None else after_id + 1)
+        write_varint(out, payload.get('credits', 0))
+        return frame(AUTH, out)
+    if op == 'send':
+        write_varint(out, payload.get('ref') or 0)
+        out.append(RECEIVER_TYPES.index(payload.get('type', 'user')))
+        write_varint(out, payload['to'])
+        write_str(out, payload.get('content'))
+        return frame(SEND, out)
+    if op == 'credit':
+        write_varint(out, payload['credits'])
+        return frame(CREDIT, out)
+    if op == 'auth_ok':
+        write_varint(out, payload['user_id'])
+        write_varint(out, payload['last_id'])
+        return frame(AUTH_OK, out)
+    if op == 'sent':
+        write_varint(out, payload.get('ref') or 0)
+        write_varint(out, payload['id'])
+        return frame(SENT, out)
+    if op == 'error':
+        write_varint(out, payload.get('ref') or 0)
+        write_str(out, payload['message'])
+        return frame(ERROR, out)
+    raise ProtocolError(f"Неизвестная команда: {op}")
+
+def decode_request(frame_type, view):
+    if frame_type == AUTH:
+        username, offset = read_str(view, 0)
+        password, offset = read_str(view, offset)
+        after_id, offset = _read_varint(view, offset)
+        credits, offset = _read_varint(view, offset)
+        return {'op': 'auth', 'username': username, 'password': password,
+                'after_id': after_id - 1 if after_id else None, 'credits': credits}
+    if frame_type == SEND:
+        ref, offset = _read_varint(view, 0)
+        receiver_type, offset = _read_receiver_type(view, offset)
+        receiver_id, offset = _read_varint(view, offset)
+        content, offset = read_str(view, offset)
+        return {'op': 'send', 'ref': ref, 'type': receiver_type, 'to': receiver_id, 'content': content}
+    if frame_type == CREDIT:
+        credits, _ = _read_varint(view, 0)
+        return {'op': 'credit', 'credits': credits}
+    if frame_type == AUTH_OK:
+        user_id, offset = _read_varint(view, 0)
+        last_id, offset = _read_varint(view, offset)
+        return {'op': 'auth_ok', 'user_id': user_id, 'last_id': last_id}
+    if frame_type == SENT:
+        ref, offset = _read_varint(view, 0)
+        message_id, offset = _read_varint(view, offset)
+        return {'op': 'sent', 'ref': ref, 'id': message_id}
+    if frame_type == ERROR:
+        ref, offset = _read_varint(view, 0)
+        message, offset = read_str(view, offset)
+        return {'op': 'error', 'ref': ref, 'message': message}
+    raise ProtocolError(f"Неизвестный тип кадра: {frame_type}")
+
+class FrameReader:
+    # Приёмный буфер: feed() добавляет прочитанное из сокета, frames() отдаёт целые кадры как
+    # (тип, memoryview данных). memoryview указывает прямо в буфер и годен только до следующего feed()
+
+    def __init__(self, max_frame_bytes=MAX_FRAME_BYTES):
+        self.max_frame_bytes = max_frame_bytes
+        self.buffer = bytearray()
+        self.start = 0
+
+    def feed(self, data):
+        if self.start:
+            try:
+                del self.buffer[:self.start]
+            except BufferError:
+                # Кто-то ещё держит memoryview старого буфера — начинаем новый
+                self.buffer = self.buffer[self.start:]
+            self.start = 0
+        self.buffer += data
+
+    def frames(self):
+        view = memoryview(self.buffer)
+        try:
+            while True:
+                length, offset = read_varint(view, self.start)
+                if length is None:
+                    return
+                if length == 0 or length > self.max_frame_bytes:
+                    raise ProtocolError(f"Недопустимая длина кадра: {length}")
+                end = offset + length
+                if end > len(view):
+                    return
+                self.start = end
+                yield view[offset], view[offset + 1:end]
+        finally:
+            view.release()